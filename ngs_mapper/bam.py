@@ -45,6 +45,33 @@ def samtobam( sam, outbam ):
         log.debug("Returning processes stdout value")
         return p.stdout
 
+def sortsam( sam, outbam, threads=1, memory=None ):
+    '''
+        Converts a sam stream to bam and coordinate sorts it into outbam without
+        writing anything else to disk
+
+        samtools view -Sbu - | samtools sort -@ threads -m memory -f - outbam
+
+        @sam - file object(even pipe) of sam input
+        @outbam - file path of the sorted bam
+        @threads - Threads for samtools sort to use
+        @memory - Memory per sort thread(samtools -m value such as 768M)
+
+        @returns the Popen objects for samtools view and samtools sort that the
+        caller needs to wait on
+    '''
+    viewcmd = ['samtools','view','-Sbu','-']
+    sortcmd = ['samtools','sort','-@',str(threads)]
+    if memory is not None:
+        sortcmd += ['-m',str(memory)]
+    sortcmd += ['-f','-',outbam]
+    log.info('Running {0} | {1}'.format(' '.join(viewcmd), ' '.join(sortcmd)))
+    view = subprocess.Popen( viewcmd, stdin=sam, stdout=subprocess.PIPE )
+    sort = subprocess.Popen( sortcmd, stdin=view.stdout )
+    # Only sort holds the pipe now so view gets SIGPIPE if sort dies
+    view.stdout.close()
+    return view, sort
+
 def sortbam( bam, outbam ):
     '''
         Sorts a bam file using samtools
@@ -6,17 +6,17 @@ import json
 
 import bam
 import bqd
-import samtools
+import pileup
 
 def main():
     args = parse_args()
     print_json( args )
 
 def print_json( args ):
-    pileup = samtools.nogap_mpileup(args.bamfile)
-    pileup = bqd.parse_pileup( pileup )
-    set_unmapped_mapped_reads( args.bamfile, pileup )
-    print json.dumps( pileup )
+    columns = pileup.gap_columns(args.bamfile)
+    stats = bqd.parse_pileup( columns )
+    set_unmapped_mapped_reads( args.bamfile, stats )
+    print json.dumps( stats )
 
 def set_unmapped_mapped_reads( bamfile, pileup ):
     ''' add mapped/unmapped reads to json for each reference '''
@@ -1,15 +1,26 @@
-from ngs_mapper.samtools import MPileupColumn, mpileup, parse_regionstring
+from ngs_mapper.samtools import MPileupColumn, parse_regionstring, QUAL_BINS
+from ngs_mapper import pileup
+from ngs_mapper import bqd
+from ngs_mapper import flagstat
+from ngs_mapper.bam_to_qualdepth import set_unmapped_mapped_reads
 from ngs_mapper.alphabet import iupac_amb
 
 import sys
 import argparse
 import re
+import csv
+import itertools
+from collections import namedtuple
 from StringIO import StringIO
-from os.path import basename
+from os.path import basename, exists
 import os
 import multiprocessing
+import Queue
 import time
+import math
+import json
 
+import numpy as np
 import vcf
 from Bio import SeqIO
 
@@ -27,6 +38,68 @@ VCF_HEAD = '''##fileformat=VCFv4.2
 ##INFO=<ID=HPOLY,Number=0,Type=Flag,Description="Is a homopolymer">
 #CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	{0}'''
 
+# A single row of the vcf. ALT is a list of bases or . and INFO is a dictionary
+VCFRecord = namedtuple('VCFRecord', ['CHROM', 'POS', 'REF', 'ALT', 'INFO'])
+
+class BlankRun(namedtuple('BlankRun', ['CHROM', 'start', 'end', 'refseq', 'hpoly', 'call'])):
+    '''
+    A run of reference positions start through end(1 based, inclusive) that have
+    no pileup column and would all get a blank_vcf_row
+
+    refseq is the whole reference sequence and hpoly the hpoly_index lookup for
+    the reference(or None) so runs can be split without copying either of them
+    '''
+    __slots__ = ()
+
+    @property
+    def length(self):
+        return self.end - self.start + 1
+
+    def records(self):
+        ''' Generates the blank_vcf_row for every position in the run '''
+        for pos in xrange(self.start, self.end + 1):
+            rec = blank_vcf_row(self.CHROM, self.refseq, pos, self.call)
+            if self.hpoly is not None and self.hpoly[pos]:
+                rec.INFO['HPOLY'] = True
+            yield rec
+
+# How many chunks to make per thread so workers that finish early can pick up more
+CHUNKS_PER_THREAD = 4
+# How many depth samples to take per chunk when estimating work
+SAMPLES_PER_CHUNK = 8
+# Smallest piece of a reference that is worth sampling on its own
+MIN_BIN_LENGTH = 100
+# How many vcf records a worker sends back at a time
+VCF_BATCH_SIZE = 1000
+
+# Quality value for each index of a quality histogram
+QUALS = np.arange(QUAL_BINS)
+
+def qual_index(qual):
+    '''
+    Index into a quality histogram of the first quality that is >= qual
+    so that counts[:i] are all < qual and counts[i:] are all >= qual
+
+    :param int qual: Quality threshold
+    '''
+    return min(max(int(math.ceil(qual)), 0), QUAL_BINS)
+
+def count_depth(counts):
+    '''
+    How many bases a quality histogram represents
+
+    :param numpy.array counts: quality histogram
+    '''
+    return int(counts.sum())
+
+def count_qualsum(counts):
+    '''
+    Sum of all the qualities a quality histogram represents
+
+    :param numpy.array counts: quality histogram
+    '''
+    return int(np.dot(counts, QUALS))
+
 def timeit(func):
     def wrapper(*args, **kwargs):
         import time; st = time.time()
@@ -65,66 +138,245 @@ def main():
                 args.bias,
                 args.threads,
                 VCF_HEAD.format(basename(args.bamfile)),
+                args.qualdepth,
+                args.flagstats
        )
+    if args.validate:
+        validate_vcf(args.vcf_output_file)
 
-def generate_vcf_multithreaded(bamfile, reffile, vcf_output_file, minbq, maxd, mind, minth, biasth, bias, threads, vcfhead=VCF_HEAD):
+def generate_vcf_multithreaded(bamfile, reffile, vcf_output_file, minbq, maxd, mind, minth, biasth, bias, threads, vcfhead=VCF_HEAD, qualdepth_file=None, flagstats_file=None):
     '''
-    Generate vcf for each ref and split each ref into pieces
+    Generate vcf for each ref and split each ref into pieces that are called
+    by a pool of threads workers.
+
+    Workers send batches of formatted records back through a queue and they are
+    written to vcf_output_file in reference order as soon as every chunk before
+    them is finished
+
+    The same pass can also produce the qualdepth json(same as graphsample) and
+    flagstats(same as samtools flagstat) for the bam file so it does not have to be
+    read again for them
+
+    :param str qualdepth_file: Where to write the qualdepth json if given
+    :param str flagstats_file: Where to write the flagstat output if given
     '''
     # Generate name if not given
     if vcf_output_file is None:
         vcf_output_file = bamfile + '.vcf'
-    # Store the temp file names to concat together later
+
+    references = []
+    # Homopolymers are found once for every reference and shared with the workers
+    # unless they were already saved next to the reference
+    saved = load_hpoly_index(reffile) or {}
+    hpolys = {}
+    for rec in SeqIO.parse(reffile, 'fasta'):
+        references.append((rec.id, len(rec.seq)))
+        if rec.id in saved and len(saved[rec.id]) == len(rec.seq) + 1:
+            hpolys[rec.id] = saved[rec.id]
+        else:
+            hpolys.update(hpoly_index({rec.id: rec}, 3))
+    regions = partition_references(bamfile, references, threads)
+
     map_args = []
-    # Temporary name suffix because tmpfile is too good of an idea
-    i = 0
-
-    procs = []
-    for refrecord in SeqIO.parse(reffile,'fasta'):
-        reflen = len(refrecord.seq)+1
-
-        # Will break reference into chunks depending on how many threads
-        chunksize = reflen/threads
-        
-        # Make regionstr to match chunks
-        for start in range(1, reflen, chunksize):
-            vcf_tmp_filename = "{0}.{1}".format(vcf_output_file,i)
-            end = start + chunksize - 1
-            regionstr = '{0}:{1}-{2}'.format(refrecord.id,start,end)
-            
-            complete_ref = False
-            if end == reflen:
-                complete_ref = True
-
-            args = (bamfile, reffile, regionstr, vcf_tmp_filename, minbq, maxd, mind, minth, biasth, bias, vcfhead)#, complete_ref)
-            map_args.append(args)
-            # Create and start a new process
-            p = multiprocessing.Process(target=generate_vcf, args=args)
-            p.start()
-            procs.append(p)
-            #generate_vcf(*args)
-            i += 1
-
-        # Wait for all processes to finish
-        for p in procs:
-            p.join()
-
-    with open(vcf_output_file, 'w') as fho:
-        # Write the head
-        fho.write(vcfhead + '\n')
-        # Cat all tmpfiles and remove them
-        for args in map_args:
-            f = args[3]
-            # Write tmp file contents to master file
-            with open(f) as fhr:
-                # Burn off header
-                for line in VCF_HEAD.splitlines():
-                    fhr.readline()
-                fho.write(fhr.read())
-                # Remove temp file
-                os.unlink(f)
+    for i, regionstr in enumerate(regions):
+        args = (i, bamfile, reffile, regionstr, minbq, maxd, mind, minth, biasth, bias, vcfhead)
+        map_args.append(args)
+
+    queue = multiprocessing.Queue()
+    collect_qualdepth = qualdepth_file is not None
+    pool = multiprocessing.Pool(threads, _init_worker, (queue, hpolys, collect_qualdepth))
+    try:
+        # chunksize of 1 hands out chunks in order
+        result = pool.map_async(_vcf_chunk, map_args, 1)
+        # Flags are counted by whichever worker frees up first
+        if flagstats_file is not None:
+            flagresult = pool.apply_async(flagstat.flagstats, (bamfile,))
+        with open(vcf_output_file, 'w') as fho:
+            # Write the head
+            fho.write(vcfhead + '\n')
+            for batch in ordered_batches(queue, len(map_args), result):
+                fho.write(batch)
+        if collect_qualdepth:
+            stats = bqd.merge_pileup_stats(result.get())
+            set_unmapped_mapped_reads(bamfile, stats)
+            with open(qualdepth_file, 'w') as fh:
+                json.dump(stats, fh)
+        if flagstats_file is not None:
+            with open(flagstats_file, 'w') as fh:
+                fh.write(flagresult.get())
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
     return vcf_output_file
 
+def _init_worker(queue, hpolys, collect_qualdepth=False):
+    '''
+    Gives each pool worker the queue to send finished batches to, the
+    hpoly_index for all references and if chunks should collect bqd.PileupStats
+    '''
+    global _batch_queue, _hpolys, _collect_qualdepth
+    _batch_queue = queue
+    _hpolys = hpolys
+    _collect_qualdepth = collect_qualdepth
+
+def _vcf_chunk(args):
+    '''
+    Calls a single chunk inside of a pool worker
+
+    Puts (chunk, text) onto the worker queue for every VCF_BATCH_SIZE records
+    followed by (chunk, None) when the chunk is finished
+
+    :param tuple args: chunk number followed by the generate_vcf arguments(without vcf_output_file)
+    :return: bqd.PileupStats for the chunk if the pool is collecting them otherwise None
+    '''
+    chunk = args[0]
+    vcf_template = args[-1]
+    qualdepth = None
+    if _collect_qualdepth:
+        qualdepth = bqd.PileupStats(*parse_regionstring(args[3]))
+    # The parent writes the header itself
+    out_vcf = VCFWriter(None, vcf_template)
+    records = vcf_records(*args[1:-1], hpolys=_hpolys, qualdepth=qualdepth)
+    for batch in record_batches(records, VCF_BATCH_SIZE):
+        _batch_queue.put((chunk, out_vcf.format_records(batch)))
+    _batch_queue.put((chunk, None))
+    return qualdepth
+
+def batches(iterable, size):
+    '''
+    Generates lists of up to size items from iterable
+
+    :param iterable iterable: Any iterable
+    :param int size: Maximum items in each list
+    '''
+    iterable = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterable, size))
+        if not batch:
+            return
+        yield batch
+
+def record_batches(records, size):
+    '''
+    Same as batches except that a BlankRun counts as every position it covers
+    and is split up so that no batch covers more than size positions
+
+    :param iterable records: VCFRecord and BlankRun
+    :param int size: Maximum positions in each list
+    '''
+    batch = []
+    npos = 0
+    for rec in records:
+        if isinstance(rec, BlankRun):
+            start = rec.start
+            while start <= rec.end:
+                end = min(rec.end, start + size - npos - 1)
+                batch.append(rec._replace(start=start, end=end))
+                npos += end - start + 1
+                start = end + 1
+                if npos == size:
+                    yield batch
+                    batch = []
+                    npos = 0
+        else:
+            batch.append(rec)
+            npos += 1
+            if npos == size:
+                yield batch
+                batch = []
+                npos = 0
+    if batch:
+        yield batch
+
+def ordered_batches(queue, nchunks, result=None):
+    '''
+    Generates the text batches from queue in chunk order. Batches for the chunk
+    that is next in line are yielded as soon as they arrive and batches for any
+    later chunk are held until every chunk before it is finished
+
+    :param Queue queue: queue of (chunk, text) where text is None when chunk is finished
+    :param int nchunks: How many chunks there are(numbered 0 through nchunks - 1)
+    :param multiprocessing.pool.AsyncResult result: If given, any exception a worker
+        raised is raised here instead of waiting forever for its chunk
+    '''
+    pending = {}
+    nextchunk = 0
+    while nextchunk < nchunks:
+        try:
+            chunk, batch = queue.get(True, 1)
+        except Queue.Empty:
+            if result is not None and result.ready() and not result.successful():
+                result.get()
+            continue
+        pending.setdefault(chunk, []).append(batch)
+        while nextchunk in pending:
+            batches = pending.pop(nextchunk)
+            for batch in batches:
+                if batch is not None:
+                    yield batch
+            # Only move on once the chunk is finished
+            if batches[-1] is not None:
+                break
+            nextchunk += 1
+
+def partition_references(bamfile, references, threads):
+    '''
+    Breaks up references into regions that should each take about the same amount
+    of work to call.
+
+    Each reference is split into small bins and the depth in the middle of each bin
+    is sampled from the bam index. A bin's work is its length times its depth(+1 so
+    that uncovered bases still count) and consecutive bins are joined until they
+    reach an even share of the total work. CHUNKS_PER_THREAD regions are made for
+    every thread so a single deep region does not leave the other workers idle.
+
+    If depth cannot be sampled regions are just split up by length.
+
+    :param str bamfile: Path to bam file
+    :param list references: (refname, reflen) for every reference in order
+    :param int threads: How many workers will be calling
+    :return: list of region strings in reference order
+    '''
+    nchunks = max(threads, 1) * CHUNKS_PER_THREAD
+    totallen = sum([reflen for ref, reflen in references])
+    binsize = max(MIN_BIN_LENGTH, int(math.ceil(totallen / float(nchunks * SAMPLES_PER_CHUNK))))
+
+    # (start, end, work) for every bin of every reference
+    refbins = []
+    for ref, reflen in references:
+        starts = range(1, reflen + 1, binsize)
+        ends = [min(start + binsize - 1, reflen) for start in starts]
+        middles = [(start + end) // 2 for start, end in zip(starts, ends)]
+        depths = pileup.sample_depths(bamfile, ref, middles)
+        bins = [
+            (start, end, (end - start + 1) * (depth + 1))
+            for start, end, depth in zip(starts, ends, depths)
+        ]
+        refbins.append((ref, bins))
+
+    target = sum([b[2] for ref, bins in refbins for b in bins]) / float(nchunks)
+    regions = []
+    for ref, bins in refbins:
+        if not bins:
+            continue
+        # Each reference gets its share of the chunks and regions never cross references
+        refwork = sum([b[2] for b in bins])
+        share = refwork / float(max(1, int(round(refwork / target))))
+        start = 1
+        work = 0
+        refregions = []
+        for binstart, binend, binwork in bins:
+            work += binwork
+            # Cut whenever the work crosses the next share or the reference ends
+            if work >= share * (len(refregions) + 1) or binend == bins[-1][1]:
+                refregions.append('{0}:{1}-{2}'.format(ref, start, binend))
+                start = binend + 1
+        regions += refregions
+    return regions
+
 def parse_args(args=sys.argv[1:]):
     from ngs_mapper import config
     conf_parser, args, config, configfile = config.get_config_argparse(args)
@@ -232,7 +484,28 @@ def parse_args(args=sys.argv[1:]):
         help=defaults['threads']['help']
    )
 
+    parser.add_argument(
+        '--qualdepth',
+        default=None,
+        help='Also write the qualdepth json(same as graphsample makes) for the bam file to this path'
+   )
+
+    parser.add_argument(
+        '--flagstats',
+        default=None,
+        help='Also write the samtools flagstat output for the bam file to this path'
+   )
+
+    parser.add_argument(
+        '--validate',
+        default=False,
+        action='store_true',
+        help='Read the finished vcf back in with PyVCF to make sure it is valid'
+   )
+
     args = parser.parse_args(args)
+    if args.regionstr is not None and (args.qualdepth or args.flagstats):
+        parser.error('--qualdepth and --flagstats are for the whole bam file and cannot be used with -r')
     if args.vcf_output_file is None:
         args.vcf_output_file = args.bamfile + '.vcf'
 
@@ -242,7 +515,7 @@ def mark_lq(stats, minbq, mind, refbase):
     '''
     Goes through all keys in the stats dictionary that are not in ('depth','mqualsum','bqualsum')
     which should be keys that represent nucleotide bases. Those keys then point to a dictionary
-    that contain 'mapq': [] and 'baseq': []
+    that contain 'baseq' which is a quality histogram(see MPileupColumn.base_counts)
     Creating a new base called N or ? depending on the overall depth
 
         - N for < mind & not refbase
@@ -262,31 +535,34 @@ def mark_lq(stats, minbq, mind, refbase):
     stats2['mqualsum'] = stats['mqualsum']
     stats2['bqualsum'] = stats['bqualsum']
 
+    # Qualities below this index are low quality
+    lqi = qual_index(minbq)
     for base, quals in stats.iteritems():
         # Only interested in base stats in this loop
         if base not in ('depth','mqualsum','bqualsum'):
-            # generates a list called bquals
             bquals = quals['baseq']
-            # loop to examine the quality score and identifyes bases with a quality score less than the minbq
-            for q in bquals:
-                # Copy base so we can modify if needed without destroying original base
-                k = base
-                if q < minbq:
-                    # Determine base to use since this base is low quality
-                    if stats2['depth'] < mind:
-                        if base != refbase:
-                            # N since low qual and low depth
-                            k = 'N'
-                        else:
-                            # Bias reference base
-                            k = base
-                    else:
-                        # Base is unknown
-                        k = '?'
-                # adds the N to the nucleotides (A C G T and N)
-                if k not in stats2:
-                    stats2[k] = {'baseq':[]}
-                stats2[k]['baseq'].append(q)
+            # Split the histogram into the low quality and the high quality part
+            lq = bquals.copy()
+            lq[lqi:] = 0
+            hq = bquals - lq
+            # Determine base to use for the low quality part
+            if stats2['depth'] < mind:
+                if base != refbase:
+                    # N since low qual and low depth
+                    k = 'N'
+                else:
+                    # Bias reference base
+                    k = base
+            else:
+                # Base is unknown
+                k = '?'
+            # adds the N to the nucleotides (A C G T and N)
+            for b, counts in ((base, hq), (k, lq)):
+                # Bases only show up if they have any qualities
+                if counts.any():
+                    if b not in stats2:
+                        stats2[b] = {'baseq': np.zeros(QUAL_BINS, dtype=counts.dtype)}
+                    stats2[b]['baseq'] += counts
     return stats2
 
 def hpoly_list(refseqs, minlength=3):
@@ -302,15 +578,62 @@ def hpoly_list(refseqs, minlength=3):
         hpolys[seq] = [(m.group(0),m.start()+1,m.end()) for m in matches]
     return hpolys
 
-def is_hpoly(hpolylist, seqid, curpos):
+def hpoly_index(refseqs, minlength=3):
+    '''
+    Builds a lookup table for every reference in refseqs where index i is True if
+    reference position i(1 based) is inside of a homopolymer
+
+    :param str refseqs: Bio.SeqIO.index'd fasta(or dictionary of SeqRecord)
+    :param int minlength: Minimum length of a homopolymer
+    :return: dictionary of numpy bool arrays keyed by reference name
+    '''
+    index = {}
+    for seq, hpolys in hpoly_list(refseqs, minlength).iteritems():
+        lookup = np.zeros(len(refseqs[seq].seq) + 1, dtype=bool)
+        for _, start, end in hpolys:
+            lookup[start:end+1] = True
+        index[seq] = lookup
+    return index
+
+def save_hpoly_index(reffile, path, minlength=3):
+    '''
+    Saves the hpoly_index of every reference in reffile to path so it does not
+    have to be built again(see load_hpoly_index)
+
+    :param str reffile: Path to reference fasta
+    :param str path: Where to save the index(numpy .npz)
+    :param int minlength: Minimum length of a homopolymer
+    '''
+    index = {}
+    for rec in SeqIO.parse(reffile, 'fasta'):
+        index.update(hpoly_index({rec.id: rec}, minlength))
+    with open(path, 'wb') as fh:
+        np.savez(fh, **index)
+
+def load_hpoly_index(reffile):
+    '''
+    Loads the hpoly_index saved next to reffile as reffile.hpoly.npz(such as by
+    :py:mod:`ngs_mapper.refcache`)
+
+    :param str reffile: Path to reference fasta
+    :return: dictionary just like hpoly_index or None if there is no saved index
+    '''
+    path = reffile + '.hpoly.npz'
+    if not exists(path):
+        return None
+    with np.load(path) as saved:
+        return dict((ref, saved[ref]) for ref in saved.files)
+
+def is_hpoly(hpolyindex, seqid, curpos):
     '''
     Identifies if a position is contained inside of a homopolymer
+
+    :param dict hpolyindex: lookup table from hpoly_index
+    :param str seqid: Reference name
+    :param int curpos: Reference position(1 based)
     '''
-    l = hpolylist[seqid]
-    for polys in l:
-        if curpos >= polys[1] and curpos <= polys[2]:
-            return True
-    return False
+    lookup = hpolyindex[seqid]
+    return curpos < len(lookup) and bool(lookup[curpos])
 
 def generate_vcf(bamfile, reffile, regionstr, vcf_output_file, minbq, maxd, mind=10, minth=0.8, biasth=50, bias=10, vcf_template=VCF_HEAD, complete_ref=False):
     '''
@@ -336,80 +659,179 @@ def generate_vcf(bamfile, reffile, regionstr, vcf_output_file, minbq, maxd, mind
 
     @returns path to vcf_output_file
     '''
-    #print regionstr
-    # All the references indexed by the seq.id(first string after the > in the file until the first space)
-    refseqs = SeqIO.index(reffile, 'fasta')
-    # Homopolymers for references
-    hpolys = hpoly_list(refseqs, 3)
-    # Our pretend file object that has vcf stuff in it
-    vcf_head = StringIO(vcf_template)
-    vcf_head.name = 'header.vcf'
     # Where to write the output file to
     if vcf_output_file is None:
         output_path = bamfile + '.vcf'
     else:
         output_path = vcf_output_file
-    # The vcf writer object
-    fh = open(output_path, 'w')
-    out_vcf = vcf.Writer(
-        fh,
-        template=vcf.Reader(vcf_head)
+    out_vcf = VCFWriter(open(output_path, 'w'), vcf_template)
+    out_vcf.write_records(
+        vcf_records(bamfile, reffile, regionstr, minbq, maxd, mind, minth, biasth, bias)
     )
+    out_vcf.close()
 
+    return output_path
 
-    # Get the iterator for an mpileupcal
+class VCFWriter(object):
+    '''
+    Writes VCFRecords the same way vcf.Writer writes vcf.model._Record but
+    without building any PyVCF objects
+
+    The header is just vcf_template and INFO fields are ordered the way they
+    are defined in it(undefined fields go last in alphabetical order). ID, QUAL
+    and FILTER are always .
+
+    :param file fh: File like object to write to. If None, only format_records can be used
+    :param str vcf_template: VCF Header template(string)
+    '''
+    def __init__(self, fh, vcf_template=VCF_HEAD):
+        self.fh = fh
+        self.info_order = re.findall(r'##INFO=<ID=([^,>]+)', vcf_template)
+        # csv handles quoting just like vcf.Writer does
+        self._buf = StringIO()
+        self._writer = csv.writer(self._buf, delimiter='\t', lineterminator='\n')
+        if fh is not None:
+            fh.write(vcf_template + '\n')
+
+    def format_info(self, info):
+        ''' Formats an INFO dictionary '''
+        if not info:
+            return '.'
+        keys = [k for k in self.info_order if k in info]
+        if len(keys) != len(info):
+            keys += sorted([k for k in info if k not in self.info_order])
+        fields = []
+        for k in keys:
+            v = info[k]
+            if isinstance(v, bool):
+                fields.append(k if v else '')
+            elif isinstance(v, list):
+                fields.append(k + '=' + ','.join([str(i) if i is not None else '.' for i in v]))
+            else:
+                fields.append(k + '=' + (str(v) if v is not None else '.'))
+        return ';'.join(fields)
+
+    def format_record(self, record):
+        ''' Returns the tuple of vcf columns for a VCFRecord '''
+        return (
+            str(record.CHROM), str(record.POS), '.', str(record.REF),
+            ','.join(map(str, record.ALT)), '.', '.', self.format_info(record.INFO)
+        )
+
+    def format_blank_run(self, run):
+        ''' Returns the list of vcf column tuples for every position in a BlankRun '''
+        info = blank_vcf_row(run.CHROM, run.refseq, run.start, run.call).INFO
+        infos = (self.format_info(info), self.format_info(dict(info, HPOLY=True)))
+        chrom = str(run.CHROM)
+        bases = str(run.refseq[run.start-1:run.end])
+        if run.hpoly is None:
+            hpoly = itertools.repeat(False)
+        else:
+            hpoly = run.hpoly[run.start:run.end+1].tolist()
+        positions = xrange(run.start, run.end + 1)
+        return [
+            (chrom, str(pos), '.', base, '.', '.', '.', infos[hp])
+            for pos, base, hp in itertools.izip(positions, bases, hpoly)
+        ]
+
+    def format_records(self, records):
+        ''' Returns the vcf text for a list of VCFRecords and BlankRuns '''
+        rows = []
+        for r in records:
+            if isinstance(r, BlankRun):
+                rows += self.format_blank_run(r)
+            else:
+                rows.append(self.format_record(r))
+        self._writer.writerows(rows)
+        text = self._buf.getvalue()
+        self._buf.seek(0)
+        self._buf.truncate()
+        return text
+
+    def write_records(self, records):
+        ''' Writes all records VCF_BATCH_SIZE positions at a time '''
+        for batch in record_batches(records, VCF_BATCH_SIZE):
+            self.fh.write(self.format_records(batch))
+
+    def write_record(self, record):
+        ''' Writes a single VCFRecord '''
+        self.fh.write(self.format_records([record]))
+
+    def close(self):
+        self.fh.close()
+
+def validate_vcf(vcf_path):
+    '''
+    Reads every record in vcf_path with PyVCF to make sure the vcf is valid
+
+    :param str vcf_path: Path to vcf file
+    :raises: any exception PyVCF raises for an invalid vcf
+    :return: how many records were read
+    '''
+    count = 0
+    with open(vcf_path) as fh:
+        for record in vcf.Reader(fh):
+            count += 1
+    return count
+
+def vcf_records(bamfile, reffile, regionstr, minbq, maxd, mind=10, minth=0.8, biasth=50, bias=10, hpolys=None, qualdepth=None):
+    '''
+    Generates a VCFRecord for every reference position in regionstr that has a
+    pileup column and a BlankRun for every run of positions without one
+
+    All parameters are identical to generate_vcf except
+
+    :param dict hpolys: hpoly_index that contains the reference in regionstr.
+        If not given, it is built just for that reference
+    :param bqd.PileupStats qualdepth: If given, every pileup column is added to it
+    '''
+    #print regionstr
+    # All the references indexed by the seq.id(first string after the > in the file until the first space)
+    refseqs = SeqIO.index(reffile, 'fasta')
+
+    # Get the iterator of pileup columns
     # Do not exclude any bases by setting minmq and minbq to 0 and maxdepth to 100000
-    piles = mpileup(bamfile, regionstr, 0, 0, 100000)
+    piles = pileup.columns(bamfile, regionstr, 0, 0, 100000)
 
     # Parse the region string for later
     parsed_regionstr = parse_regionstring(regionstr)
     # Get the reference name to work with
     refname = parsed_regionstr[0]
     refseq = refseqs[refname].seq
+    # Homopolymers for the reference
+    if hpolys is None:
+        hpolys = hpoly_index({refname: refseqs[refname]}, 3)
     # The end of the ref may be restricted via regionstr
     # Lets user specify region start less than 1
     refstart = max(parsed_regionstr[1], 1)
-    # Set refstart to 0 if regionstring start is 1
-    # so that the first base gets inserted with blank_vcf_rows
-    if refstart == 1:
-        refstart = 0
     # Lets user specify region end past length of region
     refend = min(parsed_regionstr[2], len(refseq))
     # Last position stores the last position seen
-    lastpos = refstart
+    # It starts just before the region so an uncovered first base gets a blank row
+    lastpos = refstart - 1
 
-    # Loop through each pileup row
-    for pilestr in piles:
-        # Generate the handy pileup column object
-        col = MPileupColumn(pilestr)
+    # Loop through each pileup column
+    for col in piles:
         # Current position in alignment
         curpos = col.pos
-        # The reference we are iterating on
-        for rec in blank_vcf_rows(col.ref, refseq, lastpos, curpos, '-'):
-            if is_hpoly(hpolys, col.ref, rec.POS):
-                rec.INFO['HPOLY'] = True
-            out_vcf.write_record(rec)
+        if qualdepth is not None:
+            qualdepth.add(col)
+        # Positions between the last column and this one are blank
+        if curpos > lastpos + 1:
+            yield BlankRun(refname, lastpos + 1, curpos - 1, refseq, hpolys[refname], '-')
         # Generate the vcf row for that column
         row = generate_vcf_row(col, refseq, minbq, maxd, mind, minth, biasth, bias)
         if is_hpoly(hpolys, col.ref, curpos):
             if row.INFO['CB'] == 'N':
                 row = generate_vcf_row(col, refseq, 10, maxd, 2, 0.5, biasth, bias)
             row.INFO['HPOLY'] = True
-        # Write the record to the vcf file
-        out_vcf.write_record(row)
+        yield row
         # Set last position seen
         lastpos = row.POS
 
-    # Insert blank vcf records from last position in mpileup to the end of regionstring
-    for rec in blank_vcf_rows(refname, refseq, lastpos, refend+1, '-'):
-        if is_hpoly(hpolys, refname, rec.POS):
-            rec.INFO['HPOLY'] = True
-        out_vcf.write_record(rec)
-
-    # Close the file
-    out_vcf.close()
-
-    return output_path
+    # Blank positions from last position in mpileup to the end of regionstring
+    if refend > lastpos:
+        yield BlankRun(refname, lastpos + 1, refend, refseq, hpolys[refname], '-')
 
 def blank_vcf_rows(refname, refseq, frompos, topos, call='-'):
     '''
@@ -421,27 +843,17 @@ def blank_vcf_rows(refname, refseq, frompos, topos, call='-'):
     The blank rows should represent a gap in the alignment and be called whatever
     call is set too
 
-    :param str refname: Reference name to set _Record.CHROM
+    :param str refname: Reference name to set VCFRecord.CHROM
     :param str refseq: Reference sequence to get reference base from
     :param int topos: Current position in the alignment(1 based)
     :param int frompos: Last position seen in the alignment(1 based)
     :param str call: - What to set the CB info field to(Default to:)
     :param bool includeend: Include end base position
 
-    @returns a list of vcf.model._Record objects filled out with the DP,RC,RAQ,PRC,CBD=0 and CB=call
+    @returns a list of VCFRecord objects filled out with the DP,RC,RAQ,PRC,CBD=0 and CB=call
     '''
-    #print refname
-    #print 'Topos: {0}'.format(topos)
-    #print 'formpos: {0}'.format(frompos)
-    # Blank record list
-    records = []
     # Only do records between frompos and topos
-    for i in range(frompos + 1, topos):
-        # Reference base at current position
-        rec = blank_vcf_row(refname, refseq, i, call)
-        records.append(rec)
-
-    return records
+    return list(BlankRun(refname, frompos + 1, topos - 1, refseq, None, call).records())
 
 def blank_vcf_row(refname, refseq, pos, call='-'):
     '''
@@ -451,7 +863,7 @@ def blank_vcf_row(refname, refseq, pos, call='-'):
     :param str pos: Reference position to get the reference base from(1 indexed)
     :param str call: What to set the CB info field to
 
-    @returns a vcf.model._Record
+    @returns a VCFRecord
     '''
     info = dict(
         DP=0,
@@ -461,14 +873,14 @@ def blank_vcf_row(refname, refseq, pos, call='-'):
         CB=call,
         CBD=0
     )
-    record = vcf.model._Record(refname, pos, None, refseq[pos-1], '.', None, None, info, None, None)
+    record = VCFRecord(refname, pos, refseq[pos-1], '.', info)
     return record
 
 def bias_hq(stats, biasth=50, bias=10):
     '''
     Biases high quality reads in stats so that they are more likely to be selected later on.
     Essentially duplicates quality scores(baseq values) by a factor of bias.
-    Given the example::
+    Given the example(baseq shown as lists instead of quality histograms)::
 
         stats = { 'A': {'baseq':[40,40,40]}, 'C': {'baseq':[50,50,50,50,50,50,50]} }
 
@@ -477,21 +889,19 @@ def bias_hq(stats, biasth=50, bias=10):
     With bias_hq(stats, 50, 2) you would end up with 3 A's and 14 C's or 18% A and 82% C so C
     would be more correctly called for the consensus
 
-    bias will round the length of the created list to the nearest integer so if the length of a
-    baseq is say 10 and the bias is 1.25 the resulting baseq list will be 13 in length(addition of 3 baseq)
-
     :param dict stats: Should most likely be a stats2 dictionary although stats would work as well
     :param int biasth: What quality value(>=) should be considered to be bias towards
     :param int bias: How much to bias aka, how much to multiply the # of quals >= biasth(has to be int >= 1)
 
     :rtype: dict
-    :return: stats2 formatted dictionary with all baseq lists appended to with the bias amount
+    :return: stats2 formatted dictionary with all baseq counts >= biasth multiplied by bias
     '''
     if bias < 1 or int(bias) != bias:
         raise ValueError("bias was set to {0} which is less than 1. Cannot bias on a factor < 1".format(bias))
 
-    # Because we are adding onto the existing list this needs to be one less
-    bias = int(bias) - 1
+    bias = int(bias)
+    # Qualities at or above this index get biased
+    hqi = qual_index(biasth)
 
     stats2 = {'depth': 0}
 
@@ -502,12 +912,10 @@ def bias_hq(stats, biasth=50, bias=10):
                 stats2[k] = v
             continue
         stats2[k] = {}
-        bquals = v['baseq']
-        # New list of all baseq >= biasth biased by a factor of bias
-        duplist = [d for d in bquals if d >= biasth] * bias
-        stats2[k]['baseq'] = v['baseq'] + duplist
-        stats2[k]['mapq'] = v.get('mapq', [])
-        stats2['depth'] += len(stats2[k]['baseq'])
+        bquals = v['baseq'].copy()
+        bquals[hqi:] *= bias
+        stats2[k]['baseq'] = bquals
+        stats2['depth'] += count_depth(bquals)
     return stats2
 
 def pile_stats(mpileupcol, refbase, minbq, mind, biasth, bias):
@@ -518,9 +926,7 @@ def pile_stats(mpileupcol, refbase, minbq, mind, biasth, bias):
 
     @returns a stats2 dictionary that is modified by biasing reference bases and high quality bases
     '''
-    # This call needs to be replaced after the mpileupcol parameter is put into place
-    # then stats_for_col(mpileup
-    s = mpileupcol.base_stats()
+    s = mpileupcol.base_counts()
     # Bias high quality first as it may change the behavior of mark_lq as the depth may
     # increase above the mind threshold
     stats2 = bias_hq(s, biasth, bias)
@@ -530,7 +936,7 @@ def pile_stats(mpileupcol, refbase, minbq, mind, biasth, bias):
     # are equal to or above the min depth
     if stats2['depth'] >= mind:
         if '?' in stats2:
-            stats2['depth'] -= len(stats2['?']['baseq'])
+            stats2['depth'] -= count_depth(stats2['?']['baseq'])
             del stats2['?']
 
     return stats2
@@ -548,7 +954,7 @@ def generate_vcf_row(mpileupcol, refseq, minbq, maxd, mind=10, minth=0.8, biasth
     :param int biasth: What quality value(>=) should be considered to be bias towards
     :param int bias: How much to bias aka, how much to multiply the # of quals >= biasth(has to be int >= 1)
 
-    @returns a vcf.model._Record
+    @returns a VCFRecord
     '''
     # The base position should be the same as the second item in the parsed region string
     start = mpileupcol.pos
@@ -578,12 +984,13 @@ def generate_vcf_row(mpileupcol, refseq, minbq, maxd, mind=10, minth=0.8, biasth
     # Maybe reference base isn't in stats
     if rb in stats2:
         refstats = stats2[rb]
-        # Reference Count is length of the base qualities list
-        info['RC'] = len(refstats['baseq'])
-        # Reference Average Quality is the sum of base qualities / length
-        info['RAQ'] = int(round(sum(refstats['baseq']) / float(len(refstats['baseq'])), 0))
-        # Percentage Reference Count is len of qualities / depth
-        info['PRC'] = int(round((100.0 * len(refstats['baseq'])) / float(stats2['depth']), 0))
+        refcount = count_depth(refstats['baseq'])
+        # Reference Count is how many base qualities there are
+        info['RC'] = refcount
+        # Reference Average Quality is the sum of base qualities / count
+        info['RAQ'] = int(round(count_qualsum(refstats['baseq']) / float(refcount), 0))
+        # Percentage Reference Count is count of qualities / depth
+        info['PRC'] = int(round((100.0 * refcount) / float(stats2['depth']), 0))
     else:
         info['RC'] = 0
         info['RAQ'] = 0
@@ -603,7 +1010,7 @@ def generate_vcf_row(mpileupcol, refseq, minbq, maxd, mind=10, minth=0.8, biasth
         alt_bases = '.'
 
     # need to record each line of the vcf file.
-    record = vcf.model._Record(mpileupcol.ref, start, None, rb, alt_bases, None, None, info, None, None)
+    record = VCFRecord(mpileupcol.ref, start, rb, alt_bases, info)
 
     return record
 
@@ -629,7 +1036,7 @@ def caller(stats2, minbq, maxd, mind=10, minth=0.8):
     # Else we will determine if the N's are the majority now
     # defines if the base is an N
     if '?' in stats2:
-        nlen = len(stats2['?']['baseq'])
+        nlen = count_depth(stats2['?']['baseq'])
         np = nlen/(stats2['depth']*1.0)
         if np > (1-minth):
             return ('N', nlen)
@@ -641,7 +1048,7 @@ def call_on_pct(stats2, minth=0.8):
     any base where it is in %total >= minth.
 
     Base quality is not used to make the determination, but instead the number of quality scores
-    in the baseq list is used as it depicts the depth of that base. The quality scores are not used
+    in the baseq histogram is used as it depicts the depth of that base. The quality scores are not used
     as the stats dictionary should already be run through the label_n function.
 
     :param str stats2: Stats dictionary returned from mark_lq or stats_at_refpos.stats
@@ -657,15 +1064,15 @@ def call_on_pct(stats2, minth=0.8):
     for base, quals in stats2.iteritems():
         # Only interested in base stats in this loop
         if base not in ('depth','mqualsum','bqualsum'):
-            # Quick alias for quals['baseq']
-            bquals = quals['baseq']    
+            # How many of this base there are
+            basecount = count_depth(quals['baseq'])
             # Percentage of current base compared to total depth
-            np_2 = len(bquals)/(stats2['depth']*1.0)
+            np_2 = basecount/(stats2['depth']*1.0)
             # fix for proper calculations with float
             # If basepercent is greater than minimum threashold
             if np_2 > round((1-minth),2):
                 nt_list += base
-                count += len(bquals)
+                count += basecount
     dnalist = sorted(nt_list)
     try:
         return (iupac_amb(dnalist), count)
@@ -705,12 +1112,13 @@ def info_stats(stats, rb):
     for base, quals in stats.iteritems():
         if base  not in ('depth','mqualsum','bqualsum',rb):
             # identify the alternitive bases in stats 2        
+            basecount = count_depth(quals['baseq'])
             # data for the alternitive count
-            info['AC'].append(len(quals['baseq']))
+            info['AC'].append(basecount)
             # data for the alternitive avarage quality
-            info['AAQ'].append(int(round((sum(quals['baseq'])*1.0)/len(quals['baseq']))))
+            info['AAQ'].append(int(round((count_qualsum(quals['baseq'])*1.0)/basecount)))
             # data for the percentage reference count
-            info['PAC'].append(int(round((len(quals['baseq'])*100.0)/(stats['depth']))))
+            info['PAC'].append(int(round((basecount*100.0)/(stats['depth']))))
             # base data
             info['bases'].append(base)
                                      
@@ -8,6 +8,7 @@ from collections import namedtuple
 from itertools import izip
 
 from matplotlib.lines import Line2D
+import numpy as np
 
 import log
 import samtools
@@ -25,10 +26,13 @@ REGIONTYPES = [
     G, N, LC, LQ, LCQ
 ]
 
+# Average quality of a position without any bases(same as MPileupColumn.bqual_avg)
+GAP_QUAL = float('nan')
+
 def parse_pileup( pileup ):
     '''
-    Parses the raw pileup output from samtools mpileup and returns a dictionary
-    with stats for every reference in the pileup
+    Parses the raw pileup output from samtools mpileup(or the pileup columns from
+    ngs_mapper.pileup) and returns a dictionary with stats for every reference in the pileup
 
         - maxd/mind - max/min depth found for that reference
         - maxq/minq - max/min quality found for that reference
@@ -36,14 +40,18 @@ def parse_pileup( pileup ):
         - avgquals - average quality at each base position
         - length - length of assembly
 
-    @pileup - file like object that returns lines from samtools mpileup
+    @pileup - file like object that returns lines from samtools mpileup or iterable of
+        pileup column objects. samtools.PileupGap runs are expanded into 0 depth positions
 
     @returns dictionary {'ref1': {maxd:0,mind:0,maxq:0,minq:0,depths:[],avgquals:[],length:0}, 'ref2':...}
     '''
     refs = {}
     lastpos = {}
     for line in pileup:
-        mcol = samtools.MPileupColumn(line)
+        if isinstance(line, basestring):
+            mcol = samtools.MPileupColumn(line)
+        else:
+            mcol = line
 
         # Initialize new reference
         if mcol.ref not in refs:
@@ -58,6 +66,15 @@ def parse_pileup( pileup ):
                 'length': 0
             }
 
+        # Whole run of 0 depth positions without any qualities
+        if isinstance(mcol, samtools.PileupGap):
+            refs[mcol.ref]['mind'] = 0
+            refs[mcol.ref]['avgquals'].extend([GAP_QUAL] * mcol.length)
+            refs[mcol.ref]['depths'].extend([0] * mcol.length)
+            refs[mcol.ref]['length'] += mcol.length
+            lastpos[mcol.ref] = mcol.end
+            continue
+
         refs[mcol.ref]['maxd'] = max(refs[mcol.ref]['maxd'], mcol.depth)
         refs[mcol.ref]['mind'] = min(refs[mcol.ref]['mind'], mcol.depth)
         for q in mcol.bquals:
@@ -71,6 +88,97 @@ def parse_pileup( pileup ):
 
     return refs
 
+class PileupStats(object):
+    '''
+    Collects the same statistics as parse_pileup for a region of a reference from
+    pileup columns that were made without any filtering(minmq=0, minbq=0) by
+    filtering every column the way samtools mpileup would with minmq and minbq
+
+    This lets the same pileup columns be used for other things(such as base_caller)
+    while still getting qualdepth statistics for the default mpileup options
+
+    :param str ref: Reference name
+    :param int start: First position of the region(1 based)
+    :param int end: Last position of the region(1 based, inclusive)
+    :param int minmq: Minimum mapping quality for a read to be in a column
+    :param int minbq: Minimum base quality for a base to be counted
+    '''
+    def __init__( self, ref, start, end, minmq=20, minbq=25 ):
+        self.ref = ref
+        self.start = start
+        self.end = end
+        self.minmq = minmq
+        self.minbq = minbq
+        length = max(end - start + 1, 0)
+        self.depths = np.zeros(length, dtype=int)
+        self.avgquals = np.empty(length)
+        self.avgquals.fill(GAP_QUAL)
+        # Positions that would have a column in the filtered pileup
+        self.covered = np.zeros(length, dtype=bool)
+        self.maxq = 0
+        self.minq = 1000
+
+    def add( self, mcol ):
+        ''' Adds an unfiltered pileup column '''
+        mqpass = np.asarray(mcol.mquals) >= self.minmq
+        # mpileup skips reads below minmq so there is no column without any
+        if not mqpass.any():
+            return
+        i = mcol.pos - self.start
+        bquals = np.asarray(mcol.bquals)
+        quals = bquals[mqpass & (bquals >= self.minbq)]
+        self.covered[i] = True
+        self.depths[i] = len(quals)
+        if len(quals):
+            self.avgquals[i] = round(np.mean(quals), 2)
+            self.maxq = max(self.maxq, int(quals.max()))
+            self.minq = min(self.minq, int(quals.min()))
+
+def merge_pileup_stats( pileupstats ):
+    '''
+    Merges PileupStats for regions of references into the same dictionary
+    parse_pileup would return for a nogap pileup of the whole alignment
+
+    Just like the pileup, each reference starts at position 1 and ends at the last
+    covered position and references without any covered positions are left out
+
+    :param list pileupstats: PileupStats in reference order
+    :return: dictionary {'ref1': {maxd:0,mind:0,maxq:0,minq:0,depths:[],avgquals:[],length:0}, 'ref2':...}
+    '''
+    byref = {}
+    order = []
+    for stats in pileupstats:
+        if stats.ref not in byref:
+            byref[stats.ref] = []
+            order.append(stats.ref)
+        byref[stats.ref].append(stats)
+
+    refs = {}
+    for ref in order:
+        length = max([s.end for s in byref[ref]])
+        depths = np.zeros(length + 1, dtype=int)
+        avgquals = np.empty(length + 1)
+        avgquals.fill(GAP_QUAL)
+        covered = np.zeros(length + 1, dtype=bool)
+        for s in byref[ref]:
+            depths[s.start:s.end+1] = s.depths
+            avgquals[s.start:s.end+1] = s.avgquals
+            covered[s.start:s.end+1] = s.covered
+        if not covered.any():
+            continue
+        # Index of the last covered position is also the length
+        last = int(np.flatnonzero(covered)[-1])
+        refs[ref] = {
+            'maxd': int(depths[1:last+1].max()),
+            'mind': int(depths[1:last+1].min()),
+            'maxq': max([s.maxq for s in byref[ref]]),
+            'minq': min([s.minq for s in byref[ref]]),
+            'depths': depths[1:last+1].tolist(),
+            'avgquals': avgquals[1:last+1].tolist(),
+            'length': last
+        }
+    return refs
+
 # Named tuple to store each region in
 CoverageRegion = namedtuple('CoverageRegion', ['start','end','type'])
 
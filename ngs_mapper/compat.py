@@ -1,3 +1,5 @@
+import os
+
 try:
     from collections import OrderedDict
 except ImportError:
@@ -21,3 +23,58 @@ except ImportError:
             e.output = output
             raise e
         return output
+
+def _libc_function( name, restype, argtypes ):
+    '''
+    Gets name from the C library through ctypes so system calls python 2 does not
+    wrap can still be used. Calls raise OSError just like the os module does
+    Returns None if the C library does not have name
+    '''
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL( ctypes.util.find_library( 'c' ), use_errno=True )
+        func = getattr( libc, name )
+    except (ImportError, OSError, AttributeError, TypeError):
+        return None
+    func.restype = restype
+    func.argtypes = argtypes
+    def call( *args ):
+        r = func( *args )
+        if r < 0:
+            err = ctypes.get_errno()
+            raise OSError( err, os.strerror( err ) )
+        return r
+    return call
+
+try:
+    from os import sendfile
+except ImportError:
+    import ctypes
+    _sendfile = _libc_function(
+        'sendfile', ctypes.c_ssize_t,
+        [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+    )
+    if _sendfile is None:
+        sendfile = None
+    else:
+        def sendfile( out_fd, in_fd, offset, count ):
+            ''' Only offset=None(read from the current position of in_fd) is supported '''
+            if offset is not None:
+                raise ValueError( 'offset is not supported' )
+            return _sendfile( out_fd, in_fd, None, count )
+
+try:
+    from os import copy_file_range
+except ImportError:
+    import ctypes
+    _copy_file_range = _libc_function(
+        'copy_file_range', ctypes.c_ssize_t,
+        [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    )
+    if _copy_file_range is None:
+        copy_file_range = None
+    else:
+        def copy_file_range( src, dst, count ):
+            ''' Copies count bytes from the current position of src to the current position of dst '''
+            return _copy_file_range( src, None, dst, None, count, 0 )
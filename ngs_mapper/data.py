@@ -4,8 +4,12 @@ import os
 import sys
 import re
 import log
+import json
+import tempfile
 from Bio import SeqIO
 import gzip
+from ngs_mapper.reads import iter_fastq, fastq_records, record_id, fasta_records, FastqWriter
+from ngs_mapper.util import readable_mode
 
 logger = log.setup_logger(__name__, log.get_config())
 
@@ -77,21 +81,116 @@ READ_ID_MAPPING = (
 )
 ''' Mapping of regular expression for a read identifier to the platform that it belongs to '''
 
+PLATFORMS = ('Roche454','IonTorrent','MiSeq', 'Sanger')
+''' Every platform in the order reads_by_plat reports them '''
+PLATFORM_CACHE = '.read_platforms.json'
+''' Name of the PlatformCache file runsample keeps in a sample's working directory '''
+
 class NoPlatformFound(Exception):
     '''Exception when no platform can be found for a read'''
     pass
 
-def filter_reads_by_platform( path, platform ):
+class PlatformCache(object):
     '''
-    Filters all reads in path down to the ones that are for platform
+    Platforms found by platform_for_read that are kept in cachefile so the same read
+    files do not have to be opened and parsed again by every stage
 
-    @returns list of reads inside of path(basename)
+    Entries are stored as realpath: [size, mtime, platform] and are only used while
+    the file still has the same size and mtime. Keying on the real path lets the
+    links ngs_filter makes for reads it did not filter use the entries of the files
+    they point to. Files that have no platform are stored with a platform of null
+
+    :param str cachefile: Path to the file the platforms are kept in
+    '''
+    version = 1
+
+    def __init__( self, cachefile ):
+        self.cachefile = cachefile
+        self.entries = self.load()
+        self.changed = False
+
+    def load( self ):
+        ''' Entries from the cache file or none if it is missing or unreadable '''
+        try:
+            with open( self.cachefile ) as fh:
+                cache = json.load( fh )
+        except (IOError, ValueError):
+            return {}
+        if not isinstance( cache, dict ) or cache.get( 'version' ) != self.version:
+            return {}
+        return cache.get( 'files', {} )
+
+    def platform( self, filepath ):
+        '''
+        Same as platform_for_read but only reads filepath when it is not in the cache
+        or has changed since it was cached
+
+        :raises: NoPlatformFound, IOError
+        '''
+        key = realpath( filepath )
+        try:
+            st = os.stat( filepath )
+            stamp = [st.st_size, st.st_mtime]
+        except OSError:
+            stamp = None
+        entry = self.entries.get( key )
+        if stamp is not None and entry is not None and entry[:2] == stamp:
+            plat = entry[2]
+        else:
+            try:
+                plat = platform_for_read( filepath )
+            except NoPlatformFound:
+                plat = None
+            if stamp is not None:
+                self.entries[key] = stamp + [plat]
+                self.changed = True
+        if plat is None:
+            raise NoPlatformFound( "No platform found for {0}".format(filepath) )
+        return plat
+
+    def save( self ):
+        '''
+        Writes the cache file if anything changed, dropping entries for files that
+        no longer exist. Nothing is written if the cache file's directory is read only
+        '''
+        entries = dict( (k, v) for k, v in self.entries.items() if exists( k ) )
+        if not self.changed and len( entries ) == len( self.entries ):
+            return
+        cachedir = dirname( self.cachefile ) or '.'
+        try:
+            fd, tmp = tempfile.mkstemp( prefix='.' + basename( self.cachefile ), dir=cachedir )
+        except OSError as e:
+            logger.debug( "Not caching read platforms in {0}: {1}".format(self.cachefile, e) )
+            return
+        try:
+            with os.fdopen( fd, 'w' ) as fh:
+                json.dump( {'version': self.version, 'files': entries}, fh, sort_keys=True )
+            os.chmod( tmp, readable_mode() )
+            os.rename( tmp, self.cachefile )
+        except:
+            os.unlink( tmp )
+            raise
+
+def platforms_in_dir( path, cachefile=None ):
+    '''
+    Finds the platform of every read file in path in a single pass.
+    Files whose platform cannot be determined are skipped
+
+    If cachefile is given the platforms are looked up in and saved to a
+    PlatformCache kept there. Nothing is written otherwise
+
+    @returns a dictionary {'Platform': [reads for platform]} in the order they were found
     '''
-    # All files in path
-    files = []
+    if cachefile is not None:
+        cache = PlatformCache( cachefile )
+        classify = cache.platform
+    else:
+        cache = None
+        classify = platform_for_read
+    plat_files = {}
     for f in glob( join( path, '*' ) ):
         try:
-            pfr = platform_for_read( f )
+            pfr = classify( f )
         except NoPlatformFound as e:
             logger.warning(
                 "{0} was skipped as the platform cannot be determined".format(f)
@@ -103,9 +202,18 @@ def filter_reads_by_platform( path, platform ):
                 " It will be skipped.".format(e,f)
             )
             continue
-        if pfr == platform:
-            files.append( f )
-    return files
+        plat_files.setdefault( pfr, [] ).append( f )
+    if cache is not None:
+        cache.save()
+    return plat_files
+
+def filter_reads_by_platform( path, platform ):
+    '''
+    Filters all reads in path down to the ones that are for platform
+
+    @returns list of reads inside of path(basename)
+    '''
+    return platforms_in_dir( path ).get( platform, [] )
 
 def platform_for_read( filepath ):
     '''
@@ -131,7 +239,10 @@ def platform_for_read( filepath ):
         # First record in readfile
         try:
             logger.debug('Reading first read from {0}'.format(filepath))
-            first_record = next(SeqIO.parse(fh, ext))
+            if ext in ('fastq', 'fq'):
+                first_id = record_id(next(iter_fastq(fh)))
+            else:
+                first_id = next(SeqIO.parse(fh, ext)).id
         except StopIteration:
             logger.debug('It appears that {0} is empty'.format(filepath))
             raise NoPlatformFound("No platform found for empty read file {0}".format(filepath))
@@ -141,7 +252,7 @@ def platform_for_read( filepath ):
 
         # Find first platform that matches
         for p, plat in READ_ID_MAPPING:
-            if re.match(p, first_record.id):
+            if re.match(p, first_id):
                 return plat
         raise NoPlatformFound("No platform found for {0}".format(filepath))
     finally:
@@ -166,24 +277,27 @@ def is_sanger_readfile( filepath ):
     Inspect the top read in the file and see if the quality encoding
     max > 40
     '''
-    if not filepath.endswith( '.fastq' ):
+    if not filepath.endswith( '.fastq' ) and not filepath.endswith( '.fastq.gz' ):
         return False
 
-    reads = SeqIO.parse( filepath, 'fastq' )
-    r1 = next( reads )._per_letter_annotations['phred_quality']
+    qual = next( fastq_records( filepath ) )[3].rstrip( '\r\n' )
 
-    return max(r1) > 40
+    return max( bytearray( qual ) ) - 33 > 40
 
-def reads_by_plat( path ):
+def reads_by_plat( path, cachefile=None ):
     '''
     Returns a mapping of Platform => [reads for platform] for the given path
     If there are paired end read files they will be paired inside of a tuple in the list(MiSeq only now)
 
+    Every file is classified once(see platforms_in_dir) and cachefile is the
+    optional PlatformCache to use
+
     @returns a dictionary {'Platform': [reads for platform(basename)]
     '''
+    plat_files = platforms_in_dir( path, cachefile )
     reads_for_plat = {}
-    for platform in ('Roche454','IonTorrent','MiSeq', 'Sanger'):
-        reads = filter_reads_by_platform( path, platform )
+    for platform in PLATFORMS:
+        reads = plat_files.get( platform )
         # Don't add them if there were none
         if reads:
             reads_for_plat[platform] = pair_reads( reads )
@@ -194,93 +308,94 @@ def pair_reads( readlist ):
         Pairs paired-end read files inside of readlist into 2 item tuples
         Specific to MiSeq filenames at this point
 
+        Mates are looked up in a dictionary of read file paths so pairing takes
+        linear time no matter how many read files there are
+
         @param readlist - List of read file paths
 
         @returns the readlist with any reads that are paired end inside of a 2 item tuple with the first(forward) in [0]
             and the second(reverse) in [1]
     '''
     logger.debug("Attempting to pair readlist {0}".format(readlist))
+    # First index of every read file path
+    index_of = {}
+    for i, read in enumerate(readlist):
+        index_of.setdefault(read, i)
     paired_reads = []
-    skiplist = []
-    for i in range(len(readlist)):
-        logger.info("paired_reads: {0}".format(paired_reads))
-        logger.debug("i: {0}".format(i))
+    skiplist = set()
+    for read in readlist:
         # Don't do anything with reads that have been mated already
-        if not readlist[i] in skiplist:
-            # Is there a mate file?
-            index = find_mate( readlist[i], readlist )
-            logger.debug("Index in readlist for {0} is {1}".format(readlist[i],index))
-            # No mate found so just add it to list
-            if index == -1:
-                logger.debug("Index was -1 so appending readfile")
-                paired_reads.append(readlist[i])
-            else:
-                # Append mate pair
-                logger.debug("Appending mated pairs ({0},{1})".format(readlist[i],readlist[index]))
-                paired_reads.append( tuple(sorted([readlist[i],readlist[index]])) )
-                # Append mate to be skipped so we don't re-add it again
-                skiplist.append(readlist[index])
-                logger.debug("Mate list {0}".format(skiplist))
+        if read in skiplist:
+            continue
+        # Is there a mate file?
+        index = index_of.get(mate_name(read), -1)
+        # No mate found so just add it to list
+        if index == -1:
+            paired_reads.append(read)
         else:
-            logger.debug("Ignoring {0} because it has already been added to the mate list".format(readlist[i]))
+            # Append mate pair
+            logger.debug("Appending mated pairs ({0},{1})".format(read,readlist[index]))
+            paired_reads.append( tuple(sorted([read,readlist[index]])) )
+            # Append mate to be skipped so we don't re-add it again
+            skiplist.add(readlist[index])
     return paired_reads
 
+# Forward/Reverse part of a paired read file name
+MATE_PATTERN = re.compile('_R([12])_')
+
+def mate_name( filepath ):
+    '''
+        Name the mate file of filepath would have
+        Just looks for _R[12]_ and gives the identical filename but with the opposite of whatever R? is found
+
+        @param filepath - Path to a read file
+
+        @returns path of the mate for filepath or None if filepath is not a paired read file
+    '''
+    m = MATE_PATTERN.search( basename(filepath) )
+    if not m:
+        return None
+    found_r = m.group(1)
+    # Look for opposite index
+    mate_r = '2' if found_r == '1' else '1'
+    return filepath.replace(
+        '_R{0}_'.format(found_r),
+        '_R{0}_'.format(mate_r)
+    )
+
 def find_mate( filepath, readlist ):
     '''
         Finds the index of the mate file for filepath given a readlist
-        Just looks for _R[12]_ and looks for identical filename but with the opposite of whatever R? is found
+        See mate_name for how the mate is named
 
         @param filepath - Path to a read file
         @param readlist - List of paths to reads
 
         @returns the index in readlist for the mate for filepath or -1 if none are found
     '''
-    #cp = re.compile( '(?P<samplename>\S+?)_S\d+_L\d{3}_(?P<fr>R\d)_\d{3}_\d{4}_\d{2}_\d{2}.fastq' )
-    cp = re.compile('_R([12])_')
-    m = cp.search( basename(filepath) )
-    if not m:
+    matefn = mate_name( filepath )
+    if matefn is None:
         logger.debug( "Cannot find _R1_ or _R2_ in {0}".format(
             filepath
         ))
         return -1
-    else:
-        found_r = m.group(1)
-
-        # Look for opposite index
-        if found_r == '1':
-            mate_r = '2'
-        elif found_r == '2':
-            mate_r = '1'
-        else:
-            logger.warning('Found {0} instead of 1 or 2 in {1}'.format(found_r, filepath))
-            return -1
-
-        matefn = filepath.replace(
-            '_R{0}_'.format(found_r),
-            '_R{0}_'.format(mate_r)
-        )
-        logger.debug('{0} found in {1} and will search for {2}'.format(found_r, filepath, matefn))
-        try:
-            return readlist.index(matefn)
-        except ValueError as e:
-            logger.debug( "Could not find mate in {0} for {1}".format(
-                readlist, filepath
-            ))
-            return -1
-
-
+    logger.debug('Searching for {0} as the mate of {1}'.format(matefn, filepath))
+    try:
+        return readlist.index(matefn)
+    except ValueError as e:
+        logger.debug( "Could not find mate in {0} for {1}".format(
+            readlist, filepath
+        ))
+        return -1
 
 def fastas_to_40s_fastqs(outdir, fastas):
-    def to_fq_rec(seq):
-        s = str(seq.seq)
-        qual = ']'*len(s)
-        id = str(seq.id)
-        return "@{}\n{}\n{}\n{}\n".format(id, s, '+', qual)
+    def to_fq_rec(id, seq):
+        return ('@' + id + '\n', seq + '\n', '+\n', ']'*len(seq) + '\n')
     swap_ext = lambda s, ext: '.'.join(s.split('.')[:-1] + [ext])
     for f in fastas:
         outname = join(outdir, basename(swap_ext(f, 'fastq')))
-        with open(outname, 'w') as out:
-            for seq in SeqIO.parse(f, 'fasta'):
-                out.write(to_fq_rec(seq))
+        with open(outname, 'w') as out, FastqWriter(out) as writer:
+            for id, seq in fasta_records(f):
+                writer.write(to_fq_rec(id, seq))
 
 
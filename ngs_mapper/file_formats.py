@@ -1,5 +1,6 @@
 from ngs_mapper.reads import sffs_to_fastq
 import os, sys
+import shutil
 from functools import partial
 from glob import glob
 import gzip
@@ -24,11 +25,7 @@ def convert_sff(dir, outdir):
     outnames = map(swap_dir(outdir), outnames)
     def wrapped_conv(a, b):
         logger.info('Converting {0} to {1}'.format(a, b))
-        n = 0
-        try:
-            n=sffs_to_fastq([a], b, trim=True)
-        except AssertionError as e:
-            pass
+        n=sffs_to_fastq([a], b, trim=True)
         logger.info("{0} reads converted".format(n))
         return n
     return sum(map(wrapped_conv, sff_paths, outnames))
@@ -41,18 +38,27 @@ def convert_ab1(dir, outdir):
         SeqIO.convert(abi, 'abi', dest, 'fastq')
 
 def convert_gzips(dir, outdir):
+    '''
+    Compressed fastq files are linked into outdir as they are since every stage
+    after this reads them directly. Any other .gz file is unpacked into outdir
+    '''
     for gz in find_ext('gz')(dir):
+        if gz.endswith('.fastq.gz'):
+            dest = swap_dir(outdir)(gz)
+            logger.debug('Symlinking {0} to {1}'.format(gz, dest))
+            os.symlink(os.path.abspath(gz), os.path.abspath(dest))
+            continue
         dest = swap_dir(outdir)(drop_ext(gz))
         with gzip.open( gz, 'rb' ) as input:
-            with open(dest, 'w') as output:
+            with open(dest, 'wb') as output:
                 logger.info('Unpacking {0} to {1}'.format(gz, dest))
-                output.write(input.read())
+                shutil.copyfileobj(input, output, 1048576)
 def link_fastqs(dir, outdir): 
     for fq in find_ext('fastq')(dir):
         dest = swap_dir(outdir)(fq)
         src = os.path.abspath(fq)
         dst = os.path.abspath(dest)
-        if os.path.exists(dst):
+        if os.path.exists(dst) or os.path.exists(dst + '.gz'):
             logger.warning(
                 'Skipping symlink of {0} because {1} already exists.' \
                 'This can happen if you have the file compressed and also not ' \
@@ -0,0 +1,133 @@
+'''
+Produces the same counts and output as samtools flagstat(0.1.19) by reading the
+flags of every read in-process through pysam
+
+If pysam is not installed samtools flagstat is run instead
+'''
+import logging
+from subprocess import Popen, PIPE
+
+import numpy as np
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+log = logging.getLogger(__name__)
+
+# SAM flag bits
+PAIRED = 0x1
+PROPER_PAIR = 0x2
+UNMAPPED = 0x4
+MATE_UNMAPPED = 0x8
+READ1 = 0x40
+READ2 = 0x80
+QCFAIL = 0x200
+DUPLICATE = 0x400
+
+# Every count kept for QC-passed and QC-failed reads in the order samtools
+# flagstat reports them
+FIELDS = [
+    'total', 'duplicates', 'mapped', 'paired', 'read1', 'read2', 'properpair',
+    'mated', 'singletons', 'diffchr', 'diffchrhigh'
+]
+
+def count_flags( reads ):
+    '''
+    Counts reads the same way samtools flagstat does
+
+    :param iterable reads: (flag, tid, mtid, mapq) for every read
+    :return: dictionary of FIELDS each with [QC-passed count, QC-failed count]
+    '''
+    counts = dict((f, [0, 0]) for f in FIELDS)
+    for flag, tid, mtid, mapq in reads:
+        w = 1 if flag & QCFAIL else 0
+        counts['total'][w] += 1
+        if flag & PAIRED:
+            counts['paired'][w] += 1
+            if flag & PROPER_PAIR:
+                counts['properpair'][w] += 1
+            if flag & READ1:
+                counts['read1'][w] += 1
+            if flag & READ2:
+                counts['read2'][w] += 1
+            if flag & MATE_UNMAPPED and not flag & UNMAPPED:
+                counts['singletons'][w] += 1
+            if not flag & UNMAPPED and not flag & MATE_UNMAPPED:
+                counts['mated'][w] += 1
+                if mtid != tid:
+                    counts['diffchr'][w] += 1
+                    if mapq >= 5:
+                        counts['diffchrhigh'][w] += 1
+        if not flag & UNMAPPED:
+            counts['mapped'][w] += 1
+        if flag & DUPLICATE:
+            counts['duplicates'][w] += 1
+    return counts
+
+def pct( count, total ):
+    '''
+    Formats count/total as a percentage just like samtools which does the
+    division with C floats(0/0 is -nan)
+    '''
+    if total == 0:
+        return '-nan' if count == 0 else 'inf'
+    return '{0:.2f}'.format(float(np.float32(count) / np.float32(total)) * 100.0)
+
+def format_flagstats( counts ):
+    '''
+    Formats counts from count_flags exactly like samtools flagstat output
+
+    :param dict counts: count_flags output
+    :return: flagstat text
+    '''
+    c = counts
+    def line( field, desc ):
+        return '{0} + {1} {2}\n'.format(c[field][0], c[field][1], desc)
+    def pctline( field, of, desc ):
+        return '{0} + {1} {2} ({3}%:{4}%)\n'.format(
+            c[field][0], c[field][1], desc,
+            pct(c[field][0], c[of][0]), pct(c[field][1], c[of][1])
+        )
+    return ''.join([
+        line('total', 'in total (QC-passed reads + QC-failed reads)'),
+        line('duplicates', 'duplicates'),
+        pctline('mapped', 'total', 'mapped'),
+        line('paired', 'paired in sequencing'),
+        line('read1', 'read1'),
+        line('read2', 'read2'),
+        pctline('properpair', 'paired', 'properly paired'),
+        line('mated', 'with itself and mate mapped'),
+        pctline('singletons', 'paired', 'singletons'),
+        line('diffchr', 'with mate mapped to a different chr'),
+        line('diffchrhigh', 'with mate mapped to a different chr (mapQ>=5)'),
+    ])
+
+def read_flags( bamfile ):
+    '''
+    Generates (flag, tid, mtid, mapq) for every read in bamfile(including unmapped)
+
+    :param str bamfile: Path to bam file(does not need to be indexed)
+    '''
+    bam = pysam.AlignmentFile(bamfile, 'rb', check_sq=False)
+    try:
+        for read in bam.fetch(until_eof=True):
+            yield (read.flag, read.reference_id, read.next_reference_id, read.mapping_quality)
+    finally:
+        bam.close()
+
+def flagstats( bamfile ):
+    '''
+    Same output as samtools flagstat for bamfile
+
+    :param str bamfile: Path to bam file
+    :return: flagstat text
+    '''
+    if pysam is not None:
+        log.debug("Counting flags for {0} in-process".format(bamfile))
+        return format_flagstats(count_flags(read_flags(bamfile)))
+    log.debug("Counting flags for {0} with samtools flagstat".format(bamfile))
+    p = Popen(['samtools', 'flagstat', bamfile], stdout=PIPE)
+    sout, _ = p.communicate()
+    return sout
@@ -1,19 +1,19 @@
 import argparse
 from collections import defaultdict
 import sys
-from Bio.SeqIO import parse
+from ngs_mapper.reads import fastq_records
 import matplotlib.pyplot as plt
 from os.path import *
 import numpy as np
 
 def main():
     args = parse_args()
-    fqs = [(basename(fq),parse( fq, 'fastq' )) for fq in args.fastqs]
+    fqs = [(basename(fq),fastq_records( fq )) for fq in args.fastqs]
     plot_fqs( fqs, args.output )
 
 def plot_fqs( iterable, out ):
     '''
-        @param iterable - list of SeqRecord iterables(probably from Bio.SeqIO.parse)
+        @param iterable - list of (name, fastq record iterable) from ngs_mapper.reads.fastq_records
         @param out - Output path of png
     '''
     # How many rows
@@ -61,8 +61,8 @@ def plot_fqs( iterable, out ):
 
 def fqstats( seqrecs ):
     '''
-        Generates fqstats for a given iterator of SeqRecord objects
-        @param seqrecs - Iterable of Bio.SeqRecord.SeqRecord's
+        Generates fqstats for a given iterator of fastq records
+        @param seqrecs - Iterable of (header, seq, plus, qual) from ngs_mapper.reads.fastq_records
         @returns tuple of
         - ReadLength bins
         - AvgQuality bins
@@ -85,17 +85,18 @@ def fqstats( seqrecs ):
     return (rlb, aqb, maxreadlen, maxaqual, maxreads, maxquals)
 
 def fqstat( rec ):
-    seqlen = len( rec.seq._data )
+    seqlen = len( rec[1].rstrip( '\r\n' ) )
     aqual = read_avg_qual( rec )
     return (seqlen,aqual)
 
 def read_avg_qual( rec ):
     '''
-        Return the average quality of the qualities of given SeqRec object
+        Return the average quality of the qualities of given fastq record
+        by summing the bytes of its quality line
     '''
-    quals = rec._per_letter_annotations['phred_quality']
+    quals = rec[3].rstrip( '\r\n' )
     if quals:
-        avg = float(sum( quals )) / len( quals )
+        avg = float(sum( bytearray( quals ) ) - 33 * len( quals )) / len( quals )
         return round( avg )
     else:
         return 0
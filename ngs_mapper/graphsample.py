@@ -5,7 +5,7 @@ import subprocess
 import argparse
 
 import bqd, graph_qualdepth as qd
-import samtools
+import pileup
 from bam_to_qualdepth import set_unmapped_mapped_reads
 import json
 import log
@@ -23,8 +23,8 @@ def main():
     pngfile = make_image( jfile, args.outpath )
 
 def make_json( bamfile, outpathprefix ):
-    pileup = samtools.nogap_mpileup(bamfile)
-    stats = bqd.parse_pileup( pileup )
+    columns = pileup.gap_columns(bamfile)
+    stats = bqd.parse_pileup( columns )
     set_unmapped_mapped_reads( bamfile, stats )
     outfile = outpathprefix + '.qualdepth.json'
     with open( outfile, 'w' ) as fh:
@@ -1,11 +1,13 @@
 '''
-Usage: ngs_filter <readdir> [--threads=<threads>]  [--drop-ns ] [--index-min=<index_min>] [--platforms <PLATFORMS>] [--outdir <DIR>] [--config <CONFIG>]
+Usage: ngs_filter <readdir> [--threads=<threads>]  [--drop-ns ] [--index-min=<index_min>] [--platforms <PLATFORMS>] [--outdir <DIR>] [--compress] [--config <CONFIG>] [--platform-cache <FILE>]
 
 Options:
     --outdir=<DIR>,-o=<DIR>   outupt directory [Default: filtered]
     --config=<CONFIG>,-c=<CONFIG>  Derive options from provided YAML file instead of commandline
-    --threads=<threads>            Number of files to filter in parallel. [Default: 1]
+    --threads=<threads>            Number of files or chunks of large files to filter in parallel. [Default: 1]
     --platforms=<PLATFORMS>   Only accept reads from specified machines. Choices: 'Roche454','IonTorrent','MiSeq', 'Sanger', 'All', [Default: All]
+    --compress                Write filtered reads as .fastq.gz files. Compressed input is always read directly.
+    --platform-cache=<FILE>   File to remember the platform of every read file in so later stages do not have to read them again
 
 Help:
     If an argument is not given for a parameter, that filter is not applied. If no filter parameters are provided, an error is raised.
@@ -15,22 +17,34 @@ Help:
 from functools import partial
 import multiprocessing
 from operator import methodcaller
-from Bio import SeqIO
 from docopt import docopt
 from schema import Schema, Use, Optional, Or
-from itertools import ifilterfalse, izip, chain, izip_longest
+from itertools import ifilterfalse, izip, chain, izip_longest, islice
 import re
 import os
+import shutil
 import sys
+import time
+import json
+import tempfile
 import warnings
 from data import reads_by_plat
 from ngs_mapper.config import load_config
+from ngs_mapper.reads import fastq_records, iter_fastq, min_qual, FastqWriter, \
+    open_input, open_output, is_gzip, gzip_name
 import log
 logger = log.setup_logger(__name__, log.get_config())
 
 ALLPLATFORMS = 'Roche454','IonTorrent','MiSeq', 'Sanger'
 #TODO: should guarantee that there is an index file or allow there not to be one
 STATSFILE_NAME='ngs_filter_stats.txt'
+# Structured versions of the stats file with one entry per read file
+STATSJSON_NAME='ngs_filter_stats.json'
+STATSTSV_NAME='ngs_filter_stats.tsv'
+STATS_FIELDS = ('file', 'output', 'total', 'bad_index', 'has_n', 'written', 'bytes',
+                'bytes_written', 'seconds', 'reads_per_second', 'mb_per_second')
+# Fewest reads worth handing to a worker when a file is split into chunks
+MIN_CHUNK_READS = 50000
 stat_header = '''ngs_filter found {0} reads in file {1}, and filtered out {2} reads.'''
 stat_body = '''In file {0}, {1} reads were filtered for poor quality index below {2}. {3} reads had Ns and were filtered.'''
 
@@ -40,14 +54,15 @@ stat_body = '''In file {0}, {1} reads were filtered for poor quality index below
 
 get_index = partial(re.sub, r'_R([12])_', r'_I\1_')
 
-is_fastq = methodcaller('endswith', ('fq', 'fastq'))
-def name_filtered(path, outdir):
-    ''' rename with 'fitered.' prefix and inside the new path directory. '''
+is_fastq = methodcaller('endswith', ('fq', 'fastq', 'fq.gz', 'fastq.gz'))
+def name_filtered(path, outdir, compress=False):
+    ''' rename with 'fitered.' prefix and inside the new path directory.
+    the new path ends with .gz only if compress is True. '''
     #rename = "filtered.{0}".format
-    dirpath, filename = os.path.split(path)
+    dirpath, filename = os.path.split(gzip_name(path, False))
     #renamed = rename(filename)
     renamed = filename[:-3] + 'fastq' if filename.endswith('sff') else filename
-    return os.path.join(outdir, renamed)
+    return gzip_name(os.path.join(outdir, renamed), compress)
 
 def has_index(fn):
     ''' returns index path (ie _I1_ or _I2_)  or none.'''
@@ -71,11 +86,12 @@ def flatten(container):
                 yield j
         else:
             yield i
-def map_to_dir(readsdir, idxQualMin, dropNs, platforms, outdir, threads):
+def map_to_dir(readsdir, idxQualMin, dropNs, platforms, outdir, threads, compress=False, platform_cache=None):
     '''maps *func* to all fastq/sff files which are not indexes.
-    fetch the fastqs and indexes of the directory and write the filtered results.'''
+    fetch the fastqs and indexes of the directory and write the filtered results.
+    platform_cache is the optional data.PlatformCache file to look platforms up in.'''
     #no_index_fqs = fqs_excluding_indices(readsdir)
-    plat_files_dict = reads_by_plat(readsdir)
+    plat_files_dict = reads_by_plat(readsdir, platform_cache)
     #_nested_files = map(plat_files_dict.get, platforms)
     _nested_files = filter(None, map(plat_files_dict.get, platforms))
     if not _nested_files:
@@ -108,16 +124,20 @@ def map_to_dir(readsdir, idxQualMin, dropNs, platforms, outdir, threads):
         "Using {0} threads to map filters over read files {1} in directory {2}"
         .format(threads, files, readsdir)
     )
-    func = partial(write_filtered, idxQualMin=idxQualMin, dropNs=dropNs, outdir=outdir)
     pool = multiprocessing.Pool(threads)
-    outpaths = pool.map(func, files)
+    if threads > 1 and (idxQualMin or dropNs):
+        stats = write_chunked(pool, files, idxQualMin, dropNs, outdir, threads, compress)
+    else:
+        func = partial(write_filtered, idxQualMin=idxQualMin, dropNs=dropNs, outdir=outdir, compress=compress)
+        stats = pool.map(func, files)
     pool.close()
     pool.join()
-    return outpaths
+    write_summary(stats, idxQualMin, outdir)
+    return [stat['output'] for stat in stats]
 
 def idx_filter(read, idxread, thresh):
     ''' AT or ABOVE threshold.'''
-    return min(idxread._per_letter_annotations['phred_quality']) >= thresh
+    return min_qual(idxread[3]) >= thresh
 formats={ 'sff' : 'sff', 'fq' : 'fastq', 'fastq' : 'fastq', 'fa' : 'fasta', 'fasta' : 'fasta' }
 extension = lambda s: s.split('.')[-1]
 compose = lambda f, g: lambda x: f(g(x))
@@ -126,77 +146,233 @@ getformat = compose(formats.__getitem__, extension)
 def make_filtered(readpath, idxQualMin, dropNs):
     ''' given a fastq file with an index, will filter on low-quality index entries, and drop all reads with N.
     If file does not have an index, only drops Ns.
-    Raises an AssertionError if the index-quality filter drops all reads. '''
+    Reads are raw fastq records from reads.fastq_records. '''
     index = has_index(readpath)
     if idxQualMin and not index:
         sys.stderr.write("Specified Non-null index quality minimum, but index for file {0} does not exist.\n".format(readpath))
-    #NOTE: this will fail if the reads have an index stored in a different format (ie reads in FASTA, index in FASTQ) but that should never happen
-    format = getformat(readpath)
-    # right now this silently skips
-    fq_open = partial(SeqIO.parse, format=format)
-    def filterReads(readsWithMaybeIndex):
-        total = badIndex = hadNCount = 0
-        read, idxRead = None, None
-        for read, idxRead in readsWithMaybeIndex:
-            indexIsBad = False
-            if idxRead:
-                indexIsBad = min(idxRead._per_letter_annotations['phred_quality']) < idxQualMin
-                badIndex += int(indexIsBad)
-            hasN = False
-            if dropNs:
-                hasN = 'N' in str(read.seq).upper()
-                hadNCount += int(hasN)
-            dropRead = hasN or indexIsBad
-            total += 1
-            if dropRead:
-                read = None
-            yield (total, badIndex, hadNCount, read)
-    try:
-        indexReads = [] if not index else fq_open(index)
-        reads = fq_open(readpath)
-    except AssertionError, E:
-        logger.debug("skipping biopython assertion error in file %s " % readpath)
+    indexReads = [] if not index else fastq_records(index)
+    reads = fastq_records(readpath)
     readsWithMaybeIndex = izip_longest(reads, indexReads, fillvalue=None)
-    return filterReads(readsWithMaybeIndex)
+    return filter_reads(readsWithMaybeIndex, idxQualMin, dropNs)
+
+def filter_reads(readsWithMaybeIndex, idxQualMin, dropNs):
+    ''' yields (total, badIndex, hadNCount, read) for every (read, idxRead) pair of fastq
+    records from reads.iter_fastq where read is None if it was filtered out and the counts
+    are running totals. Only the raw quality and sequence lines are looked at. '''
+    total = badIndex = hadNCount = 0
+    for read, idxRead in readsWithMaybeIndex:
+        indexIsBad = False
+        if idxRead:
+            indexIsBad = min_qual(idxRead[3]) < idxQualMin
+            badIndex += int(indexIsBad)
+        hasN = False
+        if dropNs:
+            hasN = 'N' in read[1] or 'n' in read[1]
+            hadNCount += int(hasN)
+        dropRead = hasN or indexIsBad
+        total += 1
+        if dropRead:
+            read = None
+        yield (total, badIndex, hadNCount, read)
 
-def write_filtered(readpath, idxQualMin, dropNs, outdir='.'):
-    '''write the results to the new directory.
-    Also writes a stats file to outdir/ngs_filter_stats.txt, with basic information about how many reads were filtered.'''
+def write_filtered(readpath, idxQualMin, dropNs, outdir='.', compress=False):
+    '''write the results to the new directory. readpath can be compressed and the results are
+    compressed if compress is True. Unfiltered files are linked as they are.
+    Returns the stats for readpath from filter_stats so the caller can write them with write_summary.
+    Counts are None if nothing was filtered and readpath was only linked to the new directory.'''
+    start = time.time()
     results = make_filtered(readpath, idxQualMin, dropNs)
-    outpath = name_filtered(readpath, outdir)
+    outpath = name_filtered(readpath, outdir, compress)
     if not idxQualMin and not dropNs:
+        outpath = name_filtered(readpath, outdir, is_gzip(readpath))
         os.symlink(os.path.abspath(readpath), os.path.abspath(outpath))
         logger.warn("Index Quality was %s and dropNs was set to %s, so file %s was copied to %s without filtering" % (idxQualMin, dropNs, readpath, outpath))
-        return outpath
+        return filter_stats(readpath, outpath, None, None, None, None, time.time() - start)
+    total = badIndex = hadN = 0
+    with open_output(outpath) as outfile, FastqWriter(outfile) as writer:
+        for total, badIndex, hadN, read in results:
+            if read:
+                writer.write(read)
+    num_written = writer.written
+    logger.info("filtered reads from %s will be written to %s" % (readpath, outpath))
+    logger.info("%s reads left after filtering." % num_written)
+    if  num_written <= 0:
+        logger.warn("No reads left after filtering! Quality controls eliminated all reads. Drop-Ns was set to %s; maybe try again with lower quality min than %s. " %(dropNs, idxQualMin))
+        warnings.warn("No reads left after filtering! Quality controls eliminated all reads. Drop-Ns was set to %s; maybe try again with lower quality min than %s. " %(dropNs, idxQualMin))
+    return filter_stats(readpath, outpath, total, badIndex, hadN, num_written, time.time() - start)
+
+def filter_stats(readpath, outpath, total, badIndex, hadN, written, seconds):
+    ''' stats dictionary with STATS_FIELDS keys for filtering readpath into outpath '''
+    nbytes = os.path.getsize(readpath)
+    stats = {
+        'file': readpath, 'output': outpath, 'total': total, 'bad_index': badIndex,
+        'has_n': hadN, 'written': written, 'bytes': nbytes,
+        'bytes_written': os.path.getsize(outpath) if written is not None else None,
+        'seconds': round(seconds, 3), 'reads_per_second': None, 'mb_per_second': None
+    }
+    if seconds > 0 and total is not None:
+        stats['reads_per_second'] = round(total / seconds, 1)
+        stats['mb_per_second'] = round(nbytes / seconds / 1048576, 3)
+    return stats
+
+def atomic_write(path, data):
+    ''' write data to a temporary file next to path and rename it over path
+    so path is either the old file or completely written '''
+    fd, tmppath = tempfile.mkstemp(prefix='.' + os.path.basename(path), dir=os.path.dirname(path) or '.')
     try:
-        num_written = 0
-        with open(outpath, 'w') as outfile:
-            for total, badIndex, hadN, read in results:
-                if read:
-                    SeqIO.write(read, outfile, 'fastq')
-                    num_written += 1
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(data)
+        os.chmod(tmppath, 0644)
+        os.rename(tmppath, path)
+    except:
+        os.unlink(tmppath)
+        raise
+
+def write_summary(stats, idxQualMin, outdir):
+    ''' write the stats of every filtered file to outdir as ngs_filter_stats.txt and the
+    structured ngs_filter_stats.json and ngs_filter_stats.tsv. Only the parent process
+    writes them so entries from different workers never interleave. '''
+    msgs = []
+    for stat in stats:
+        if stat['total'] is None:
+            continue
+        msgs.append('\n'.join( [stat_header.format(stat['total'], stat['file'], stat['bad_index'] + stat['has_n']),
+                                stat_body.format(stat['file'], stat['bad_index'], idxQualMin, stat['has_n']) ]))
+    atomic_write(os.path.join(outdir, STATSFILE_NAME), '\n'.join(msgs))
+    atomic_write(os.path.join(outdir, STATSJSON_NAME), json.dumps(stats, indent=4, sort_keys=True))
+    rows = ['\t'.join(STATS_FIELDS)]
+    for stat in stats:
+        rows.append('\t'.join(['' if stat[f] is None else str(stat[f]) for f in STATS_FIELDS]))
+    atomic_write(os.path.join(outdir, STATSTSV_NAME), '\n'.join(rows) + '\n')
+
+def count_lines(path, blocksize=1048576):
+    ''' number of lines in path including a last line without a newline '''
+    lines = 0
+    last = '\n'
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), ''):
+            lines += block.count('\n')
+            last = block[-1]
+    return lines + int(last != '\n')
+
+def line_offsets(path, linenums, blocksize=1048576):
+    ''' byte offset of the start of each of the sorted 0 based linenums in path '''
+    offsets = []
+    wanted = iter(linenums)
+    target = next(wanted, None)
+    line = pos = 0
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), ''):
+            start = 0
+            while target is not None:
+                if target == line:
+                    offsets.append(pos + start)
+                    target = next(wanted, None)
+                    continue
+                nl = block.find('\n', start)
+                if nl == -1:
+                    break
+                start = nl + 1
+                line += 1
+            pos += len(block)
+    return offsets
+
+def plan_chunks(readpath, nchunks, minreads=None):
+    ''' splits readpath and its index into at most nchunks record ranges.
+    Returns a list of (readoffset, indexoffset, count) where indexoffset is None if there
+    is no index and count is the number of records in the chunk(None means the rest of the file).
+    Chunks are only made for uncompressed 4 line fastq files whose index has the same number of records
+    so every chunk sees exactly the same reads and index reads as filtering the whole file would. '''
+    if minreads is None:
+        minreads = MIN_CHUNK_READS
+    index = has_index(readpath)
+    whole = [(0, 0 if index else None, None)]
+    if is_gzip(readpath) or (index and is_gzip(index)):
+        return whole
+    lines = count_lines(readpath)
+    if lines % 4 or (index and count_lines(index) != lines):
+        return whole
+    records = lines // 4
+    perchunk = max(-(-records // nchunks), minreads, 1)
+    if perchunk >= records:
+        return whole
+    starts = range(0, records, perchunk)
+    counts = [min(perchunk, records - start) for start in starts]
+    startlines = [start * 4 for start in starts]
+    readoffsets = line_offsets(readpath, startlines)
+    indexoffsets = line_offsets(index, startlines) if index else [None] * len(starts)
+    return zip(readoffsets, indexoffsets, counts)
+
+def fastq_range(path, offset, count):
+    ''' fastq records for count records of the fastq path starting at byte offset '''
+    with open_input(path) as fh:
+        fh.seek(offset)
+        for record in islice(iter_fastq(fh), count):
+            yield record
+
+def filter_chunk(task):
+    ''' filter one chunk planned by plan_chunks and write the reads that pass to chunkpath.
+    task is (readpath, (readoffset, indexoffset, count), idxQualMin, dropNs, chunkpath).
+    Returns (total, badIndex, hadN, num_written, seconds) for the chunk. '''
+    start = time.time()
+    readpath, (readoffset, indexoffset, count), idxQualMin, dropNs, chunkpath = task
+    reads = fastq_range(readpath, readoffset, count)
+    indexReads = [] if indexoffset is None else fastq_range(has_index(readpath), indexoffset, count)
+    readsWithMaybeIndex = izip_longest(reads, indexReads, fillvalue=None)
+    total = badIndex = hadN = 0
+    with open_output(chunkpath) as outfile, FastqWriter(outfile) as writer:
+        for total, badIndex, hadN, read in filter_reads(readsWithMaybeIndex, idxQualMin, dropNs):
+            if read:
+                writer.write(read)
+    return total, badIndex, hadN, writer.written, time.time() - start
+
+def write_chunked(pool, files, idxQualMin, dropNs, outdir, threads, compress=False):
+    '''same as mapping write_filtered over files with pool except every file is split into up to
+    threads chunks that are filtered in parallel and then joined back together in order
+    so the output and stats are identical to filtering each file in one piece.
+    When compress is True every chunk is compressed by its worker and the compressed chunks
+    are joined into one .gz file so compression is done in parallel too.
+    Returns the stats from filter_stats for every file where seconds is the time spent
+    by all workers on the file.'''
+    tasks = []
+    for readpath in files:
+        if idxQualMin and not has_index(readpath):
+            sys.stderr.write("Specified Non-null index quality minimum, but index for file {0} does not exist.\n".format(readpath))
+        chunkdir, outname = os.path.split(name_filtered(readpath, outdir, compress))
+        for i, chunk in enumerate(plan_chunks(readpath, threads)):
+            chunkpath = os.path.join(chunkdir, '.chunk{0}.{1}'.format(i, outname))
+            tasks.append((readpath, chunk, idxQualMin, dropNs, chunkpath))
+    logger.debug("Filtering {0} files in {1} chunks".format(len(files), len(tasks)))
+    results = pool.map(filter_chunk, tasks)
+    stats = []
+    for readpath in files:
+        outpath = name_filtered(readpath, outdir, compress)
+        chunks = [(task[-1], counts) for task, counts in zip(tasks, results) if task[0] == readpath]
+        with open(outpath, 'wb') as outfile:
+            for chunkpath, counts in chunks:
+                with open(chunkpath, 'rb') as chunkfile:
+                    shutil.copyfileobj(chunkfile, outfile)
+                os.unlink(chunkpath)
+        total, badIndex, hadN, num_written, seconds = map(sum, zip(*[counts for chunkpath, counts in chunks]))
         logger.info("filtered reads from %s will be written to %s" % (readpath, outpath))
         logger.info("%s reads left after filtering." % num_written)
         if  num_written <= 0:
             logger.warn("No reads left after filtering! Quality controls eliminated all reads. Drop-Ns was set to %s; maybe try again with lower quality min than %s. " %(dropNs, idxQualMin))
             warnings.warn("No reads left after filtering! Quality controls eliminated all reads. Drop-Ns was set to %s; maybe try again with lower quality min than %s. " %(dropNs, idxQualMin))
-    except AssertionError, E:
-        logger.debug("skipping biopython assertion error")
-        #sys.stderr.write(str(E))
-    msg = '\n'.join( [stat_header.format(total, readpath, badIndex + hadN),
-                      stat_body.format(readpath, badIndex, idxQualMin, hadN) ])
-    with open(os.path.join(outdir, STATSFILE_NAME), 'a') as statfile:
-        statfile.write(msg)
-    return outpath
-
-def write_groups(paths, idxQualMin, dropNs, outdir):
-     func = partial(write_filtered, idxQualMin=idxQualMin, dropNs=dropNs, outdir=outdir)
-     return map(func, paths)
-
-def write_post_filter(readsdir, idxQualMin, dropNs, platforms, outdir=None, threads=1):
+        stats.append(filter_stats(readpath, outpath, total, badIndex, hadN, num_written, seconds))
+    return stats
+
+def write_groups(paths, idxQualMin, dropNs, outdir, compress=False):
+     func = partial(write_filtered, idxQualMin=idxQualMin, dropNs=dropNs, outdir=outdir, compress=compress)
+     stats = map(func, paths)
+     write_summary(stats, idxQualMin, outdir)
+     return [stat['output'] for stat in stats]
+
+def write_post_filter(readsdir, idxQualMin, dropNs, platforms, outdir=None, threads=1, compress=False, platform_cache=None):
     '''execute write_filtered on the whole directory'''
     return map_to_dir(readsdir, idxQualMin=idxQualMin, dropNs=dropNs,
-                      platforms=platforms, outdir=outdir, threads=threads)#, parallel=parallel)
+                      platforms=platforms, outdir=outdir, threads=threads, compress=compress,
+                      platform_cache=platform_cache)#, parallel=parallel)
 
 def mkdir_p(dir):
     ''' emulate bash command  $ mkdir -p '''
@@ -208,12 +384,13 @@ def picked_platforms(rawarg):
     return [ p for p in ALLPLATFORMS if p.lower() in rawarg.lower()]
 
 
-def run_from_config(readsdir, outdir, config_path):
+def run_from_config(readsdir, outdir, config_path, platform_cache=None):
     _config = load_config(config_path)
     defaults = _config['ngs_filter']
     return write_post_filter(readsdir, defaults['indexQualityMin']['default'],
                              defaults['dropNs']['default'], defaults['platforms']['default'],
-                             outdir, defaults['threads']['default'])
+                             outdir, defaults['threads']['default'], defaults['compress']['default'],
+                             platform_cache)
 
 def main():
     scheme = Schema(
@@ -223,6 +400,8 @@ def main():
          Optional('--index-min') : Use(lambda x: int(x) if x else x, error="--index-min expects an integer"),
          Optional('--platforms') : Use(picked_platforms),
          Optional('--config') : Or(str, lambda x: x is None),
+         Optional('--compress') : bool,
+         Optional('--platform-cache') : Or(str, lambda x: x is None),
          '--outdir' : str
          })
 
@@ -230,10 +409,11 @@ def main():
     args = scheme.validate(raw_args)
     mkdir_p(args['--outdir'])
     if args['--config']:
-        run_from_config(args['<readdir>'], args['--outdir'], args['--config'])
+        run_from_config(args['<readdir>'], args['--outdir'], args['--config'], args['--platform-cache'])
         return 0
     dropNs, idxMin = args['--drop-ns'], args['--index-min']
     minmin, minmax = 0, 50
     outpaths = write_post_filter(args['<readdir>'], idxMin, dropNs,
-                                 args['--platforms'], args['--outdir'], args['--threads'])
+                                 args['--platforms'], args['--outdir'], args['--threads'], args['--compress'],
+                                 args['--platform-cache'])
     return 0
@@ -0,0 +1,198 @@
+'''
+In-process pileup engine
+
+Reads indexed BAM files directly through htslib(via pysam) and yields pileup
+columns that behave just like :py:class:`ngs_mapper.samtools.MPileupColumn` without
+having to run samtools mpileup and parse its text output.
+
+If pysam is not installed or the bam file is not indexed, the samtools mpileup
+subprocess is used instead so the same columns are always produced.
+'''
+import itertools
+import logging
+from os.path import exists
+
+from ngs_mapper import samtools
+from ngs_mapper.samtools import MPileupColumn, PileupGap, parse_regionstring
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+log = logging.getLogger(__name__)
+
+# samtools mpileup caps quality characters at ~ which is phred 93
+MAX_QUAL = 93
+
+class PileupColumn(MPileupColumn):
+    '''
+    A pileup column that is built from already decoded bases and qualities instead
+    of an mpileup string
+
+    Since there is no reference given to the pileup, refbase is always N just like
+    samtools mpileup output without -f
+
+    :param str ref: Reference name
+    :param int pos: Reference position(1 based)
+    :param str bases: Upper case bases for every read in the column(* is a deletion)
+    :param list bquals: Base quality for every read in the column
+    :param list mquals: Mapping quality for every read in the column
+    '''
+    __slots__ = ()
+
+    refbase = 'N'
+
+    def __init__( self, ref, pos, bases, bquals, mquals ):
+        # Everything is already decoded so the raw fields are never used
+        self._fields = [ref, None, 'N', None, '', '', '']
+        self._pos = pos
+        self._depth = len(bquals)
+        self._decoded = bases
+        self._bqual_list = bquals
+        self._mqual_list = mquals
+
+    def bqual_str( self ):
+        return ''.join([chr(q+33) for q in self.bquals])
+
+    def mqual_str( self ):
+        return ''.join([chr(q+33) for q in self.mquals])
+
+    def __str__( self ):
+        ''' Returns the equivalent mpileup string '''
+        return '{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}'.format(
+            self.ref, self.pos, self.refbase, self.depth, self.bases,
+            self.bqual_str(), self.mqual_str()
+        )
+
+def has_engine( bamfile ):
+    '''
+    Can bamfile be read in-process?
+    pysam has to be installed and the bam file needs to be indexed
+
+    :param str bamfile: Path to bam file
+    :return: True if the in-process engine can be used for bamfile
+    '''
+    if pysam is None:
+        return False
+    if not isinstance(bamfile, str) or not exists(bamfile):
+        return False
+    return exists(bamfile + '.bai') or exists(bamfile + '.csi')
+
+def alignment_columns( bamfile, regionstr=None, minmq=20, minbq=25, maxd=100000 ):
+    '''
+    Generates PileupColumn's for bamfile by reading it through htslib
+
+    Reads are filtered the same way samtools mpileup filters them by default
+    (unmapped, secondary, qc fail, duplicate and orphan reads are skipped) and
+    overlapping mates are not corrected so every column is identical to what
+    samtools.mpileup would produce with the same arguments
+
+    :param str bamfile: Path to indexed bam file
+    :param str regionstr: Region string to restrict columns to. None is all references
+    :param int minmq: Minimum mapping quality. Same as -q option to mpileup
+    :param int minbq: Minimum base quality. Same as -Q option to mpileup
+    :param int maxd: Maximum depth to consider. Same as -d option to mpileup
+    :return: generator of PileupColumn
+    '''
+    bam = pysam.AlignmentFile(bamfile, 'rb')
+    if regionstr:
+        ref, start, end = parse_regionstring(regionstr)
+        regions = [(ref, max(start, 1) - 1, end)]
+    else:
+        regions = [(ref, 0, l) for ref, l in zip(bam.references, bam.lengths)]
+    try:
+        for ref, start, end in regions:
+            columns = bam.pileup(
+                ref, start, end, truncate=True, stepper='samtools',
+                max_depth=int(maxd), min_base_quality=int(minbq),
+                min_mapping_quality=int(minmq), ignore_overlaps=False,
+                ignore_orphans=True
+            )
+            for col in columns:
+                # Deletions come back empty and are * in mpileup
+                bases = ''.join([b or '*' for b in col.get_query_sequences()]).upper()
+                bquals = [min(q, MAX_QUAL) for q in col.get_query_qualities()]
+                mquals = [min(q, MAX_QUAL) for q in col.get_mapping_qualities()]
+                yield PileupColumn(ref, col.reference_pos + 1, bases, bquals, mquals)
+    finally:
+        bam.close()
+
+def columns( bamfile, regionstr=None, minmq=20, minbq=25, maxd=100000 ):
+    '''
+    Generates pileup columns for bamfile using the in-process engine when possible
+    and falling back to parsing samtools mpileup output otherwise
+
+    Arguments are identical to :py:func:`ngs_mapper.samtools.mpileup`
+
+    :return: iterator of MPileupColumn like objects
+    '''
+    if has_engine(bamfile):
+        log.debug("Reading pileup for {0} in-process".format(bamfile))
+        return alignment_columns(bamfile, regionstr, minmq, minbq, maxd)
+    log.debug("Reading pileup for {0} from samtools mpileup".format(bamfile))
+    return itertools.imap(
+        MPileupColumn, samtools.mpileup(bamfile, regionstr, minmq, minbq, maxd)
+    )
+
+def sample_depths( bamfile, ref, positions ):
+    '''
+    Quickly estimates depth at a few positions of a reference by counting how many
+    reads overlap each position through the bam index(no pileup is built)
+
+    If the bam file cannot be read in-process every depth is 0
+
+    :param str bamfile: Path to bam file
+    :param str ref: Reference name
+    :param list positions: Reference positions(1 based) to sample
+    :return: list of read counts for each position
+    '''
+    if not has_engine(bamfile):
+        return [0] * len(positions)
+    bam = pysam.AlignmentFile(bamfile, 'rb')
+    try:
+        if ref not in bam.references:
+            return [0] * len(positions)
+        return [bam.count(ref, pos - 1, pos) for pos in positions]
+    finally:
+        bam.close()
+
+def gap_columns( *args, **kwargs ):
+    '''
+    Wrapper around columns that yields a :py:class:`ngs_mapper.samtools.PileupGap`
+    for every run of positions that are missing between columns
+    Arguments are the same as columns
+
+    Same as :py:func:`ngs_mapper.samtools.gap_mpileup` but for column objects
+
+    :return: generator of MPileupColumn like objects and PileupGap
+    '''
+    lastref = None
+    lastpos = 0
+    for col in columns(*args, **kwargs):
+        # New reference
+        if col.ref != lastref:
+            lastref = col.ref
+            lastpos = 0
+
+        if col.pos > lastpos + 1:
+            yield PileupGap(col.ref, lastpos + 1, col.pos - 1)
+
+        yield col
+        lastpos = col.pos
+
+def nogap_columns( *args, **kwargs ):
+    '''
+    Wrapper around columns that fills in missing positions with 0 depth columns
+    Arguments are the same as columns
+
+    Same as :py:func:`ngs_mapper.samtools.nogap_mpileup` but for column objects
+
+    :return: generator of MPileupColumn like objects
+    '''
+    for col in gap_columns(*args, **kwargs):
+        if isinstance(col, PileupGap):
+            for i in col.positions():
+                yield PileupColumn(col.ref, i, '', [], [])
+        else:
+            yield col
@@ -1,12 +1,198 @@
 import os
+import errno
+import gzip
+import shutil
+import struct
+import tempfile
 from os.path import *
+from itertools import izip_longest
 from Bio import SeqIO
 
+from ngs_mapper import compat
+from ngs_mapper.util import readable_mode
+
 import logging
 log = logging.getLogger(__name__)
 
 # Valid Read extensions
 VALID_READ_EXT = ('sff','fastq')
+# Compression level used when writing .gz read files(same as the gzip command)
+COMPRESSLEVEL = 6
+# Most bytes held in memory at once when files have to be copied through python
+COPY_BLOCKSIZE = 1048576
+# Most bytes handed to the kernel in a single copy call
+KERNEL_COPY_SIZE = 64 * COPY_BLOCKSIZE
+# Errors that mean a kernel copy does not work for the files given so the next
+# method has to be used instead
+KERNEL_COPY_ERRNO = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+# sff common header up to the flow characters
+# (magic, version, index offset, index length, # reads, header length, key length, # flows, flowgram format)
+SFF_HEADER = struct.Struct( '>4s4sQIIHHHB' )
+# sff read header up to the read name
+# (read header length, name length, # bases, clip qual left, clip qual right, clip adapter left, clip adapter right)
+SFF_READ_HEADER = struct.Struct( '>HHIHHHH' )
+# Phred quality byte to Sanger fastq quality character(fastq caps quality at 93)
+SFF_QUAL_TABLE = ''.join( [chr( min( q, 93 ) + 33 ) for q in range( 256 )] )
+# Directory inside of a sample's directory that its converted sff files are kept in
+SFF_CACHE_DIR = '.sff_cache'
+# Permissions of files written through a temporary file
+FILE_MODE = readable_mode()
+
+def is_gzip( path ):
+    ''' Does path have a .gz extension '''
+    return path.endswith( '.gz' )
+
+def gzip_name( path, compress ):
+    '''
+    Gives path with a .gz extension if compress is True otherwise without one
+
+    @param path - Path to rename
+    @param compress - Should the name be for a compressed file
+
+    @returns path with or without .gz on the end
+    '''
+    if is_gzip( path ):
+        path = path[:-3]
+    if compress:
+        path += '.gz'
+    return path
+
+def open_input( path ):
+    '''
+    Opens path for reading and decompresses it on the fly if it is a .gz file
+
+    @param path - Path to read file
+
+    @returns opened file like object
+    '''
+    if is_gzip( path ):
+        return gzip.open( path, 'rb' )
+    return open( path, 'rb' )
+
+def open_output( path ):
+    '''
+    Opens path for writing and compresses everything written if path has a .gz
+    extension. Compressed files written separately can be concatenated together
+    into a single valid .gz file
+
+    @param path - Path to write
+
+    @returns opened file like object
+    '''
+    if is_gzip( path ):
+        return gzip.open( path, 'wb', COMPRESSLEVEL )
+    return open( path, 'wb' )
+
+def concat_decompressed( paths, outfile ):
+    '''
+    Concatenates the uncompressed contents of every file in paths into outfile
+
+    @param paths - List of paths that may or may not be .gz files
+    @param outfile - Path to write to
+    '''
+    with open( outfile, 'wb' ) as out:
+        for path in paths:
+            with open_input( path ) as fh:
+                shutil.copyfileobj( fh, out, COPY_BLOCKSIZE )
+
+def kernel_copiers( ):
+    '''
+    Copy functions that have the kernel move bytes between two file descriptors
+    without them going through python, best first. Each takes (infd, outfd, count)
+    and returns how many bytes were copied from the current position of infd to
+    the current position of outfd
+
+    @returns list of copy functions(empty if none are available)
+    '''
+    copiers = []
+    if compat.copy_file_range is not None:
+        copiers.append( compat.copy_file_range )
+    if compat.sendfile is not None:
+        copiers.append( lambda infd, outfd, count: compat.sendfile( outfd, infd, None, count ) )
+    return copiers
+
+def block_copy( infd, outfd ):
+    '''
+    Copies everything from the current position of infd to outfd reading only
+    COPY_BLOCKSIZE bytes at a time
+
+    @returns bytes copied
+    '''
+    copied = 0
+    while True:
+        block = os.read( infd, COPY_BLOCKSIZE )
+        if not block:
+            return copied
+        copied += len( block )
+        while block:
+            block = block[os.write( outfd, block ):]
+
+def copy_fd( infd, outfd, copiers ):
+    '''
+    Copies everything from the current position of infd to outfd using the first
+    of copiers that works and block_copy when none of them do. Copiers that do not
+    work for the two files are removed from copiers so they are not tried again
+
+    @param infd - File descriptor to copy from
+    @param outfd - File descriptor to copy to
+    @param copiers - List from kernel_copiers
+
+    @returns bytes copied
+    '''
+    remaining = os.fstat( infd ).st_size - os.lseek( infd, 0, os.SEEK_CUR )
+    copied = 0
+    while copiers and remaining > 0:
+        try:
+            n = copiers[0]( infd, outfd, min( remaining, KERNEL_COPY_SIZE ) )
+        except OSError as e:
+            if e.errno not in KERNEL_COPY_ERRNO:
+                raise
+            log.debug( "Kernel copy failed({0}), trying the next method".format(e) )
+            copiers.pop( 0 )
+            continue
+        if n == 0:
+            break
+        copied += n
+        remaining -= n
+    # Pick up anything left over(file still growing or no copier worked)
+    return copied + block_copy( infd, outfd )
+
+def concat_files( paths, outfile ):
+    '''
+    Concatenates every file in paths into outfile with the kernel doing the copying
+    (copy_file_range or sendfile) when it can so no more than COPY_BLOCKSIZE bytes
+    are ever held in memory
+
+    @param paths - List of paths to concatenate in order
+    @param outfile - Path to write to
+
+    @returns bytes written to outfile
+    '''
+    copiers = kernel_copiers()
+    written = 0
+    with open( outfile, 'wb' ) as out:
+        for path in paths:
+            with open( path, 'rb' ) as fh:
+                written += copy_fd( fh.fileno(), out.fileno(), copiers )
+    return written
+
+def link_or_concat( paths, outfile ):
+    '''
+    Makes outfile have the contents of every file in paths
+
+    A single file is symlinked to outfile instead of being copied
+
+    @param paths - List of paths to concatenate in order
+    @param outfile - Path to write to(must not exist)
+
+    @returns outfile
+    '''
+    if len( paths ) == 1:
+        log.debug( "Linking {0} to {1}".format(paths[0], outfile) )
+        os.symlink( abspath( paths[0] ), outfile )
+    else:
+        concat_files( paths, outfile )
+    return outfile
 
 def clip_seq_record( seqrecord ):
     '''
@@ -34,6 +220,72 @@ def clip_seq_record( seqrecord ):
     newrec._per_letter_annotations['phred_quality'] = trimquals
     return newrec
 
+def _pad8( n ):
+    ''' Bytes of padding that follow n bytes in an sff file '''
+    return -n % 8
+
+def _read_exactly( fh, n ):
+    data = fh.read( n )
+    if len( data ) != n:
+        raise ValueError( "sff file ended {0} bytes early".format(n - len(data)) )
+    return data
+
+def iter_sff( fh, trim=True ):
+    '''
+    Generates a fastq record for every read in an open sff file by slicing the
+    bases and qualities straight out of the file without building any Biopython
+    objects
+
+    When trimming, the bases and qualities are sliced at the clip_qual bounds the
+    same way clip_seq_record does(a clip_qual_right of 0 means no right clip).
+    Untrimmed bases are upper case inside of the qual/adapter clip bounds and
+    lower case outside of them just like Bio.SeqIO gives them
+
+    @param fh - Open sff file
+    @param trim - Whether or not to trim using the clip_qual fields
+
+    @returns generator of (header, seq, plus, qual) lines with their newlines(see iter_fastq)
+    @raises ValueError if fh is not a valid sff file
+    '''
+    (magic, version, index_offset, index_length, nreads, header_length,
+        key_length, nflows, flowgram_format) = SFF_HEADER.unpack( _read_exactly( fh, SFF_HEADER.size ) )
+    if magic != '.sff':
+        raise ValueError( "Not an sff file(magic number {0!r})".format(magic) )
+    if flowgram_format != 1:
+        raise ValueError( "Unsupported sff flowgram format {0}".format(flowgram_format) )
+    _read_exactly( fh, header_length - SFF_HEADER.size )
+    offset = header_length
+    flowsize = 2 * nflows
+    for i in xrange( nreads ):
+        if offset == index_offset:
+            # Index block can sit between reads
+            skip = index_length + _pad8( index_length )
+            _read_exactly( fh, skip )
+            offset += skip
+        (read_header_length, name_length, nbases, cql, cqr,
+            cal, car) = SFF_READ_HEADER.unpack( _read_exactly( fh, SFF_READ_HEADER.size ) )
+        name = _read_exactly( fh, read_header_length - SFF_READ_HEADER.size )[:name_length]
+        datasize = flowsize + 3 * nbases
+        data = _read_exactly( fh, datasize )
+        # Some files leave the padding off of the last read
+        offset += read_header_length + datasize + len( fh.read( _pad8( datasize ) ) )
+        bases = data[flowsize+nbases:flowsize+2*nbases]
+        quals = data[flowsize+2*nbases:flowsize+3*nbases]
+        # Clip values are 1 based
+        left = cql - 1 if cql else 0
+        if trim:
+            right = cqr or nbases
+            bases = bases[left:right].upper()
+            quals = quals[left:right]
+        else:
+            left = max( left, cal - 1 if cal else 0 )
+            right = min( cqr or nbases, car or nbases )
+            if left >= right:
+                bases = bases.lower()
+            else:
+                bases = bases[:left].lower() + bases[left:right].upper() + bases[right:].lower()
+        yield '@' + name + '\n', bases + '\n', '+\n', quals.translate( SFF_QUAL_TABLE ) + '\n'
+
 def sffs_to_fastq( sfflist, outfile, trim=True ):
     '''
     Puts all reads from all sff files into converted fastq outfile
@@ -44,18 +296,54 @@ def sffs_to_fastq( sfflist, outfile, trim=True ):
     
     @returns - # reads written
     '''
-    written_count = 0
-    with open( outfile, 'w' ) as fh:
-        for sff in sfflist:
-            for rec in SeqIO.parse( sff, 'sff' ):
-                if trim:
-                    rec = clip_seq_record( rec )
-                written_count += SeqIO.write( rec, fh, 'fastq' )
-    return written_count
+    with open( outfile, 'wb' ) as fh:
+        with FastqWriter( fh ) as writer:
+            for sff in sfflist:
+                with open( sff, 'rb' ) as sfh:
+                    for record in iter_sff( sfh, trim ):
+                        writer.write( record )
+    return writer.written
+
+def converted_sff( sffpath, cachedir ):
+    '''
+    Path to the trimmed fastq converted from sffpath so every stage of a sample
+    that needs it as fastq converts it only once
+
+    The fastq is kept in SFF_CACHE_DIR inside of cachedir(the sample's directory so
+    the directory the sff is in is never written to) and is converted again only
+    when sffpath is newer than it or it cannot be read
+
+    @param sffpath - Path to sff file
+    @param cachedir - Directory to keep SFF_CACHE_DIR in
+
+    @returns path to fastq file
+    '''
+    name = basename( sffpath )[:-4] + '.fastq'
+    cachedir = join( cachedir, SFF_CACHE_DIR )
+    cached = join( cachedir, name )
+    if exists( cached ) and os.access( cached, os.R_OK ) and getmtime( cached ) >= getmtime( sffpath ):
+        log.debug( "Using {0} already converted from {1}".format(cached, sffpath) )
+        return cached
+    try:
+        os.makedirs( cachedir )
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, tmp = tempfile.mkstemp( prefix='.' + name, dir=cachedir )
+    os.close( fd )
+    try:
+        log.info( "Converting {0} to {1}".format(sffpath, cached) )
+        sffs_to_fastq( [sffpath], tmp )
+        os.chmod( tmp, FILE_MODE )
+        os.rename( tmp, cached )
+    except:
+        os.unlink( tmp )
+        raise
+    return cached
 
 class InvalidReadFile(Exception): pass
 
-def compile_reads( readfilelist, outputdir ):
+def compile_reads( readfilelist, outputdir, sffcachedir=None ):
     '''
     Compiles all read files inside of readfilelist into respective files.
     Creates F.fq, R.fq and/or NP.fq depending on the reads found in readfilelist
@@ -65,13 +353,18 @@ def compile_reads( readfilelist, outputdir ):
     mate pair read set and the first item will be the Forward read file and the second the Reverse read file.
 
     @param outputdir - Where to output the three files
+    @param sffcachedir - Directory of the sample that converted sff files are kept in(see converted_sff).
+        Defaults to outputdir
 
     @returns a dictionary {'F': join(outputdir,'F.fq'), 'R': join(outputdir,'R.fq'), 'NP': join(outputdir,'NP.fq')}
     If there were no mated files given then F & R will be None. Same goes for NP
+    When only a single uncompressed fastq goes into one of the files it is a symlink
+    to that fastq instead of a copy of it. sff files are converted with converted_sff
     '''
-    from bwa.bwa import seqio
     if not os.path.exists(outputdir):
         os.makedirs(outputdir)
+    if sffcachedir is None:
+        sffcachedir = outputdir
 
     files_written = {'F':[],'R':[],'NP':[]}
 
@@ -106,30 +399,21 @@ def compile_reads( readfilelist, outputdir ):
             other = [r for r in files if not r.endswith('.sff')]
 
             # All files to concat together
-            cfiles = []
-
-            # Cat all sff
-            if sffs:
-                sff_out = join(outputdir,'sffs.fq')
-                log.debug( "Converting {0} to temp fastq file {1}".format(sffs,sff_out) )
-                try:
-                    r = sffs_to_fastq( sffs, sff_out )
-                except AssertionError as e:
-                    # Skip this error that started occuring in new version of BioPython
-                    # Pretty big assumption that the outfiles are ok
-                    # Check Biopython issue #294
-                    pass
-                cfiles.append( sff_out )
+            # sff files converted by an earlier stage are reused
+            cfiles = [converted_sff( sff, sffcachedir ) for sff in sffs]
             if other:
                 # Just concat these as normal since they are just text
                 cfiles += other
 
             # concat everything together now
             log.debug( "Concating all files {0} to {1}".format(cfiles,outfile) )
-            seqio.concat_files(cfiles, outfile)
-            # Remove the sff concatted file
-            if sffs:
-                os.unlink( sff_out )
+            # Never write through a link left from a previous run into the file it points to
+            if lexists( outfile ):
+                os.unlink( outfile )
+            if any( map( is_gzip, cfiles ) ):
+                concat_decompressed( cfiles, outfile )
+            else:
+                link_or_concat( cfiles, outfile )
 
             # Record the file that was written
             files_written[f] = outfile
@@ -138,13 +422,162 @@ def compile_reads( readfilelist, outputdir ):
 
     return files_written
 
+def iter_fastq( fh ):
+    '''
+    Generates the 4 lines of every record in an open 4 line per record fastq file
+    without building any Biopython objects. Blank lines between records are skipped
+
+    @param fh - Open file like object positioned at the start of a record
+
+    @returns generator of (header, seq, plus, qual) lines with their newlines
+    @raises ValueError if a record does not start with @ or its third line with +
+    '''
+    readline = fh.readline
+    while True:
+        header = readline()
+        if not header:
+            return
+        if header.isspace():
+            continue
+        seq, plus, qual = readline(), readline(), readline()
+        if header[0] != '@' or plus[:1] != '+':
+            raise ValueError( "Invalid fastq record starting with {0!r}".format(header) )
+        # Last record may not end with a newline
+        if not qual.endswith( '\n' ):
+            qual += '\n'
+        yield header, seq, plus, qual
+
+def fastq_records( fqpath ):
+    '''
+    Generates the 4 lines of every record in a 4 line per record fastq file
+
+    @param fqpath - Path to fastq file(can be .gz)
+
+    @returns generator of (header, seq, plus, qual) lines with their newlines
+    '''
+    with open_input( fqpath ) as fh:
+        for record in iter_fastq( fh ):
+            yield record
+
+def fasta_records( fapath ):
+    '''
+    Generates (id, seq) for every record in a fasta file with the sequence lines joined
+
+    @param fapath - Path to fasta file
+
+    @returns generator of (id, seq)
+    '''
+    id, seq = None, []
+    with open( fapath ) as fh:
+        for line in fh:
+            if line.startswith( '>' ):
+                if id is not None:
+                    yield id, ''.join( seq )
+                id, seq = (line[1:].split( None, 1 ) or [''])[0], []
+            elif id is not None:
+                seq.append( ''.join( line.split() ) )
+    if id is not None:
+        yield id, ''.join( seq )
+
+def record_id( record ):
+    ''' Read name of a fastq record from iter_fastq(header up to the first whitespace) '''
+    return record[0][1:].split( None, 1 )[0]
+
+def min_qual( qual, offset=33 ):
+    '''
+    Lowest phred quality in a fastq quality line found by scanning its bytes
+
+    @param qual - Quality line(trailing newline is ignored)
+    @param offset - Phred offset of the quality encoding
+
+    @returns lowest quality
+    @raises ValueError if qual is empty
+    '''
+    return ord( min( qual.rstrip( '\r\n' ) ) ) - offset
+
+class FastqWriter(object):
+    '''
+    Writes records from iter_fastq to an open file in blocks of blocksize records
+    instead of one write per record. flush has to be called once every record
+    has been written(or use it in a with statement)
+    '''
+    def __init__( self, fh, blocksize=4096 ):
+        self.fh = fh
+        self.blocksize = blocksize
+        self.buffer = []
+        self.written = 0
+
+    def write( self, record ):
+        self.buffer.append( ''.join( record ) )
+        self.written += 1
+        if len( self.buffer ) >= self.blocksize:
+            self.flush()
+
+    def flush( self ):
+        self.fh.write( ''.join( self.buffer ) )
+        self.buffer = []
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc ):
+        self.flush()
+
+def tag_header( header, comment ):
+    '''
+    Replaces everything after the read name in a fastq header line with comment
+
+    @param header - Fastq header line(@name optional comment)
+    @param comment - Comment to put after the name
+
+    @returns the new header line with a newline
+    '''
+    return header.split( None, 1 )[0] + ' ' + comment + '\n'
+
+def interleave_reads( reads, comment, out ):
+    '''
+    Writes the reads compile_reads put into F.fq/R.fq/NP.fq to out as one stream
+    that bwa mem -p can map at once. Each F.fq read is followed by its mate from
+    R.fq so bwa pairs them and the NP.fq reads follow the pairs as single reads.
+
+    Every read gets comment as its fastq comment so bwa mem -C can copy it into
+    the alignment(such as RG:Z:MiSeq)
+
+    @param reads - Dictionary returned from compile_reads
+    @param comment - Comment to give every read
+    @param out - File like object to write to
+
+    @returns number of reads written
+    '''
+    written = 0
+    if reads['F'] is not None:
+        fwd = fastq_records( reads['F'] )
+        rev = fastq_records( reads['R'] )
+        for frec, rrec in izip_longest( fwd, rev ):
+            if frec is None or rrec is None:
+                raise InvalidReadFile( "{0} and {1} do not have the same number of reads".format(
+                    reads['F'], reads['R']
+                ) )
+            out.write( tag_header( frec[0], comment ) + ''.join( frec[1:] ) )
+            out.write( tag_header( rrec[0], comment ) + ''.join( rrec[1:] ) )
+            written += 2
+    if reads['NP'] is not None:
+        for rec in fastq_records( reads['NP'] ):
+            out.write( tag_header( rec[0], comment ) + ''.join( rec[1:] ) )
+            written += 1
+    return written
+
 def is_valid_read( readpath ):
     '''
     Just checks to make sure file extension is in VALID_READ_EXT
+    Compressed fastq files(.fastq.gz) are valid too
 
     @param readpath - Path to read file
 
     @returns true if ext of readpath is in VALID_READ_EXT
     '''
     # File extension without the period in VALID_READ_EXT ?
-    return splitext( readpath )[1][1:] in VALID_READ_EXT
+    ext = splitext( gzip_name( readpath, False ) )[1][1:]
+    if is_gzip( readpath ):
+        return ext == 'fastq'
+    return ext in VALID_READ_EXT
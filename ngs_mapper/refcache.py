@@ -0,0 +1,156 @@
+'''
+Reference index cache shared between samples
+
+Every reference fasta is stored under the cache directory in a directory named
+after the sha1 checksum of its contents along with its bwa index, .fai index and
+homopolymer tables so samples mapped against the same reference only have to link
+to them instead of building them again.
+
+Builds are done in a temporary directory inside of the cache directory while
+holding an exclusive lock on <checksum>.lock and then renamed into place so
+samples running at the same time never see a partially built entry and only one
+of them builds it.
+'''
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from os.path import exists, join
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+from ngs_mapper import compat
+from ngs_mapper.util import readable_mode
+
+log = logging.getLogger(__name__)
+
+# Name of the fasta inside of every cache entry
+REFERENCE_NAME = 'reference.fasta'
+# Extensions of every file built for a reference
+BWA_INDEX_EXT = ('.amb', '.ann', '.bwt', '.pac', '.sa')
+INDEX_EXT = BWA_INDEX_EXT + ('.fai', '.hpoly.npz')
+
+# Raised when a cache entry cannot be built
+class IndexBuildError(Exception): pass
+
+def fasta_checksum( fasta, blocksize=1048576 ):
+    '''
+    sha1 checksum of the contents of fasta
+
+    :param str fasta: Path to fasta file
+    :param int blocksize: How many bytes to read at a time
+    :return: hex digest
+    '''
+    sha = hashlib.sha1()
+    with open( fasta, 'rb' ) as fh:
+        for block in iter( lambda: fh.read( blocksize ), '' ):
+            sha.update( block )
+    return sha.hexdigest()
+
+@contextmanager
+def locked( lockfile ):
+    '''
+    Holds an exclusive lock on lockfile(created if it does not exist) until the
+    with block is left
+    '''
+    with open( lockfile, 'a' ) as fh:
+        fcntl.flock( fh.fileno(), fcntl.LOCK_EX )
+        try:
+            yield
+        finally:
+            fcntl.flock( fh.fileno(), fcntl.LOCK_UN )
+
+def build_index( fasta ):
+    '''
+    Builds the bwa index, .fai index and homopolymer tables next to fasta
+
+    :param str fasta: Path to fasta file
+    '''
+    # Only needed to build entries
+    from bwa.bwa import index_ref
+    from ngs_mapper.base_caller import save_hpoly_index
+    log.info( "Building bwa index for {0}".format(fasta) )
+    if not index_ref( fasta ):
+        raise IndexBuildError( "{0} cannot be indexed by bwa".format(fasta) )
+    if pysam is not None:
+        pysam.faidx( fasta )
+    else:
+        compat.check_output( ['samtools', 'faidx', fasta] )
+    save_hpoly_index( fasta, fasta + '.hpoly.npz' )
+
+def make_readable( entry ):
+    '''
+    Gives entry(made by mkdtemp so only its owner can get into it) and every file
+    in it the permissions a normally created directory and file would have so the
+    entry can be used by every user that shares the cache
+    '''
+    os.chmod( entry, readable_mode( 0755 ) )
+    for name in os.listdir( entry ):
+        os.chmod( join( entry, name ), readable_mode( 0644 ) )
+
+def cached_reference( fasta, cachedir ):
+    '''
+    Gets the path to the cached copy of fasta, building the cache entry if this
+    is the first time the reference is seen
+
+    :param str fasta: Path to fasta file
+    :param str cachedir: Cache directory(created if it does not exist)
+    :return: path to the cached fasta which has all INDEX_EXT files next to it
+    '''
+    checksum = fasta_checksum( fasta )
+    entry = join( cachedir, checksum )
+    cached = join( entry, REFERENCE_NAME )
+    if exists( entry ):
+        log.debug( "Using cached index {0} for {1}".format(entry, fasta) )
+        return cached
+    try:
+        os.makedirs( cachedir )
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    with locked( entry + '.lock' ):
+        # Someone else may have built it while we waited for the lock
+        if exists( entry ):
+            return cached
+        tmpentry = tempfile.mkdtemp( prefix='.' + checksum, dir=cachedir )
+        try:
+            shutil.copy( fasta, join( tmpentry, REFERENCE_NAME ) )
+            build_index( join( tmpentry, REFERENCE_NAME ) )
+            make_readable( tmpentry )
+            os.rename( tmpentry, entry )
+        except:
+            shutil.rmtree( tmpentry )
+            raise
+    return cached
+
+def link_file( src, dst ):
+    ''' Hard links src to dst or symlinks it when it cannot be hard linked(different filesystems or owner) '''
+    try:
+        os.link( src, dst )
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK):
+            raise
+        os.symlink( os.path.abspath( src ), dst )
+
+def link_reference( fasta, dest, cachedir ):
+    '''
+    Links the cached copy of fasta to dest along with all of its cached index
+    files so nothing has to be indexed for the sample
+
+    :param str fasta: Path to fasta file
+    :param str dest: Where to link the copy of fasta
+    :param str cachedir: Cache directory
+    :return: dest
+    '''
+    cached = cached_reference( fasta, cachedir )
+    link_file( cached, dest )
+    for ext in INDEX_EXT:
+        link_file( cached + ext, dest + ext )
+    return dest
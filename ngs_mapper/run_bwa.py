@@ -1,43 +1,47 @@
-from bwa.bwa import BWAMem, index_ref, which_bwa, compile_refs
+from bwa.bwa import index_ref, which_bwa, compile_refs
 from ngs_mapper.data import reads_by_plat
-from ngs_mapper.reads import compile_reads
+from ngs_mapper.reads import compile_reads, interleave_reads
+from ngs_mapper.tagreads import rg_line
+from ngs_mapper.refcache import BWA_INDEX_EXT
 import ngs_mapper.bam
 
 import os
 import sys
 from os.path import *
 import log
-import tempfile
 import shutil
-from subprocess import PIPE
+from subprocess import Popen, PIPE
 
 logger = log.setup_logger(__name__, log.get_config())
 
 # For bwa errors
 class BWAError(Exception): pass
 
+# For samtools errors while sorting the bwa output
+class SortError(Exception): pass
+
 def main():
     '''
         Compiles and runs everything
 
+        The reads for every platform are mapped with a single bwa mem run. Mated and
+        non-paired reads are streamed to bwa interleaved and every read carries the read
+        group of the platform its read file came from so every alignment is tagged and
+        the bam header has the read groups for all mapped platforms
+
         @returns path to the final bam file which will be dictated by the --ouput arg value
     '''
     args = parse_args( sys.argv[1:] )
     tdir = join(dirname(args.output), 'bwa')
+    SM = args.SM
+    if SM is None:
+        SM = basename(args.output).replace( '.bam', '' )
     
-    # Compile together all the reads into a list
-    preads = reads_by_plat( args.reads )
+    # Compile together all the reads for each platform
+    preads = reads_by_plat( args.reads, args.platform_cache )
     logger.debug( "Reads parsed by platform: {0}".format(preads) )
-    reads = []
-    for plat in args.platforms:
-        if plat in preads:
-            reads += preads[plat]
-    # Creates reads/F.fq, reads/R.fq, reads/NP.fq
     readdir = join(tdir,'reads')
     os.makedirs( readdir )
-    reads = compile_reads( reads, readdir )
-    if not reads:
-        raise Exception( "Somehow no reads were compiled" )
 
     if os.path.isdir( args.reference ):
         cwd = os.getcwd()
@@ -47,38 +51,31 @@ def main():
     else:
         ref = args.reference
 
-    # Keeps track so we know to merge bams later if it is 3
-    merge = 0
-
-    if reads['F'] is not None:
-        merge += 1
-        pairedsai = bwa_mem( reads['F'], reads['R'], ref, join(tdir, 'paired.sai'), t=args.threads )
-        if isinstance(pairedsai,int):
-            raise BWAError("There was an error running bwa")
-        pairedbam = ngs_mapper.bam.sortbam( ngs_mapper.bam.samtobam( pairedsai, PIPE ), join(tdir, 'paired.bam') )
-        #bam.indexbam( pairedbam )
-
-    if reads['NP'] is not None:
-        merge += 2
-        nonpairedsai = bwa_mem( reads['NP'], ref=ref, output=join(tdir, 'nonpaired.sai'), t=args.threads )
-        if isinstance(nonpairedsai,int):
-            raise BWAError("There was an error running bwa")
-        nonpairedbam = ngs_mapper.bam.sortbam( ngs_mapper.bam.samtobam( nonpairedsai, PIPE ), join(tdir, 'nonpaired.bam') )
-        #bam.indexbam( nonpairedbam )
-
-    # Now decide if any merging needs to happen
-    bampath = args.output
-    if merge == 3:
-        ngs_mapper.bam.mergebams( [pairedbam, nonpairedbam], args.output )
-    elif merge == 1:
-        logger.debug( "Paired only. Moving result file {0} to {1}".format(pairedbam, bampath) )
-        shutil.move( pairedbam, bampath )
-    elif merge == 2:
-        logger.debug( "Includes non-paired. Moving result file {0} to {1}".format(nonpairedbam, bampath) )
-        shutil.move( nonpairedbam, bampath )
-    else:
+    # (read group id, compile_reads output) for every platform to map
+    platreads = []
+    rgs = []
+    for plat in args.platforms:
+        if plat not in preads:
+            continue
+        # Creates reads/<platform>/F.fq, reads/<platform>/R.fq, reads/<platform>/NP.fq
+        # sff files trim_reads already converted for the sample are reused
+        platreads.append( (plat, compile_reads( preads[plat], join(readdir, plat), dirname(tdir) )) )
+        rgs.append( rg_line( plat, SM, args.CN ) )
+
+    if not platreads:
         raise Exception( "Somehow no reads were compiled" )
 
+    # Read group lines bwa puts into the header
+    hdr = join(tdir, 'rg.txt')
+    with open(hdr, 'w') as fh:
+        fh.write( '\n'.join( rgs ) + '\n' )
+
+    bampath = args.output
+    bwa_mem_sorted(
+        platreads, ref, bampath, args.threads, hdr,
+        args.sort_threads, args.sort_memory
+    )
+
     # Index the resulting bam
     ngs_mapper.bam.indexbam( bampath )
 
@@ -100,14 +97,15 @@ def parse_args( args=sys.argv[1:] ):
     from ngs_mapper import config
     conf_parser, args, config, configfile = config.get_config_argparse(args)
     defaults = config['run_bwa_on_samplename']
+    rgdefaults = config['tagreads']
 
     parser = argparse.ArgumentParser(
         description='Runs the bwa mem argument on a given set of reads and references for the given platform\'s reads',
         epilog='You should consider this script an autonomous bwa operation. That is, it will select the reads for ' \
             'the platforms you select and it will pull those reads onto the current host. It will ' \
             'compile references if they are multiple ones in a directory you select onto the local computer. Then it ' \
-            'will map any mated reads against to those refs and also map the nonpaired reads against that ref in a separate ' \
-            'call. Then when both are finished it will convert to bam/sort/index/merge/reindex the results. It attempts all of ' \
+            'will map the mated and nonpaired reads of every platform against those refs in a single bwa call whose ' \
+            'output is sorted into a bam as it is produced and then indexed. It attempts all of ' \
             'this inside of the /dev/shm filesystem which should be very fast. If /dev/shm cannot be used then /tmp will be used. '\
             'If you want the temporary files that are created to stay then you can use the --keep-temp argument',
         parents=[conf_parser]
@@ -156,24 +154,54 @@ def parse_args( args=sys.argv[1:] ):
         help=defaults['threads']['help']
     )
 
+    parser.add_argument(
+        '--sort-threads',
+        dest='sort_threads',
+        default=defaults['sort_threads']['default'],
+        type=int,
+        help=defaults['sort_threads']['help']
+    )
+
+    parser.add_argument(
+        '--sort-memory',
+        dest='sort_memory',
+        default=defaults['sort_memory']['default'],
+        help=defaults['sort_memory']['help']
+    )
+
+    parser.add_argument(
+        '-SM',
+        dest='SM',
+        default=rgdefaults['SM']['default'],
+        help=rgdefaults['SM']['help']
+    )
+
+    parser.add_argument(
+        '-CN',
+        dest='CN',
+        default=rgdefaults['CN']['default'],
+        help=rgdefaults['CN']['help']
+    )
+
+    parser.add_argument(
+        '--platform-cache',
+        dest='platform_cache',
+        default=None,
+        help='File to remember the platform of every read file in(see data.PlatformCache). ' \
+            'runsample passes one file for the whole sample so each stage can reuse it'
+    )
+
     return parser.parse_args( args )
 
 class InvalidReference(Exception): pass
 
-def bwa_mem( read1, mate=None, ref=None, output='bwa.sai', **kwargs ):
+def prepare_ref( ref ):
     '''
-        Runs the bwa mem algorithm on read1 against ref. If mate is given then run that file with the read1 file
-        so paired alignment is done.
-
-        TODO:
-            bwa_path should be an option to specify where the executable is
+        Compiles ref if it is a directory of references and makes sure it is indexed
 
-        @param read1 - File path to read
-        @param mate - Mate file path
         @param ref - Reference file path or directory of references
-        @param output - The output destination
 
-        @returns the output path if sucessful or -1 if something went wrong
+        @returns the reference file path to map against
     '''
     if os.path.isdir( ref ):
         # Compile ref directory
@@ -182,20 +210,78 @@ def bwa_mem( read1, mate=None, ref=None, output='bwa.sai', **kwargs ):
         logger.info( "Refs are all compiled into {0}".format(ref) )
 
     # First, make sure the reference is indexed
+    # It already is when it was linked from the reference cache
+    if is_indexed( ref ):
+        logger.debug( "{0} is already indexed".format(ref) )
+        return ref
     logger.debug( "Ensuring {0} is indexed".format(ref) )
     if not index_ref(ref):
         raise InvalidReference("{0} cannot be indexed by bwa")
+    return ref
 
-    # Setup BWA Mem
-    mem = None
-    if mate:
-        mem = BWAMem( ref, read1, mate, bwa_path=which_bwa(), **kwargs )
-    else:
-        mem = BWAMem( ref, read1, bwa_path=which_bwa(), **kwargs )
+def is_indexed( ref ):
+    '''
+        Does ref have every bwa index file next to it that is not older than ref
 
-    ret = mem.run( output )
-    print "Ret: " + str(ret)
-    if ret != 0:
-        return ret
-    else:
-        return output
+        @param ref - Reference file path
+    '''
+    if not exists( ref ):
+        return False
+    reftime = os.stat( ref ).st_mtime
+    for ext in BWA_INDEX_EXT:
+        if not exists( ref + ext ) or os.stat( ref + ext ).st_mtime < reftime:
+            return False
+    return True
+
+def bwa_mem_sorted( platreads, ref, output='bwa.bam', threads=1, header=None, sort_threads=1, sort_memory=None ):
+    '''
+        Maps all mated and non-paired reads of every platform with a single bwa mem
+        run and streams its output straight into samtools so a coordinate sorted bam
+        is written without the sam output ever touching the disk
+
+        interleaved reads | bwa mem -p -C - | samtools view -Sbu - | samtools sort -f - output
+
+        Reads are written to bwa by :py:func:`ngs_mapper.reads.interleave_reads` with
+        RG:Z:<read group id> as their comment which bwa mem -C copies into every alignment
+
+        @param platreads - List of (read group id, compile_reads output) to map
+        @param ref - Reference file path or directory of references
+        @param output - Path of the sorted bam to write
+        @param threads - Threads for bwa to use
+        @param header - File of header lines(@RG lines) for bwa to add to the header
+        @param sort_threads - Threads for samtools sort to use
+        @param sort_memory - Memory for each samtools sort thread(samtools -m value)
+
+        @returns output
+    '''
+    ref = prepare_ref( ref )
+    cmd = [which_bwa(), 'mem', '-p', '-C', '-t', str(threads)]
+    if header:
+        cmd += ['-H', header]
+    cmd += [ref, '-']
+    logger.info( 'Running {0}'.format(' '.join(cmd)) )
+    bwa = Popen( cmd, stdin=PIPE, stdout=PIPE )
+    view, sort = ngs_mapper.bam.sortsam( bwa.stdout, output, sort_threads, sort_memory )
+    # Only the pipeline holds the pipe now so bwa gets SIGPIPE if samtools dies
+    bwa.stdout.close()
+    try:
+        for rgid, reads in platreads:
+            n = interleave_reads( reads, 'RG:Z:' + rgid, bwa.stdin )
+            logger.info( "Sent {0} {1} reads to bwa".format(n, rgid) )
+    except IOError as e:
+        # bwa went away, its exit status below says why
+        logger.error( "Could not send reads to bwa: {0}".format(e) )
+    finally:
+        try:
+            bwa.stdin.close()
+        except IOError:
+            pass
+        # Wait for everything so no zombies are left if any of them fail
+        bwaret, viewret, sortret = bwa.wait(), view.wait(), sort.wait()
+    if bwaret != 0:
+        raise BWAError( "bwa mem exited with {0}".format(bwaret) )
+    if viewret != 0 or sortret != 0:
+        raise SortError( "samtools could not sort bwa output into {0}(view exited {1}, sort exited {2})".format(
+            output, viewret, sortret
+        ) )
+    return output
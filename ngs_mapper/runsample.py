@@ -10,10 +10,8 @@ Current Pipeline Stages
 
 * :py:mod:`ngs_mapper.nfilter`
 * :py:mod:`ngs_mapper.trim_reads`
-* :py:mod:`ngs_mapper.run_bwa_on_samplename <ngs_mapper.run_bwa>`
-* :py:mod:`ngs_mapper.tagreads`
-* :py:mod:`ngs_mapper.base_caller`
-* :doc:`../scripts/gen_flagstats`
+* :py:mod:`ngs_mapper.run_bwa_on_samplename <ngs_mapper.run_bwa>` (also tags reads with their platform's read group)
+* :py:mod:`ngs_mapper.base_caller` (also makes the qualdepth json and flagstats)
 * :py:mod:`ngs_mapper.graphsample`
 * :py:mod:`ngs_mapper.fqstats`
 * :py:mod:`ngs_mapper.vcf_consensus`
@@ -60,7 +58,7 @@ Output Analysis Directory
     * Index for the .bam file
 * samplename.bam.consensus.fasta (:py:mod:`ngs_mapper.vcf_consensus`)
     * Consensus sequence built for your mapping
-* samplename.bam.qualdepth.json (:py:mod:`ngs_mapper.graphs`)
+* samplename.bam.qualdepth.json (:py:mod:`ngs_mapper.base_caller`)
     * Contains statistics about your bam alignment such as depth and coverage.
       Not really meant for humans to read
 * samplename.bam.qualdepth.png (:py:mod:`ngs_mapper.graphs`)
@@ -79,14 +77,17 @@ Output Analysis Directory
 * bwa.log (:py:mod:`ngs_mapper.run_bwa_on_samplename`)
     * Log file that is specific to when bwa ran and contains all bwa output
 * reference.fasta (:py:mod:`ngs_mapper.runsample`)
-    * Copied reference fasta file that was specified
+    * Copied reference fasta file that was specified(linked from the reference cache
+      along with its index files when --ref-cache is given)
 * reference.fasta.amb (:py:mod:`ngs_mapper.runsample`)
 * reference.fasta.ann (:py:mod:`ngs_mapper.runsample`)
 * reference.fasta.bwt (:py:mod:`ngs_mapper.runsample`)
 * reference.fasta.pac (:py:mod:`ngs_mapper.runsample`)
 * reference.fasta.sa( :py:mod:`ngs_mapper.runsample`)
-* flagstats.txt (:py:mod:`ngs_mapper.gen_flagstats`)
-    * Just the dump from samtools flagstats
+* reference.fasta.fai and reference.fasta.hpoly.npz (:py:mod:`ngs_mapper.refcache`)
+    * Only when --ref-cache is given
+* flagstats.txt (:py:mod:`ngs_mapper.base_caller`)
+    * Same output as samtools flagstat
 * qualdepth (:py:mod:`ngs_mapper.graphs`)
     * sample.bam.qualdepth.referencename.png
     * ...
@@ -100,6 +101,8 @@ Output Analysis Directory
     * filtered.sampleread1.fastq
     * filtered.sampleread2.fastq
     * ngs_filter_stats.txt
+    * ngs_filter_stats.json
+    * ngs_filter_stats.tsv
 """
 
 import argparse
@@ -114,8 +117,9 @@ import shutil
 import glob
 from ngs_mapper import compat
 import sh
-from data import fastas_to_40s_fastqs
+from data import fastas_to_40s_fastqs, PLATFORM_CACHE
 import nfilter
+import refcache
 # Everything to do with running a single sample
 # Geared towards running in a Grid like universe(HTCondor...)
 # Ideally the entire sample would be run inside of a prefix directory under
@@ -235,6 +239,13 @@ def parse_args( args=sys.argv[1:] ):
         help=_config['ngs_filter']['platforms']['help'],
     )
 
+    parser.add_argument(
+        '--ref-cache',
+        dest='ref_cache',
+        default=_config['refcache']['cachedir']['default'],
+        help=_config['refcache']['cachedir']['help'],
+    )
+
     default_outdir = os.getcwd()
     parser.add_argument(
         '-od',
@@ -337,6 +348,7 @@ def main():
     flagstats = os.path.join( tdir, 'flagstats.txt' )
     consensus = bamfile+'.consensus.fasta'
     vcf = bamfile+'.vcf'
+    qualdepth = bamfile+'.qualdepth.json'
     bwalog = os.path.join( tdir, 'bwa.log' )
     stdlog = os.path.join( tdir, args.prefix + '.std.log' )
     logfile = os.path.join( tdir, args.prefix + '.log' )
@@ -362,10 +374,13 @@ def main():
             'flagstats': flagstats,
             'consensus': consensus,
             'vcf': vcf,
+            'qualdepth': qualdepth,
             'CN': CN,
             'trim_qual': args.trim_qual,
             'trim_outdir': os.path.join(tdir,'trimmed_reads'),
             'filtered_dir' : os.path.join(tdir, 'filtered'),
+            # Every stage looks up the platforms of the reads it is given in here
+            'platform_cache': os.path.join(tdir, PLATFORM_CACHE),
             'head_crop': args.head_crop,
             'minth': args.minth,
             'config': args.config,
@@ -378,8 +393,14 @@ def main():
         # Best not to run across multiple cpu/core/threads on any of the pipeline steps
         # as multiple samples may be running concurrently already
 
-        logger.debug( "Copying reference file {0} to {1}".format(args.reference,cmd_args['reference']) )
-        shutil.copy( args.reference, cmd_args['reference'] )
+        if args.ref_cache:
+            logger.debug( "Linking reference file {0} and its index from {1} to {2}".format(
+                args.reference, args.ref_cache, cmd_args['reference'])
+            )
+            refcache.link_reference( args.reference, cmd_args['reference'], args.ref_cache )
+        else:
+            logger.debug( "Copying reference file {0} to {1}".format(args.reference,cmd_args['reference']) )
+            shutil.copy( args.reference, cmd_args['reference'] )
 
         # Return code list
         rets = []
@@ -401,9 +422,10 @@ def main():
 
         try:
             if cmd_args['config']:
-                __result = sh.ngs_filter(convert_dir, config=cmd_args['config'], outdir=cmd_args['filtered_dir'])
+                __result = sh.ngs_filter(convert_dir, config=cmd_args['config'], outdir=cmd_args['filtered_dir'],
+                                         platform_cache=cmd_args['platform_cache'])
             else:
-                filter_args = select_keys(cmd_args, ["drop_ns", "platforms", "index_min"])
+                filter_args = select_keys(cmd_args, ["drop_ns", "platforms", "index_min", "platform_cache"])
                 __result = sh.ngs_filter(convert_dir, outdir=cmd_args['filtered_dir'], **filter_args)
             logger.debug( 'ngs_filter: %s' % __result )
         except sh.ErrorReturnCode, e:
@@ -413,7 +435,7 @@ def main():
         #sh.rm(convert_dir, r=True)
 
         #Trim reads
-        cmd = 'trim_reads {filtered_dir} -q {trim_qual} -o {trim_outdir} --head-crop {head_crop}'
+        cmd = 'trim_reads {filtered_dir} -q {trim_qual} -o {trim_outdir} --head-crop {head_crop} --platform-cache {platform_cache}'
         if cmd_args['config']:
             cmd += ' -c {config}'
         primer_info = cmd_args['primer_info']
@@ -428,7 +450,7 @@ def main():
 
         # Mapping
         with open(bwalog, 'wb') as blog:
-            cmd = 'run_bwa_on_samplename {trim_outdir} {reference} -o {bamfile}'
+            cmd = 'run_bwa_on_samplename {trim_outdir} {reference} -o {bamfile} -CN {CN} --platform-cache {platform_cache}'
             if cmd_args['config']:
                 cmd += ' -c {config}'
             p = run_cmd( cmd.format(**cmd_args), stdout=blog, stderr=subprocess.STDOUT )
@@ -440,18 +462,8 @@ def main():
                 logger.critical( "{0} failed to complete sucessfully. Please check the log file {1} for more details".format(cmd,bwalog) )
                 sys.exit(1)
 
-        # Tag Reads
-        cmd = 'tagreads {bamfile} -CN {CN}'
-        if cmd_args['config']:
-            cmd += ' -c {config}'
-        p = run_cmd( cmd.format(**cmd_args), stdout=lfile, stderr=subprocess.STDOUT )
-        r = p.wait()
-        if r != 0:
-            logger.critical( "{0} did not exit sucessfully".format(cmd.format(**cmd_args)) )
-        rets.append( r )
-
-        # Variant Calling
-        cmd = 'base_caller {bamfile} {reference} {vcf} -minth {minth}'
+        # Variant Calling, qualdepth and flagstats all from the same pass
+        cmd = 'base_caller {bamfile} {reference} {vcf} -minth {minth} --qualdepth {qualdepth} --flagstats {flagstats}'
         if cmd_args['config']:
             cmd += ' -c {config}'
         p = run_cmd( cmd.format(**cmd_args), stdout=lfile, stderr=subprocess.STDOUT )
@@ -463,17 +475,8 @@ def main():
             cmd = cmd.format(**cmd_args)
             logger.critical( '{0} failed to complete successfully'.format(cmd.format(**cmd_args)) )
 
-        # Flagstats
-        with open(flagstats,'wb') as flagstats:
-            cmd = 'samtools flagstat {bamfile}'
-            p = run_cmd( cmd.format(**cmd_args), stdout=flagstats, stderr=lfile, script_dir='' )
-            r = p.wait()
-            if r != 0:
-                logger.critical( "{0} did not exit sucessfully".format(cmd.format(**cmd_args)) )
-            rets.append( r )
-
-        # Graphics
-        cmd = 'graphsample {bamfile} -od {tdir}'
+        # Graphics from the qualdepth base_caller made
+        cmd = 'graphsample {bamfile} -od {tdir} -qualdepth {qualdepth}'
         p = run_cmd( cmd.format(**cmd_args), stdout=lfile, stderr=subprocess.STDOUT )
         r = p.wait()
         if r != 0:
@@ -481,7 +484,10 @@ def main():
         rets.append( r )
 
         # Read Graphics
-        fastqs = ' '.join( glob.glob( os.path.join( cmd_args['trim_outdir'], '*.fastq' ) ) )
+        fastqs = ' '.join(
+            glob.glob( os.path.join( cmd_args['trim_outdir'], '*.fastq' ) ) +
+            glob.glob( os.path.join( cmd_args['trim_outdir'], '*.fastq.gz' ) )
+        )
         cmd = 'fqstats -o {0}.reads.png {1}'.format(cmd_args['bamfile'].replace('.bam',''),fastqs)
         p = run_cmd( cmd, stdout=lfile, stderr=subprocess.STDOUT )
         r = p.wait()
@@ -2,6 +2,8 @@ from subprocess import Popen, PIPE
 import numpy as np
 import itertools
 import re
+import string
+from collections import namedtuple
 
 def view( infile, *args, **kwargs ):
     '''
@@ -59,36 +61,84 @@ class Prop(object):
     def __set__( self, obj, val ):
         obj.__dict__[self.name] = self.type(val)
 
+class LazyProp(object):
+    '''
+    Defines a property for classes with __slots__ that reads field index of the
+    raw fields list(obj._fields)
+
+    If type is given the raw value is converted only the first time it is accessed and
+    kept in the slot named slot. Setting the property converts the value right away and
+    also updates the raw field so the object can still be turned back into a string
+    '''
+    def __init__( self, index, type=None, slot=None ):
+        self.index = index
+        self.type = type
+        self.slot = slot
+
+    def __get__( self, obj, objtype=None ):
+        if obj is None:
+            return self
+        if self.type is None:
+            return obj._fields[self.index]
+        try:
+            return getattr( obj, self.slot )
+        except AttributeError:
+            value = self.type( obj._fields[self.index] )
+            setattr( obj, self.slot, value )
+            return value
+
+    def __set__( self, obj, val ):
+        if self.type is not None:
+            val = self.type( val )
+            setattr( obj, self.slot, val )
+        obj._fields[self.index] = str( val )
+
 class SamRow(object):
     '''
     Represents a single sam row
     
     Object is instantiated by supplying it with a valid sam row string
+    Fields are only converted when they are accessed and then only once
 
     @param samrow_str - Sam row string
     '''
-    FLAG = Prop( 'FLAG', int )
-    MAPQ = Prop( 'MAPQ', int )
-    POS = Prop( 'POS', int )
-    TLEN = Prop( 'TLEN', int )
-    PNEXT = Prop( 'PNEXT', int )
+    __slots__ = ( '_fields', '_tags', '_FLAG', '_MAPQ', '_POS', '_TLEN', '_PNEXT', '_QUAL', '_TAGS' )
+
+    QNAME = LazyProp( 0 )
+    FLAG = LazyProp( 1, int, '_FLAG' )
+    RNAME = LazyProp( 2 )
+    POS = LazyProp( 3, int, '_POS' )
+    MAPQ = LazyProp( 4, int, '_MAPQ' )
+    CIGAR = LazyProp( 5 )
+    RNEXT = LazyProp( 6 )
+    PNEXT = LazyProp( 7, int, '_PNEXT' )
+    TLEN = LazyProp( 8, int, '_TLEN' )
+    SEQ = LazyProp( 9 )
+    _qual = LazyProp( 10 )
 
     def __init__( self, samrow_str ):
         # Only split up to 11 times. The last element will be all the tags if they are there at all
         parts = samrow_str.rstrip().split( '\t', 11 )
         if len( parts ) == 12:
-            self.QNAME, self.FLAG, self.RNAME, self.POS, self.MAPQ, self.CIGAR, \
-                self.RNEXT, self.PNEXT, self.TLEN, self.SEQ, self._qual, self._tags = parts
-        else:
-            self.QNAME, self.FLAG, self.RNAME, self.POS, self.MAPQ, self.CIGAR, \
-                self.RNEXT, self.PNEXT, self.TLEN, self.SEQ, self._qual = parts
+            self._tags = parts.pop()
+        elif len( parts ) == 11:
             self._tags = ''
+        else:
+            raise ValueError( "{0} is not a valid sam row".format(samrow_str) )
+        self._fields = parts
 
     @property
     def TAGS( self ):
         '''
         Returns python objects for each flag type
+        Only parsed again if _tags has changed
         '''
+        try:
+            tagstr, t = self._TAGS
+            if tagstr is self._tags:
+                return t
+        except AttributeError:
+            pass
         tags = re.findall( '([A-Za-z]{2}):([AifZHB]):(\S+)', self._tags )
         t = []
         for name,typ,val in tags:
@@ -108,7 +158,8 @@ class SamRow(object):
                 raise ValueError("{0} is not a supported field type".format(typ))
 
             t.append( (name,value) )
-            
+
+        self._TAGS = (self._tags, t)
         return t
 
     @property
@@ -116,11 +167,14 @@ class SamRow(object):
         '''
         Returns the quality scores as a list of integers
         '''
-        return [char_to_qual(c) for c in self._qual]
+        try:
+            return self._QUAL
+        except AttributeError:
+            self._QUAL = [char_to_qual(c) for c in self._qual]
+            return self._QUAL
 
     def __str__( self ):
-        s = '{QNAME}\t{FLAG}\t{RNAME}\t{POS}\t{MAPQ}\t{CIGAR}\t{RNEXT}' \
-                '\t{PNEXT}\t{TLEN}\t{SEQ}\t{_qual}'.format(**self.__dict__)
+        s = '\t'.join( self._fields )
         if self._tags:
             s += '\t'+self._tags
         return s
@@ -152,37 +206,72 @@ def mpileup( bamfile, regionstr=None, minmq=20, minbq=25, maxd=100000 ):
     # Return the stdout file descriptor handle so it can be easily iterated
     return p.stdout
 
-def nogap_mpileup(*args, **kwargs):
+class PileupGap(namedtuple('PileupGap', ['ref', 'start', 'end'])):
     '''
-    Wrapper around mpileup that fills in missing positions with 0 depth
-    Arguments are the same as mplileup
+    A run of reference positions start through end(1 based, inclusive) that
+    have no pileup column(0 depth)
 
-    Returns a generator of mpileup rows
+    Runs are only expanded into per position rows when something needs them
+    '''
+    __slots__ = ()
+
+    depth = 0
+
+    @property
+    def length( self ):
+        return self.end - self.start + 1
+
+    def positions( self ):
+        ''' Returns an iterator over every position in the run '''
+        return xrange(self.start, self.end + 1)
+
+    def rows( self ):
+        ''' Generates a 0 depth mpileup row for every position in the run '''
+        for i in self.positions():
+            yield '{0}\t{1}\t\t0\t\t\t'.format(self.ref, i)
+
+def gap_mpileup(*args, **kwargs):
+    '''
+    Wrapper around mpileup that yields a PileupGap for every run of positions
+    that are missing between rows
+    Arguments are the same as mpileup
+
+    Only gaps in front of or between rows of a reference can be found since the
+    reference lengths are not known from mpileup output
+
+    Returns a generator of mpileup rows and PileupGap
     '''
     lastref = None
     lastpos = 0
     for pile in mpileup(*args, **kwargs):
-        col = pile.split('\t')
+        col = pile.split('\t', 2)
         refname = col[0]
         pos = int(col[1])
-        # First iteration
-        if lastref is None:
-            lastref = refname
-        elif lastref != refname:
+        if lastref != refname:
             # New reference
             lastref = refname
             lastpos = 0
 
-        # yield all blank rows needed
-        for i in range(lastpos+1, pos):
-            row = '{0}\t{1}\t\t0\t\t\t'.format(
-                refname, i
-            )
-            yield row
+        if pos > lastpos + 1:
+            yield PileupGap(refname, lastpos + 1, pos - 1)
 
         yield pile
         lastpos = pos
 
+def nogap_mpileup(*args, **kwargs):
+    '''
+    Wrapper around mpileup that fills in missing positions with 0 depth
+    Arguments are the same as mplileup
+
+    Returns a generator of mpileup rows
+    '''
+    for pile in gap_mpileup(*args, **kwargs):
+        if isinstance(pile, PileupGap):
+            for row in pile.rows():
+                yield row
+        else:
+            yield pile
+
 def char_to_qual( qual_char ):
     '''
     Converts a given quality character to the phred - 33 integer
@@ -193,6 +282,96 @@ def char_to_qual( qual_char ):
     '''
     return ord( qual_char ) - 33
 
+# Number of possible quality values(phred 0 through 93 which is ~)
+QUAL_BINS = 94
+
+def qual_counts( quals ):
+    '''
+        Builds a quality histogram for a list of quality values
+
+        @param quals - iterable of integer quality values(0-93)
+
+        @returns numpy array of length QUAL_BINS where each index is a quality
+        value and the value is how many times it was in quals
+    '''
+    return np.bincount( np.asarray( quals, dtype=np.intp ), minlength=QUAL_BINS )
+
+# Read starts(with their mapping quality), read ends and indels with their length
+_BASES_MARKERS = re.compile( r'\^.|\$|[+-](\d*)' )
+# Translation tables that upper case bases and replace . and , with the reference base
+_BASES_TABLES = {}
+
+def _bases_table( refbase ):
+    ''' Cached translation table for refbase '''
+    try:
+        return _BASES_TABLES[refbase]
+    except KeyError:
+        table = string.maketrans(
+            string.ascii_lowercase + '.,',
+            string.ascii_uppercase + refbase * 2
+        )
+        _BASES_TABLES[refbase] = table
+        return table
+
+def decode_bases( bases, refbase ):
+    '''
+        Decodes an mpileup bases string into just the bases that are of interest
+        Read starts(^ and the mapping quality after it), read ends($) and indels(+/-,
+        their length and the inserted/deleted bases) are removed, bases are upper cased and
+        . and , are replaced with refbase. * which indicates a deletion is kept.
+
+        @param bases - mpileup bases column
+        @param refbase - reference base
+
+        @returns the decoded bases string
+    '''
+    if '+' in bases or '-' in bases:
+        # Indels are rare, but the bases after them can only be skipped by their length
+        parts = []
+        i = 0
+        m = _BASES_MARKERS.search( bases )
+        while m:
+            parts.append( bases[i:m.start()] )
+            i = m.end()
+            if m.group(1):
+                i += int( m.group(1) )
+            m = _BASES_MARKERS.search( bases, i )
+        parts.append( bases[i:] )
+        cleaned = ''.join( parts )
+    else:
+        cleaned = _BASES_MARKERS.sub( '', bases )
+    if len(refbase) == 1:
+        return cleaned.translate( _bases_table(refbase) )
+    return cleaned.upper().replace( '.', refbase ).replace( ',', refbase )
+
+# Flat arrays for many pileup columns. Values for column i are [offsets[i]:offsets[i+1]]
+PileupArrays = namedtuple( 'PileupArrays', ['offsets', 'bases', 'bquals', 'mquals'] )
+
+def decode_columns( columns ):
+    '''
+        Decodes many pileup columns at once into flat numpy arrays
+
+        Mapping qualities of columns that do not have usable mapping qualities(see
+        MPileupColumn.mquals) are 0 just like MPileupColumn.__iter__ fills them
+
+        @param columns - iterable of mpileup strings or MPileupColumn like objects
+
+        @returns PileupArrays where offsets has an extra item at the end and bases is
+        uint8 ascii values
+    '''
+    cols = [c if isinstance(c, MPileupColumn) else MPileupColumn(c) for c in columns]
+    bases = [c.bases for c in cols]
+    offsets = np.zeros( len(cols) + 1, dtype=np.intp )
+    np.cumsum( [len(b) for b in bases], out=offsets[1:] )
+    bquals = ''.join( [c.bqual_str() for c in cols] )
+    mquals = ''.join( [c.mqual_str().ljust( len(b), '!' ) for c, b in itertools.izip( cols, bases )] )
+    return PileupArrays(
+        offsets,
+        np.frombuffer( ''.join( bases ), dtype=np.uint8 ),
+        np.frombuffer( bquals, dtype=np.uint8 ).astype( int ) - 33,
+        np.frombuffer( mquals, dtype=np.uint8 ).astype( int ) - 33
+    )
+
 class MPileupColumn(object):
     '''
     Represents a single Mpileup column
@@ -204,36 +383,28 @@ class MPileupColumn(object):
     It is assumed that minimum base quality and mapping quality have already been applied to the mpileup string that is 
     provided to the constructor.
 
+    Fields are only converted when they are accessed and then only once, so the lists
+    returned by bquals and mquals are shared by every caller and should not be modified
+
     @param mpileup_str - Mpileup string
     '''
-    _bases = ''
-    _mquals = ''
-    _bquals = ''
-    def __init__( self, mpileup_str ):
-        parts = mpileup_str.rstrip('\n').split('\t')
-        if len(parts) == 7:
-            self.ref,self.pos,self.refbase,self.depth,self._bases,self._bquals,self._mquals = parts
-        else:
-            self.ref,self.pos,self.refbase,self.depth,self._bases,self._bquals = parts
-            self._mquals = ''
+    __slots__ = ( '_fields', '_pos', '_depth', '_decoded', '_bqual_list', '_mqual_list' )
 
-    @property
-    def depth( self ):
-        return self.__dict__['depth']
-    
-    @depth.setter
-    def depth( self, value ):
-        ''' Depth is an integer '''
-        self.__dict__['depth'] = int(value)
+    ref = LazyProp( 0 )
+    pos = LazyProp( 1, int, '_pos' )
+    refbase = LazyProp( 2 )
+    depth = LazyProp( 3, int, '_depth' )
+    _bases = LazyProp( 4 )
+    _bquals = LazyProp( 5 )
+    _mquals = LazyProp( 6 )
 
-    @property
-    def pos( self ):
-        return self.__dict__['pos']
-    
-    @pos.setter
-    def pos( self, value ):
-        ''' Position is an integer '''
-        self.__dict__['pos'] = int(value)
+    def __init__( self, mpileup_str ):
+        parts = mpileup_str.rstrip('\n').split('\t')
+        if len(parts) == 6:
+            parts.append( '' )
+        elif len(parts) != 7:
+            raise ValueError( "{0} is not a valid mpileup row".format(mpileup_str) )
+        self._fields = parts
 
     @property
     def bases( self ):
@@ -241,54 +412,42 @@ class MPileupColumn(object):
             Returns the bases with the inserts, deletions, $ and ^qual removed.
             This means it returns just the bases that are really of interest.
             it also includes the * which indicates a deletion.
+            The bases are only decoded the first time(see decode_bases)
         '''
-        # Will contain the cleaned base
-        cleaned = ''
-        # The counter
-        i = 0
-        # Iterate every position
-        while i < len( self._bases ):
-            x = self._bases[i]
-            # Just skip - and +
-            if x in '-+$':
-                i += 1
-                continue
-            # Skip this position and the next quality scores
-            if x == '^':
-                i += 2
-                continue
-            # Add any normal base, but make it uppercase
-            if x.upper() in ('ACTGN*'):
-                cleaned += x.upper()
-                i += 1
-            # . and , mean a match to the reference base
-            elif x in ('.,'):
-                cleaned += self.refbase
-                i += 1
-            # We are on an indel number now so can just skip them
-            else:
-                try:
-                    # Build the integer that will tell us how many
-                    # indel bases to skip
-                    n = ''
-                    while True:
-                        # Just try it if it fails the try except will grab it
-                        int(x)
-                        n += x
-                        # Increment i
-                        i += 1
-                        # Get new base
-                        x = self._bases[i]
-                except ValueError as e:
-                    i += int( n )
-        return cleaned
+        try:
+            return self._decoded
+        except AttributeError:
+            self._decoded = decode_bases( self._bases, self.refbase )
+            return self._decoded
+
+    def bqual_str( self ):
+        ''' Returns the base qualities as phred + 33 characters '''
+        return self._bquals
+
+    def mqual_str( self ):
+        '''
+            Returns the mapping qualities as phred + 33 characters
+            See mquals for how they are truncated
+        '''
+        # Check to make sure map qual len is same as base qual length
+        if len(self._bquals) == len(self._mquals):
+            return self._mquals
+        # Otherwise we can only proceed if all items are the same
+        elif len(set(self._mquals)) == 1:
+            return self._mquals[:len(self._bquals)]
+        else:
+            return ''
 
     @property
     def bquals( self ):
         '''
             Returns the base qualities as a phred - 33 integer
         '''
-        return map(char_to_qual, self._bquals)
+        try:
+            return self._bqual_list
+        except AttributeError:
+            self._bqual_list = map(char_to_qual, self.bqual_str())
+            return self._bqual_list
 
     @property
     def mquals( self ):
@@ -301,15 +460,11 @@ class MPileupColumn(object):
             all the values are not the same since there would be no way to tell what qual values
             match what bases.
         '''
-        # Check to make sure map qual len is same as base qual length
-        if len(self._bquals) == len(self._mquals):
-            return map(char_to_qual, self._mquals)
-        # Otherwise we can only proceed if all items are the same
-        elif len(set(self._mquals)) == 1:
-            l = len(self._bquals)
-            return map(char_to_qual, self._mquals[:l])
-        else:
-            return []
+        try:
+            return self._mqual_list
+        except AttributeError:
+            self._mqual_list = map(char_to_qual, self.mqual_str())
+            return self._mqual_list
 
     def bqual_avg( self ):
         ''' Returns the mean of the base qualities rounded to 2 places '''
@@ -357,9 +512,41 @@ class MPileupColumn(object):
 
         return stats
 
+    def base_counts( self ):
+        '''
+        Same as base_stats except that instead of a list of base qualities each base
+        gets a quality histogram(see qual_counts) which stays the same size no matter
+        how deep the column is. Mapping qualities are only kept as mqualsum
+
+            * depth: Total depth of this column which should be self.depth
+            * bqualsum: sum of the base qualities
+            * mqualsum: sum of the mapping qualities
+            * 'A/C/T/G/N/\*': dictionary with a single baseq key
+                * baseq: numpy array where index is base quality and value is how many
+                  of this base had that quality
+
+        @returns the stats dictionary
+        '''
+        bquals = self.bquals
+        mquals = self.mquals
+        bases = self.bases
+        assert len(bquals) == self.depth, "Somehow length of bases != length of Base Qualities"
+        stats = {
+            'depth': self.depth,
+            'mqualsum': float( sum( mquals ) ),
+            'bqualsum': float( sum( bquals ) )
+        }
+        if not bases:
+            return stats
+        bases = np.fromstring( bases, dtype=np.uint8 )
+        bquals = np.asarray( bquals, dtype=np.intp )
+        for b in np.unique( bases ):
+            stats[chr(b)] = {'baseq': qual_counts( bquals[bases == b] )}
+        return stats
+
     def __str__( self ):
         ''' Returns the mpileup string '''
-        return "{ref}\t{pos}\t{refbase}\t{depth}\t{_bases}\t{_bquals}\t{_mquals}".format(**self.__dict__)
+        return '\t'.join( self._fields )
 
 # Exception for when invalid region strings are given
 class InvalidRegionString(Exception): pass
@@ -51,7 +51,7 @@ import argparse
 import sys
 import itertools
 from compat import OrderedDict
-from ngs_mapper import samtools
+from ngs_mapper import pileup
 
 def main():
     args = parse_args()
@@ -130,12 +130,10 @@ def stats_at_pos( bamfile, regionstr, minmq, minbq, maxd ):
     return base_stats
 
 def stats( bamfile, regionstr, minmq, minbq, maxd ):
-    out = samtools.mpileup( bamfile, regionstr, minmq, minbq, maxd )
+    out = pileup.columns( bamfile, regionstr, minmq, minbq, maxd )
     
     try:
-        o = out.next()
-        col = samtools.MPileupColumn( o )
-        out.close()
+        col = next( out )
         return col.base_stats()
     except StopIteration:
         return {
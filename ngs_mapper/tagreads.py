@@ -2,10 +2,17 @@ import argparse
 import sys
 import samtools
 import re
+import string
 import shutil
 import os.path
+from subprocess import Popen, PIPE
 from ngs_mapper.bam import sortbam, indexbam
 
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
 import log
 logger = log.setup_logger('tagreads',log.get_config())
 
@@ -86,67 +93,183 @@ def tag_reads( bam, hdr ):
     '''
         Sets header of bam and tags all reads appropriately for each platform
         Overwrites existing header
+
+        Reads are tagged in a single streaming pass that writes a new compressed bam
+        next to bam that then replaces it. Tagging never changes the order of the reads
+        so a coordinate sorted bam is only indexed again instead of being sorted again
         
         @param bam - Bam file to tag reads in
         @param hdr - Header string to set in the bam(needs newline at the end)
     '''
-    # Open the existing bam to fetch the reads to modify from
-    untagged_bam = samtools.view( bam )
-    # Open a file to write the sam output to with the tagged reads
-    samf = bam.replace('.bam','.sam')
-    with open( samf, 'w' ) as sam:
-        # Write the hdr to the file first
-        sam.write( hdr )
-        # Tag the reads
-        logger.info( "Tagging reads for {0}".format(bam) )
-        for read in untagged_bam:
-            samrow = samtools.SamRow(read)
-            read = tag_readgroup( samrow )
-            sam.write( str(read) + '\n' )
-    # Close stdout
-    untagged_bam.close()
+    tagged = bam + '.tagging'
+    logger.info( "Tagging reads for {0}".format(bam) )
+    if pysam is not None:
+        stream_tag_pysam( bam, hdr, tagged )
+    else:
+        stream_tag_samtools( bam, hdr, tagged )
     logger.info( "Finished tagging reads for {0}".format(bam) )
-    logger.info( "Sorting {0}".format(bam) )
-    b = samtools.view( samf, h=True, S=True, b=True )
-    sortbam( b, bam )
-    # Close the fh
-    b.close()
-    # Remove temp sam file
-    # maybe some day could even just use pipes all the way through :)
-    os.unlink( samf )
+    if is_coordinate_sorted( hdr ):
+        os.rename( tagged, bam )
+    else:
+        logger.info( "Sorting {0}".format(bam) )
+        sortbam( tagged, bam )
+        os.unlink( tagged )
     logger.info( "Indexing {0}".format(bam) )
-    indexbam( bam )
+    if pysam is not None:
+        pysam.index( bam )
+    else:
+        indexbam( bam )
+
+def is_coordinate_sorted( hdr ):
+    ''' Does the @HD line of the sam header hdr say it is coordinate sorted '''
+    for line in hdr.splitlines():
+        if line.startswith( '@HD' ):
+            return 'SO:coordinate' in line.split( '\t' )
+    return False
+
+def stream_tag_pysam( bam, hdr, outbam ):
+    '''
+        Writes every read in bam to outbam with hdr as the header and each read
+        tagged with its read group using pysam
+
+        Tags are only added to reads that do not already have a read group and
+        supplementary reads are skipped just like tag_read
+
+        @param bam - Bam file to read from
+        @param hdr - Header string for outbam
+        @param outbam - Path to write the tagged bam to
+    '''
+    inbam = pysam.AlignmentFile( bam, 'rb', check_sq=False )
+    out = pysam.AlignmentFile( outbam, 'wb', text=hdr )
+    try:
+        for read in inbam.fetch( until_eof=True ):
+            if read.flag < 2048 and not read.has_tag( 'RG' ):
+                read.set_tag( 'RG', classify_qname( read.query_name ), 'Z' )
+            out.write( read )
+    finally:
+        out.close()
+        inbam.close()
+
+def stream_tag_samtools( bam, hdr, outbam ):
+    '''
+        Same as stream_tag_pysam but pipes samtools view output through tag_readgroup
+        straight into samtools view -Sb
+
+        @param bam - Bam file to read from
+        @param hdr - Header string for outbam
+        @param outbam - Path to write the tagged bam to
+    '''
+    untagged_bam = samtools.view( bam )
+    p = Popen( ['samtools', 'view', '-Sb', '-o', outbam, '-'], stdin=PIPE )
+    p.stdin.write( hdr )
+    for read in untagged_bam:
+        samrow = samtools.SamRow( read )
+        read = tag_readgroup( samrow )
+        p.stdin.write( str(read) + '\n' )
+    untagged_bam.close()
+    p.stdin.close()
+    if p.wait() != 0:
+        raise ValueError( "samtools could not write {0}".format(outbam) )
 
 def get_rg_for_read( aread ):
     ''' Gets the read group name for the given samtools.SamRow '''
-    rname = aread.QNAME
+    return classify_qname( aread.QNAME )
+
+# Every digit becomes 0 in a read name's cache key
+DIGIT_TABLE = string.maketrans( string.digits, '0' * len(string.digits) )
+
+class ReadGroupCache(object):
+    '''
+        Remembers the read group that was picked for read names that have the same
+        prefix(text before the first :) so only names from a new run or chip have to be
+        matched against ID_MAP
+
+        The part after the prefix is kept in the key with every digit made 0. None
+        of the ID_MAP patterns tell one digit from another so names with the same key
+        always get the same read group, while the x/y coordinates of MiSeq and
+        IonTorrent names only make a handful of keys per run
+
+        Names without a : (Roche454 and Sanger) are not cached since Roche454 is
+        matched by the first pattern already
+
+        When maxsize keys have been cached the cache is emptied and starts over
+    '''
+    def __init__( self, maxsize=1024 ):
+        self.maxsize = maxsize
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key( self, qname ):
+        ''' Key for qname or None if it cannot be cached '''
+        prefix, sep, rest = qname.partition( ':' )
+        if not sep:
+            return None
+        return prefix + ':' + rest.translate( DIGIT_TABLE )
+
+    def __call__( self, qname ):
+        key = self.key( qname )
+        try:
+            rg = self.cache[key]
+            self.hits += 1
+            return rg
+        except KeyError:
+            pass
+        self.misses += 1
+        rg = get_rg_for_name( qname )
+        if key is not None:
+            if len( self.cache ) >= self.maxsize:
+                self.cache.clear()
+            self.cache[key] = rg
+        return rg
+
+# Read group classifier used for every read that is tagged
+classify_qname = ReadGroupCache()
+
+def get_rg_for_name( rname ):
+    ''' Gets the read group name for the given read name '''
     for i, p in enumerate( ID_MAP ):
         if p.match( rname ):
             return IDS[i]
     raise UnknownReadNameFormat( "{0} is from an unknown platform and cannot be tagged".format(rname) )
 
+def rg_line( id, SM, CN=None ):
+    '''
+        Builds the @RG header line for the read group id
+
+        @param id - Read group id(one of IDS)
+        @param SM - Sample name
+        @param CN - Sequencing center. Left out when None
+
+        @returns @RG line without a newline
+    '''
+    pl = PLATFORMS[IDS.index( id )]
+    rg = '@RG\tID:{0}\tSM:{1}\t'.format( id, SM )
+    if CN is not None:
+        rg += 'CN:{0}\t'.format( CN )
+    return rg + 'PL:{0}'.format( pl )
+
 def get_rg_headers( bam, SM=None, CN=None ):
     old_header = get_bam_header( bam ) + '\n'
 
-    for id, pl in zip( IDS, PLATFORMS ):
+    for id in IDS:
         # Skip headers that exist already
         if 'ID:{0}\t'.format(id) in old_header:
             continue
 
-        rg = '@RG\tID:{0}\tSM:{1}\t'
         if SM is None:
             SM = os.path.basename(bam).replace( '.bam', '' )
 
-        if CN is not None:
-            rg += 'CN:{2}\tPL:{3}'
-            old_header += rg.format( id, SM, CN, pl ) + '\n'
-        else:
-            rg += 'PL:{2}'
-            old_header += rg.format( id, SM, pl ) + '\n'
+        old_header += rg_line( id, SM, CN ) + '\n'
 
     return old_header
 
 def get_bam_header( bam ):
+    if pysam is not None:
+        inbam = pysam.AlignmentFile( bam, 'rb', check_sq=False )
+        hdr = str( inbam.text )
+        inbam.close()
+        return hdr.rstrip()
     r = samtools.view( bam, H=True )
     hdr = r.read()
     r.close()
@@ -4,6 +4,7 @@ import os
 from os.path import *
 from . import tdir
 import subprocess
+from nose.plugins.skip import SkipTest
 from ngs_mapper import compat
 
 class BaseTester(object):
@@ -116,6 +117,12 @@ class BaseBaseCaller(BaseClass):
         self.vcf = join( fixpath, 'test.vcf' )
         self.template = join( fixpath, 'template.vcf' )
 
+    def require_engine( self ):
+        ''' Skips tests that need the in-process pileup engine(pysam) '''
+        from ngs_mapper import pileup
+        if pileup.pysam is None:
+            raise SkipTest('pysam is not installed')
+
 def make_seqrec( seq, quals, id='id' ):
     from Bio.SeqRecord import SeqRecord
     from Bio.Seq import Seq
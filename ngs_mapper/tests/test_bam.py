@@ -80,6 +80,27 @@ class TestUnitSortBam(Base):
         else:
             assert False, "Did not raise value error on invalid output file"
 
+@patch('ngs_mapper.bam.subprocess.Popen')
+class TestUnitSortSam(Base):
+    functionname = 'sortsam'
+
+    def test_pipes_view_into_sort(self, popen_mock):
+        from subprocess import PIPE
+        view, sort = Mock(), Mock()
+        popen_mock.side_effect = [view, sort]
+        sam = Mock(spec=file)
+        res = self._C( sam, 'out.bam', 4, '1G' )
+        eq_( [
+            call(['samtools','view','-Sbu','-'],stdin=sam,stdout=PIPE),
+            call(['samtools','sort','-@','4','-m','1G','-f','-','out.bam'],stdin=view.stdout)
+        ], popen_mock.call_args_list )
+        eq_( (view, sort), res )
+        view.stdout.close.assert_called_once_with()
+
+    def test_default_memory(self, popen_mock):
+        res = self._C( Mock(spec=file), 'out.bam' )
+        eq_( ['samtools','sort','-@','1','-f','-','out.bam'], popen_mock.call_args_list[1][0][0] )
+
 @patch('ngs_mapper.bam.subprocess.Popen')
 @patch('__builtin__.open')
 class TestUnitSamToBam(Base):
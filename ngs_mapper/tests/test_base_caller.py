@@ -1,6 +1,8 @@
 from imports import *
 import re
-from ngs_mapper.samtools import InvalidRegionString
+from ngs_mapper.samtools import InvalidRegionString, qual_counts
+import numpy as np
+from mock import ANY
 
 from ngs_mapper.base_caller import VCF_HEAD
 
@@ -50,15 +52,20 @@ class Base( common.BaseBaseCaller ):
             ]
         return get_mpileup_region
 
+    def counts(self, quals):
+        ''' Quality histogram for a list of qualities '''
+        return qual_counts(quals)
+
+    def quals(self, counts):
+        ''' Sorted list of qualities from a quality histogram '''
+        return np.repeat(np.arange(len(counts)), counts).tolist()
+
     def make_stats(self, base_stats):
+        ''' Builds a base_counts stats dictionary from lists of base qualities '''
         stats = {}
         for k,v in base_stats.items():
             stats[k] = {}
-            stats[k]['baseq'] = v['baseq']
-            if 'mapq' not in stats[k]:
-                stats[k]['mapq'] = v['baseq']
-            else:
-                stats[k]['mapq'] = v['mapq']
+            stats[k]['baseq'] = self.counts(v['baseq'])
 
         self.update_stats(stats)
 
@@ -74,12 +81,10 @@ class Base( common.BaseBaseCaller ):
         # Sum everything
         for k,v in stats.items():
             if k not in nonbasekeys:
-                stats['depth'] += len(v['baseq'])
-                stats['bqualsum'] += sum(v['baseq'])
-                if 'mapq' not in v:
-                    stats['mqualsum'] += sum(v['baseq'])
-                else:
-                    stats['mqualsum'] += sum(v['mapq'])
+                quals = self.quals(v['baseq'])
+                stats['depth'] += len(quals)
+                stats['bqualsum'] += sum(quals)
+                stats['mqualsum'] += sum(quals)
 
         return stats
 
@@ -120,13 +125,45 @@ class TestHpolyList(Hpoly):
         r = self.make_list(r)
         eq_({'ref':self.hlist[1:]}, r)
 
+class TestHpolyIndex(Hpoly):
+    functionname = 'hpoly_index'
+
+    def test_marks_positions(self):
+        r = self._C(self.seqs, 3)
+        # Index 0 is never used since positions are 1 based
+        e = [False] + [True]*3 + [False] + [True]*4 + [False] + [True]*5
+        eq_(e, list(r['ref']))
+
+    def test_minlength(self):
+        r = self._C(self.seqs, 5)
+        e = [False]*10 + [True]*5
+        eq_(e, list(r['ref']))
+
+class TestSaveHpolyIndex(Hpoly):
+    functionname = 'save_hpoly_index'
+
+    def test_loads_same_index(self):
+        from ngs_mapper.base_caller import hpoly_index, load_hpoly_index
+        self._C(self.ref, self.ref + '.hpoly.npz')
+        r = load_hpoly_index(self.ref)
+        eq_(['ref'], r.keys())
+        eq_(list(hpoly_index(self.seqs, 3)['ref']), list(r['ref']))
+
+    def test_not_saved(self):
+        from ngs_mapper.base_caller import load_hpoly_index
+        eq_(None, load_hpoly_index(self.ref))
+
 class TestIsHpoly(Hpoly):
     functionname = 'is_hpoly'
 
     def setUp( self ):
         super( TestIsHpoly, self ).setUp()
-        from ngs_mapper.base_caller import hpoly_list
-        self.hpoly = hpoly_list( self.seqs, 3 )
+        from ngs_mapper.base_caller import hpoly_index
+        self.hpoly = hpoly_index( self.seqs, 3 )
+
+    def test_past_end_of_reference(self):
+        ok_(not self._C(self.hpoly, 'ref', 15))
+        ok_(not self._C(self.hpoly, 'ref', 100))
 
     def test_(self):
         ok_(self._C(self.hpoly, 'ref', 1))
@@ -161,7 +198,10 @@ class TestUnitBiasHQ(StatsBase):
     def test_no_highquality(self):
         r = self._C(self.stats)
         for k,v in self.stats.items():
-            eq_(v, r[k])
+            if k not in ('depth','mqualsum','bqualsum'):
+                eq_(self.quals(v['baseq']), self.quals(r[k]['baseq']))
+            else:
+                eq_(v, r[k])
 
     def do_depth(self, stats, bias):
         if stats is None:
@@ -170,9 +210,9 @@ class TestUnitBiasHQ(StatsBase):
         r = self._C(stats, 1, bias)
         for k,v in stats.items():
             if k not in ('depth','mqualsum','bqualsum'):
-                ebaseq = v['baseq']*int(bias)
-                rbaseq = r[k]['baseq']
-                eq_(ebaseq, r[k]['baseq'], 
+                ebaseq = self.quals(v['baseq'])*int(bias)
+                rbaseq = self.quals(r[k]['baseq'])
+                eq_(sorted(ebaseq), rbaseq, 
                     "Len of base {0} should be {1} but got {2}".format(k, len(ebaseq), len(rbaseq))
                )
         # Verify depth is updated
@@ -184,15 +224,16 @@ class TestUnitBiasHQ(StatsBase):
             yield self.do_depth, None, i
 
     def test_biasth_works(self):
-        self.stats = {
+        self.stats = self.make_stats({
             'A': {'baseq': [1,10,20,30,40,50,60] },
-            'depth': 7
-        }
-        self.update_stats(self.stats)
+        })
         r = self._C(self.stats, 50, 2)
-        eq_(self.stats['A']['baseq'] + [50,60], r['A']['baseq'])
+        eq_([1,10,20,30,40,50,50,60,60], self.quals(r['A']['baseq']))
+        eq_(9, r['depth'])
         r = self._C(self.stats, 15, 2)
-        eq_(self.stats['A']['baseq'] + [20,30,40,50,60], r['A']['baseq'])
+        eq_([1,10,20,20,30,30,40,40,50,50,60,60], self.quals(r['A']['baseq']))
+        # Original stats are not modified
+        eq_([1,10,20,30,40,50,60], self.quals(self.stats['A']['baseq']))
 
     @raises(ValueError)
     def test_bias_is_zero(self):
@@ -214,39 +255,40 @@ class TestUnitMarkLQ(StatsBase):
         }
         stats = self.make_stats(base_stats)
         r = self._C(stats, 25, 10, 'T')
-        eq_(9, len(r['T']['baseq']))
+        eq_(9, len(self.quals(r['T']['baseq'])))
 
         # Now add an A as well just to make sure. Also puts us >= mind of 10
         base_stats['A'] = {'baseq':[16]}
         stats = self.make_stats(base_stats)
         r = self._C(stats, 25, 10, 'T')
-        eq_(4, len(r['T']['baseq']))
-        eq_(6, len(r['?']['baseq']))
+        eq_(4, len(self.quals(r['T']['baseq'])))
+        eq_(6, len(self.quals(r['?']['baseq'])))
 
     def test_minq_lt(self):
-        self.stats['A']['baseq'] = [23,24,25,26]
+        self.stats['A']['baseq'] = self.counts([23,24,25,26])
         r = self._C(self.stats, 25, 1, 'G')
-        eq_([23,24], r['?']['baseq'])
+        eq_([23,24], self.quals(r['?']['baseq']))
+        eq_([25,26], self.quals(r['A']['baseq']))
         r = self._C(self.stats, 25, 100, 'G')
-        eq_([23,24], r['N']['baseq'])
+        eq_([23,24], self.quals(r['N']['baseq']))
 
     def test_removes_empty_bases(self):
-        self.stats['A']['baseq'] = [10]*10
-        self.stats['C']['baseq'] = [10]*10
+        self.stats['A']['baseq'] = self.counts([10]*10)
+        self.stats['C']['baseq'] = self.counts([10]*10)
         r = self._C(self.stats, 25, 1, 'G')
         assert 'A' not in r, 'A was not removed even though it had all < minq baseq'
         assert 'C' not in r, 'C was not removed even though it had all < minq baseq'
-        eq_([10]*20, r['?']['baseq'])
+        eq_([10]*20, self.quals(r['?']['baseq']))
         r = self._C(self.stats, 25, 100, 'G')
-        eq_([10]*20, r['N']['baseq'])
+        eq_([10]*20, self.quals(r['N']['baseq']))
 
     def test_adds_n_single_base(self):
         # A - Depth 10, AQ - 20
-        self.stats['A']['baseq'] = [10,10] + [30]*6 + [10,10]
+        self.stats['A']['baseq'] = self.counts([10,10] + [30]*6 + [10,10])
         r = self._C(self.stats, 25, 1, 'G')
-        eq_([10]*4, r['?']['baseq'])
+        eq_([10]*4, self.quals(r['?']['baseq']))
         r = self._C(self.stats, 25, 100, 'G')
-        eq_([10]*4, r['N']['baseq'])
+        eq_([10]*4, self.quals(r['N']['baseq']))
 
     def test_ensure_depth_threshold(self):
         # Make sure if the depth is == mind everything still works
@@ -256,7 +298,7 @@ class TestUnitMarkLQ(StatsBase):
         })
         # A's should all get turned to ? because mind == depth is high coverage
         r = self._C(stats, 25, 10, 'G')
-        eq_(10, len(r['?']['baseq']))
+        eq_(10, len(self.quals(r['?']['baseq'])))
 
     def test_no_n(self):
         r = self._C(self.stats, 25, 1, 'G')
@@ -326,12 +368,10 @@ class TestUnitCaller(Base):
 			'mqualsum': 540.0,
 			'depth': 9,
 			'A': {
-                'baseq': [40, 40, 40, 40, 40, 40, 40, 40],
-                'mapq': [60, 60, 60, 60, 60, 60, 60, 60]
+                'baseq': self.counts([40, 40, 40, 40, 40, 40, 40, 40]),
             },
             'C': {
-                'baseq': [40],
-                'mapq': [60]
+                'baseq': self.counts([40]),
             }
         }
         r = self._C(stats, 25, 100000, 10, 0.8)
@@ -344,16 +384,13 @@ class TestUnitCaller(Base):
 			'mqualsum': 660.0,
 			'depth': 3,
             'A': {
-                'baseq': [40],
-                'mapq': [60]
+                'baseq': self.counts([40]),
             },
 			'G': {
-                'baseq': [40],
-                'mapq': [60]
+                'baseq': self.counts([40]),
             },
 			'T': {
-                'baseq': [40],
-                'mapq': [60]
+                'baseq': self.counts([40]),
             }
         }
         r = self._C(stats, 25, 10000, 10, 0.8)
@@ -438,12 +475,12 @@ class TestUnitCallOnPct(Base):
 
     def test_no_majority_returns_n_zero(self):
         stats = {
-            'A': { 'baseq': [40]*19 },
-            'C': { 'baseq': [40]*19 },
-            'G': { 'baseq': [40]*19 },
-            'T': { 'baseq': [40]*19 },
-            'N': { 'baseq': [40]*19 },
-            '*': { 'baseq': [40]*1 },
+            'A': { 'baseq': self.counts([40]*19) },
+            'C': { 'baseq': self.counts([40]*19) },
+            'G': { 'baseq': self.counts([40]*19) },
+            'T': { 'baseq': self.counts([40]*19) },
+            'N': { 'baseq': self.counts([40]*19) },
+            '*': { 'baseq': self.counts([40]*1) },
             'depth': 100
         }
         r = self._C(stats, 0.8)
@@ -540,7 +577,7 @@ class MpileBase(Base):
             stats = self.mock_stats()
         mpilemock.ref = ref
         mpilemock.pos = pos
-        mpilemock.base_stats.return_value = stats
+        mpilemock.base_counts.return_value = stats
 
 
 @patch('ngs_mapper.base_caller.MPileupColumn')
@@ -670,8 +707,8 @@ class TestUnitGenerateVcfRow(MpileBase):
         stats = self.mock_stats()
         # SHould keep depth at 100 and as it stands
         # ambiguous call which we can bias towards the N
-        stats['G'] = {'baseq': [50]*60}
-        stats['N'] = {'baseq': [40]*10}
+        stats['G'] = {'baseq': self.counts([50]*60)}
+        stats['N'] = {'baseq': self.counts([40]*10)}
         self.setup_mpileupcol(mpilecol, stats=stats)
         # biasth @ 50 will bias the G and bias @ 3 will make it
         # the majority at 180/220 = 82%
@@ -829,8 +866,8 @@ class TestUnitGenerateVcfRow(MpileBase):
         # as it is low quality
         stats = {
             'depth': 20,
-            'A': { 'baseq': [1]*10 },
-            'C': { 'baseq': [40]*10 },
+            'A': { 'baseq': self.counts([1]*10) },
+            'C': { 'baseq': self.counts([40]*10) },
             'mqualsum': 0,
             'bqualsum': 0
         }
@@ -845,8 +882,8 @@ class TestUnitGenerateVcfRow(MpileBase):
         # as it is low quality
         stats = {
             'depth': 20,
-            'A': { 'baseq': [1]*10 },
-            'C': { 'baseq': [40]*10 },
+            'A': { 'baseq': self.counts([1]*10) },
+            'C': { 'baseq': self.counts([40]*10) },
             'mqualsum': 0,
             'bqualsum': 0
         }
@@ -873,11 +910,10 @@ class TestUnitInfoStats(Base):
 
     def mock_stats2(self):
         ''' Every base and each base has length 20 with 40 quality so depth 100 '''
-        s = { 'baseq': [40]*20 }
         self.stats2 = {'depth':0}
         for b in 'ACGNT':
-            self.stats2['depth'] = len(s['baseq'])
-            self.stats2[b] = s.copy()
+            self.stats2['depth'] += 20
+            self.stats2[b] = { 'baseq': self.counts([40]*20) }
 
     def test_empty_result(self):
         self.stats2 = {
@@ -885,7 +921,7 @@ class TestUnitInfoStats(Base):
             'bqualsum': 6000,
             'depth': 100,
             'A': {
-                'baseq': [40]*100,
+                'baseq': self.counts([40]*100),
             }
         }
         r = self._C(self.stats2, 'A')
@@ -903,11 +939,11 @@ class TestUnitInfoStats(Base):
 
     def test_ensure_expected(self):
         ''' Order of the bases must be preserved '''
-        self.stats2['A']['baseq'] = [40]*200
-        self.stats2['C']['baseq'] = [39]*200
-        self.stats2['G']['baseq'] = [38]*42
-        self.stats2['N']['baseq'] = [37]*58
-        self.stats2['T']['baseq'] = [36]*500
+        self.stats2['A']['baseq'] = self.counts([40]*200)
+        self.stats2['C']['baseq'] = self.counts([39]*200)
+        self.stats2['G']['baseq'] = self.counts([38]*42)
+        self.stats2['N']['baseq'] = self.counts([37]*58)
+        self.stats2['T']['baseq'] = self.counts([36]*500)
         self.stats2['depth'] = 1000
         r = self._C(self.stats2, 'A')
         rr = zip(r['AC'], r['PAC'], r['AAQ'], r['bases'])
@@ -922,12 +958,125 @@ class TestUnitInfoStats(Base):
         #eq_(['C','G','N','T'], r['bases'])
 
     def test_ensure_exclude_ref(self):
-        self.stats2['G']['baseq'] = [10]*20
+        self.stats2['G']['baseq'] = self.counts([10]*20)
         self.stats2['depth'] = 100
         r = self._C(self.stats2, 'G')
         eq_([40]*4, r['AAQ'])
         eq_(['A','C','N','T'], sorted(r['bases']))
 
+class TestUnitVCFWriter(Base):
+    functionname = 'VCFWriter'
+
+    def pyvcf_text(self, records):
+        ''' What vcf.Writer writes for the same records '''
+        import vcf
+        import StringIO
+        fh = StringIO.StringIO()
+        head = StringIO.StringIO(VCF_HEAD)
+        head.name = 'header.vcf'
+        w = vcf.Writer(fh, template=vcf.Reader(head))
+        for r in records:
+            w.write_record(vcf.model._Record(r.CHROM, r.POS, None, r.REF, r.ALT, None, None, r.INFO, None, None))
+        return fh.getvalue()
+
+    def records(self):
+        from ngs_mapper.base_caller import VCFRecord, blank_vcf_row
+        hpoly = blank_vcf_row('Ref1', 'ACGT', 2, 'N')
+        hpoly.INFO['HPOLY'] = True
+        return [
+            blank_vcf_row('Ref1', 'ACGT', 1),
+            hpoly,
+            VCFRecord('Ref1', 3, 'G', ['A','*'], {
+                'DP':20, 'RC':10, 'RAQ':40, 'PRC':50, 'AC':[5,5], 'AAQ':[30,20],
+                'PAC':[25,25], 'CBD':10, 'CB':'G'
+            }),
+            VCFRecord('Ref1', 4, 'T', '.', {}),
+            VCFRecord('Ref1', 5, 'T', ['C'], {'ZZ':1, 'AA':None, 'CB':'T', 'HPOLY':False}),
+            VCFRecord('Ref "2"', 1, 'A', '.', {'DP':0}),
+        ]
+
+    def test_same_as_pyvcf(self):
+        records = self.records()
+        fh = StringIO()
+        w = self._C(fh, VCF_HEAD)
+        w.write_records(records)
+        eq_(self.pyvcf_text(records), fh.getvalue())
+
+    def test_write_record(self):
+        records = self.records()
+        fh = StringIO()
+        w = self._C(fh, VCF_HEAD)
+        for r in records:
+            w.write_record(r)
+        eq_(self.pyvcf_text(records), fh.getvalue())
+
+    def test_format_records_no_header(self):
+        records = self.records()
+        w = self._C(None, VCF_HEAD)
+        text = w.format_records(records[:2]) + w.format_records(records[2:])
+        eq_(self.pyvcf_text(records).split(VCF_HEAD + '\n')[1], text)
+
+    def test_blank_run_same_as_records(self):
+        from ngs_mapper.base_caller import BlankRun, hpoly_index
+        refseq = 'ACCCGTTTTA'
+        hpoly = hpoly_index({'Ref1': Mock(seq=refseq)})['Ref1']
+        run = BlankRun('Ref1', 2, 9, refseq, hpoly, '-')
+        records = list(run.records())
+        eq_(range(2,10), [r.POS for r in records])
+        eq_([True]*3 + [False] + [True]*4, [r.INFO.get('HPOLY', False) for r in records])
+        w = self._C(None, VCF_HEAD)
+        eq_(self.pyvcf_text(records).split(VCF_HEAD + '\n')[1], w.format_records([run]))
+
+    def test_blank_run_without_hpoly(self):
+        from ngs_mapper.base_caller import BlankRun
+        run = BlankRun('Ref1', 1, 4, 'AAAA', None, 'N')
+        w = self._C(None, VCF_HEAD)
+        eq_(self.pyvcf_text(list(run.records())).split(VCF_HEAD + '\n')[1], w.format_records([run]))
+
+class TestUnitValidateVcf(Base):
+    functionname = 'validate_vcf'
+
+    def test_counts_records(self):
+        eq_(24, self._C(self.vcf))
+
+    @raises(Exception)
+    def test_invalid_vcf(self):
+        with open('bad.vcf', 'w') as fh:
+            fh.write(VCF_HEAD + '\n')
+            fh.write('Ref1\tnotapos\n')
+        self._C('bad.vcf')
+
+class TestUnitBatches(Base):
+    functionname = 'batches'
+
+    def test_batches(self):
+        eq_([[1,2],[3,4],[5]], list(self._C(iter([1,2,3,4,5]), 2)))
+
+    def test_empty(self):
+        eq_([], list(self._C([], 2)))
+
+class TestUnitRecordBatches(Base):
+    functionname = 'record_batches'
+
+    def run(self, start, end):
+        from ngs_mapper.base_caller import BlankRun
+        return BlankRun('Ref1', start, end, 'A'*20, None, '-')
+
+    def test_records_only(self):
+        eq_([[1,2],[3]], list(self._C(iter([1,2,3]), 2)))
+
+    def test_splits_runs_by_position(self):
+        r = list(self._C(iter([1, self.run(2,6), 7, self.run(8,8)]), 3))
+        e = [
+            [1, self.run(2,3)],
+            [self.run(4,6)],
+            [7, self.run(8,8)],
+        ]
+        eq_(e, r)
+
+    def test_empty(self):
+        eq_([], list(self._C([], 2)))
+
 class BaseInty(Base):
     def print_files(self, f1, f2):
         print open(f1).read()
@@ -1038,12 +1187,12 @@ class TestGenerateVCF(BaseInty):
 
     @raises(InvalidRegionString)
     @patch('ngs_mapper.base_caller.SeqIO')
-    @patch('ngs_mapper.base_caller.mpileup')
+    @patch('ngs_mapper.samtools.mpileup')
     def test_raises_exception_regionstring_invalid(self, *args):
         self._C('test.bam', 'test.ref', None, 'out.vcf', 0, 0, 10, 0.8, 50, 10, VCF_HEAD, False)
 
     @patch('ngs_mapper.base_caller.SeqIO')
-    @patch('ngs_mapper.base_caller.mpileup')
+    @patch('ngs_mapper.samtools.mpileup')
     def test_regionstr_lt0_and_gt_reflen(self, mmpileup, mseqio):
         mseqio.index.return_value = {'Ref1':MagicMock(seq='A'*10,id='Ref1')}
         mmpileup.side_effect = self.mock_mpileup_factory(
@@ -1057,7 +1206,7 @@ class TestGenerateVCF(BaseInty):
         r = self._C('test.bam', 'test.ref', 'Ref1:0-30', 'out.vcf', 0, 0, 10, 0.8, 50, 10, VCF_HEAD, False)
 
     @patch('ngs_mapper.base_caller.SeqIO')
-    @patch('ngs_mapper.base_caller.mpileup')
+    @patch('ngs_mapper.samtools.mpileup')
     def test_ref_in_bam_only_contains_some_bases(self, mmpileup, mseqio):
         reflen = 8
         refdepth = 10
@@ -1133,7 +1282,7 @@ class TestGenerateVcfMultithreaded(BaseInty):
 
     @patch('ngs_mapper.base_caller.os')
     @patch('ngs_mapper.base_caller.SeqIO')
-    @patch('ngs_mapper.base_caller.mpileup')
+    @patch('ngs_mapper.samtools.mpileup')
     def test_correct_amount_lines(self, mmpileup, mseqio, mos):
         reflen = 10
         numrefs = 3
@@ -1172,64 +1321,187 @@ class TestGenerateVcfMultithreaded(BaseInty):
                 i += 1
         eq_(numrefs*reflen, linecount)
 
-    #@timed(50.0/3.0)
+    @patch('ngs_mapper.base_caller.set_unmapped_mapped_reads')
+    def test_qualdepth_and_flagstats_same_pass(self, msumr):
+        self.require_engine()
+        import json
+        from ngs_mapper import bqd, pileup, flagstat
+        out_vcf = self._C(self.bam, self.ref, 'out.vcf', 25, 100, 10, 0.8, 50, 2, 3, VCF_HEAD.format('test.bam'), 'out.json', 'out.flagstats')
+        ok_(self.cmp_vcf(self.vcf, out_vcf))
+        # Same as graphsample would make from its own pileup
+        e = bqd.parse_pileup(pileup.nogap_columns(self.bam))
+        eq_(json.dumps(e, sort_keys=True), json.dumps(json.load(open('out.json')), sort_keys=True))
+        msumr.assert_called_once_with(self.bam, ANY)
+        eq_(flagstat.flagstats(self.bam), open('out.flagstats').read())
+
+    def _gapped_bam(self, reflen, covered):
+        ''' Writes gapped.bam/gapped.fasta with 50 base reads every 10 bases of the covered ranges '''
+        import pysam
+        refseq = 'ACGT' * (reflen // 4)
+        with open('gapped.fasta', 'w') as fh:
+            fh.write('>Ref1\n{0}\n'.format(refseq))
+        header = {'HD': {'VN': '1.3', 'SO': 'coordinate'}, 'SQ': [{'SN': 'Ref1', 'LN': reflen}]}
+        bam = pysam.AlignmentFile('gapped.bam', 'wb', header=header)
+        for start, end in covered:
+            for pos in range(start, end - 50 + 1, 10):
+                read = pysam.AlignedSegment()
+                read.query_name = 'Read{0}'.format(pos)
+                read.query_sequence = refseq[pos:pos+50]
+                read.flag = 0
+                read.reference_id = 0
+                read.reference_start = pos
+                read.mapping_quality = 60
+                read.cigar = [(0, 50)]
+                read.query_qualities = pysam.qualitystring_to_array('I' * 50)
+                bam.write(read)
+        bam.close()
+        pysam.index('gapped.bam')
+        return 'gapped.bam', 'gapped.fasta'
+
+    def test_threads_same_as_single_thread_across_gap(self):
+        self.require_engine()
+        from ngs_mapper.base_caller import partition_references
+        from ngs_mapper.samtools import parse_regionstring
+        bam, ref = self._gapped_bam(1000, [(0, 200), (700, 1000)])
+        # Make sure chunks are cut inside of the uncovered bases
+        starts = [parse_regionstring(r)[1] for r in partition_references(bam, [('Ref1',1000)], 4)]
+        ok_([s for s in starts if 201 < s <= 700], starts)
+        one = self._C(bam, ref, 'one.vcf', 25, 100000, 10, 0.8, 50, 10, 1)
+        four = self._C(bam, ref, 'four.vcf', 25, 100000, 10, 0.8, 50, 10, 4)
+        eq_(open(one).read(), open(four).read())
+        eq_(1000, len([l for l in open(four) if not l.startswith('#')]))
+
     @patch('ngs_mapper.base_caller.multiprocessing')
-    @patch('__builtin__.open')
-    @patch('ngs_mapper.base_caller.os')
+    @patch('ngs_mapper.base_caller.ordered_batches')
     @patch('ngs_mapper.base_caller.SeqIO')
-    @patch('ngs_mapper.base_caller.mpileup')
-    def test_breaks_up_refs_into_chunks(self, mmpileup, mseqio, mos, mopen, mmultiprocessing):
-        reflen = 100000
-        numrefs = 3
-        refdepth = 100
+    @patch('ngs_mapper.base_caller.partition_references')
+    def test_bounded_pool_gets_chunks_in_order(self, mpartition, mseqio, mordered_batches, mmultiprocessing):
+        from ngs_mapper.base_caller import _init_worker, _vcf_chunk
         threads = 4
-        # Each reference is 1 million bases long
-        ref1 = Mock(seq='A'*reflen,id='Ref1')
-        ref2 = Mock(seq='T'*reflen,id='Ref2')
-        ref3 = Mock(seq='G'*reflen,id='Ref3')
-        mseqio.index.return_value = {'Ref1':ref1, 'Ref2': ref2, 'Ref3': ref3}
-        mseqio.parse.return_value = iter([ref1, ref2, ref3])
-
-        # Each reference is 100 reads deep
-        ref1_pile = [self._mock_pileup_str('Ref1', i, 'A', refdepth, 'G'*refdepth, 'I'*refdepth, 'I'*refdepth) for i in range(1,reflen+1)]
-        ref2_pile = [self._mock_pileup_str('Ref2', i, 'T', refdepth, 'T'*refdepth, 'I'*refdepth, 'I'*refdepth) for i in range(1,reflen+1)]
-        ref3_pile = [self._mock_pileup_str('Ref3', i, 'G', refdepth, 'A'*refdepth, 'I'*refdepth, 'I'*refdepth) for i in range(1,reflen+1)]
-        mmpileup.side_effect = [ref1_pile, ref2_pile, ref3_pile]
-
-        with patch('ngs_mapper.base_caller.time') as time:
-            out_vcf = self._C('in.bam', 'in.ref', 'out.vcf', 25, 100000, 10, 0.8, 50, 10, threads)
-
-        expected_regionstr = [
-            ('Ref1:1-25000'),
-            ('Ref1:25001-50000'),
-            ('Ref1:50001-75000'),
-            ('Ref1:75001-100000'),
-            ('Ref2:1-25000'),
-            ('Ref2:25001-50000'),
-            ('Ref2:50001-75000'),
-            ('Ref2:75001-100000'),
-            ('Ref3:1-25000'),
-            ('Ref3:25001-50000'),
-            ('Ref3:50001-75000'),
-            ('Ref3:75001-100000'),
-        ]
+        ref1 = Mock(seq='A'*100,id='Ref1')
+        ref2 = Mock(seq='T'*50,id='Ref2')
+        mseqio.parse.return_value = iter([ref1, ref2])
+        regions = ['Ref1:1-10', 'Ref1:11-100', 'Ref2:1-50']
+        mpartition.return_value = regions
+        mordered_batches.return_value = ['batch1\n', 'batch2\n']
+        pool = mmultiprocessing.Pool.return_value
+        queue = mmultiprocessing.Queue.return_value
+
+        out_vcf = self._C('in.bam', 'in.ref', 'out.vcf', 25, 100000, 10, 0.8, 50, 10, threads, 'head')
+
+        mpartition.assert_called_once_with('in.bam', [('Ref1',100), ('Ref2',50)], threads)
+        # Only threads workers are ever started and they all get the queue
+        # and the homopolymers for every reference
+        mmultiprocessing.Pool.assert_called_once_with(threads, _init_worker, (queue, ANY, False))
+        hpolys = mmultiprocessing.Pool.call_args[0][2][1]
+        eq_(['Ref1','Ref2'], sorted(hpolys))
+        eq_([False] + [True]*100, list(hpolys['Ref1']))
+        eq_(_vcf_chunk, pool.map_async.call_args[0][0])
+        callargs = pool.map_async.call_args[0][1]
+        eq_(len(regions), len(callargs))
+        for i, (eregion, args) in enumerate(zip(regions, callargs)):
+            # Every chunk is numbered so it can be put back in order
+            eq_(i, args[0])
+            eq_(eregion, args[3])
+        mordered_batches.assert_called_once_with(queue, len(regions), pool.map_async.return_value)
+        # No temp files, just the batches after the header
+        eq_('head\nbatch1\nbatch2\n', open(out_vcf).read())
+        ok_(pool.close.called)
+        ok_(pool.join.called)
+
+class TestUnitOrderedBatches(Base):
+    functionname = 'ordered_batches'
+
+    def _queue(self, items):
+        import Queue
+        q = Queue.Queue()
+        for item in items:
+            q.put(item)
+        return q
+
+    def test_yields_in_chunk_order(self):
+        q = self._queue([
+            (1, 'b1'), (2, 'c1'), (0, 'a1'), (2, None),
+            (1, 'b2'), (0, 'a2'), (0, None), (1, None),
+        ])
+        r = list(self._C(q, 3))
+        eq_(['a1', 'a2', 'b1', 'b2', 'c1'], r)
+
+    def test_yields_before_chunk_finishes(self):
+        q = self._queue([(0, 'a1'), (1, 'b1')])
+        r = self._C(q, 2)
+        eq_('a1', next(r))
+        # b1 cannot come out until chunk 0 is done
+        q.put((0, None))
+        eq_('b1', next(r))
 
-
-        i = 0
-        for eregion, rcall in zip(expected_regionstr, mmultiprocessing.Process.call_args_list):
-            # Call from multiprocessing.Process
-            callargs = rcall[1]['args']
-
-            # Parse out call info
-            regionstr = callargs[2]
-            tmpfile = callargs[3]
-            
-            # Every process call gets a new tempfile
-            eq_('out.vcf.{0}'.format(i), tmpfile)
-            eq_(eregion, regionstr)
-
-            # Increment file count
-            i += 1
+    @raises(ValueError)
+    def test_raises_worker_exception(self):
+        q = self._queue([(0, 'a1')])
+        result = Mock()
+        result.ready.return_value = True
+        result.successful.return_value = False
+        result.get.side_effect = ValueError('worker failed')
+        list(self._C(q, 2, result))
+
+class TestUnitPartitionReferences(Base):
+    functionname = 'partition_references'
+
+    def _regions(self, regions):
+        from ngs_mapper.samtools import parse_regionstring
+        return [parse_regionstring(r) for r in regions]
+
+    def _covers(self, references, regions):
+        ''' Regions should cover every reference in order without gaps or overlaps '''
+        regions = self._regions(regions)
+        for ref, reflen in references:
+            refregions = [r for r in regions if r[0] == ref]
+            eq_(1, refregions[0][1])
+            eq_(reflen, refregions[-1][2])
+            for r1, r2 in zip(refregions, refregions[1:]):
+                eq_(r1[2]+1, r2[1])
+        # References stay in order
+        order = []
+        for r in regions:
+            if not order or order[-1] != r[0]:
+                order.append(r[0])
+        eq_([ref for ref, reflen in references], order)
+
+    def test_equal_chunks_without_depth(self):
+        references = [('Ref1',100000), ('Ref2',100000), ('Ref3',100000)]
+        r = self._C('in.bam', references, 4)
+        self._covers(references, r)
+        lengths = [e - s + 1 for ref, s, e in self._regions(r)]
+        # About CHUNKS_PER_THREAD regions for each thread that are all about the same size
+        eq_(15, len(r))
+        mean = sum(lengths) / float(len(lengths))
+        for l in lengths:
+            ok_(abs(l - mean) / mean < 0.2, lengths)
+
+    @patch('ngs_mapper.base_caller.pileup.sample_depths')
+    def test_deep_regions_get_smaller_chunks(self, msample_depths):
+        # First tenth of the reference is 1000 deep and the rest is 10 deep
+        def depths(bamfile, ref, positions):
+            return [1000 if p <= 10000 else 10 for p in positions]
+        msample_depths.side_effect = depths
+        references = [('Ref1',100000)]
+        r = self._C('in.bam', references, 4)
+        self._covers(references, r)
+        regions = self._regions(r)
+        deep = [e - s + 1 for ref, s, e in regions if e <= 10000]
+        shallow = [e - s + 1 for ref, s, e in regions if s > 11000]
+        ok_(len(deep) > len(shallow), (deep, shallow))
+        ok_(max(deep) < min(shallow), (deep, shallow))
+
+    def test_small_references(self):
+        references = [('Ref1',8), ('Ref2',0), ('Ref3',1)]
+        r = self._C('in.bam', references, 4)
+        eq_(['Ref1:1-8', 'Ref3:1-1'], r)
+
+    def test_fixture_bam(self):
+        references = [('Ref1',8), ('Ref2',8), ('Ref3',8)]
+        r = self._C(self.bam, references, 2)
+        eq_(['Ref1:1-8', 'Ref2:1-8', 'Ref3:1-8'], r)
 
 class TestUnitMain(BaseInty):
     def _C( self, bamfile, reffile, vcf_output_file, regionstr=None, minbq=25, maxd=100000, mind=10, minth=0.8, biasth=50, bias=2, threads=1 ):
@@ -1245,7 +1517,9 @@ class TestUnitMain(BaseInty):
             minth=minth,
             biasth=biasth,
             bias=bias,
-            threads=threads
+            threads=threads,
+            qualdepth=None,
+            flagstats=None
        )        
         with patch('ngs_mapper.base_caller.parse_args') as margparse:
             margparse.return_value = args
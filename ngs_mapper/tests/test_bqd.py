@@ -1,4 +1,5 @@
 from imports import *
+import numpy as np
 
 # Lazy import
 from ngs_mapper.bqd import (
@@ -44,6 +45,64 @@ class Base(BaseTester):
             qualdepth['reflen'] = kwargs['reflen']
         return qualdepth
 
+class TestParsePileup(Base):
+    functionname = 'parse_pileup'
+
+    def test_gap_runs_same_as_blank_rows(self):
+        import json
+        from ngs_mapper.samtools import PileupGap
+        pile = 'R1\t{0}\tN\t1\tA\tI\tI'
+        blank = 'R1\t{0}\t\t0\t\t\t'
+        runs = self._C([PileupGap('R1',1,2), pile.format(3), PileupGap('R1',4,4), pile.format(5)])
+        rows = self._C([blank.format(1), blank.format(2), pile.format(3), blank.format(4), pile.format(5)])
+        eq_(json.dumps(rows, sort_keys=True), json.dumps(runs, sort_keys=True))
+        eq_([0,0,1,0,1], runs['R1']['depths'])
+        eq_(0, runs['R1']['mind'])
+        eq_(5, runs['R1']['length'])
+
+class TestPileupStats(Base):
+    functionname = 'PileupStats'
+
+    def col(self, pos, bquals, mquals):
+        return Mock(pos=pos, bquals=bquals, mquals=mquals)
+
+    def test_filters_like_mpileup(self):
+        r = self._C('R1', 2, 5)
+        # Only bases with mq >= 20 and bq >= 25
+        r.add(self.col(2, [30,10,40,35], [60,60,60,10]))
+        # Every read below minmq means no column at all
+        r.add(self.col(3, [30], [10]))
+        # Reads pass minmq but no bases pass minbq
+        r.add(self.col(4, [10,20], [60,60]))
+        eq_([2,0,0,0], list(r.depths))
+        eq_([True,False,True,False], list(r.covered))
+        eq_(35.0, r.avgquals[0])
+        ok_(all(np.isnan(r.avgquals[1:])))
+        eq_((40,30), (r.maxq, r.minq))
+
+class TestMergePileupStats(Base):
+    functionname = 'merge_pileup_stats'
+
+    def test_same_as_parse_pileup(self):
+        import json
+        from ngs_mapper.bqd import PileupStats, parse_pileup
+        from ngs_mapper.samtools import PileupGap
+        col = lambda ref, pos, q: Mock(ref=ref, pos=pos, bquals=[q], mquals=[60], depth=1, bqual_avg=lambda: float(q))
+        r1a = PileupStats('R1', 1, 3)
+        r1b = PileupStats('R1', 4, 8)
+        r2 = PileupStats('R2', 1, 5)
+        r3 = PileupStats('R3', 1, 5)
+        for c in (col('R1',2,30), col('R1',5,40), col('R2',1,35)):
+            {'R1': r1b if c.pos > 3 else r1a, 'R2': r2}[c.ref].add(c)
+        r = self._C([r1a, r1b, r2, r3])
+        # R3 has no columns and trailing positions are not included
+        e = parse_pileup([
+            PileupGap('R1',1,1), col('R1',2,30), PileupGap('R1',3,4), col('R1',5,40),
+            col('R2',1,35)
+        ])
+        eq_(json.dumps(e, sort_keys=True), json.dumps(r, sort_keys=True))
+        eq_(5, r['R1']['length'])
+
 class TestRegionsFromQualDepth(Base):
     functionname = 'regions_from_qualdepth'
         
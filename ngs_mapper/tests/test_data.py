@@ -82,6 +82,33 @@ class TestPairReads(Base):
         e = [(readlist[i], readlist[i+1]) for i in range(0, len(readlist),2)]
         eq_( e, r )
 
+    def test_keeps_order(self):
+        readlist = [
+            'b_S1_L001_R2_001.fastq', 'sanger.fastq', 'a_S1_L001_R1_001.fastq',
+            'b_S1_L001_R1_001.fastq', 'c_S1_L001_R1_001.fastq', 'a_S1_L001_R2_001.fastq',
+            'sanger.fastq',
+        ]
+        e = [
+            ('b_S1_L001_R1_001.fastq', 'b_S1_L001_R2_001.fastq'), 'sanger.fastq',
+            ('a_S1_L001_R1_001.fastq', 'a_S1_L001_R2_001.fastq'), 'c_S1_L001_R1_001.fastq',
+            'sanger.fastq',
+        ]
+        eq_( e, self._C( readlist ) )
+
+    def test_many_reads(self):
+        readlist = ['s{0}_S1_L001_R{1}_001.fastq'.format(i, r) for r in (2, 1) for i in range(5000)]
+        r = self._C( readlist )
+        eq_( 5000, len(r) )
+        eq_( ('s0_S1_L001_R1_001.fastq', 's0_S1_L001_R2_001.fastq'), r[0] )
+
+class TestMateName(Base):
+    functionname = 'mate_name'
+
+    def test_mate_names(self):
+        eq_( 'd/a_S1_L001_R2_001.fastq', self._C( 'd/a_S1_L001_R1_001.fastq' ) )
+        eq_( 'a_S1_L001_R1_001.fastq', self._C( 'a_S1_L001_R2_001.fastq' ) )
+        eq_( None, self._C( 'a.fastq' ) )
+
 class TestFindMate(Base):
     functionname = 'find_mate'
 
@@ -147,6 +174,27 @@ class TestIsSangerReadFile(Base):
         r = self._C( f )
         ok_( not r, 'Incorrectly detected another platform as Sanger' )
 
+    def test_detects_sanger_gzip( self ):
+        f = 'sample1_F1_1979_01_01_Den2_Den2_0001_A01.fastq'
+        with open( join( fixtures.FIXDIR, 'trim_reads', f ), 'rb' ) as fh:
+            gz = gzip.open( f + '.gz', 'wb' )
+            gz.write( fh.read() )
+            gz.close()
+        ok_( self._C( f + '.gz' ), 'Did not detect compressed Sanger read' )
+
+class TestFastasTo40sFastqs(Base):
+    functionname = 'fastas_to_40s_fastqs'
+
+    def test_converts_fastas( self ):
+        with open( 'ref.fasta', 'w' ) as fh:
+            fh.write( '>ref1 desc\nACGT\nAC\n>ref2\nGG\n' )
+        os.mkdir( 'out' )
+        self._C( 'out', ['ref.fasta'] )
+        eq_(
+            '@ref1\nACGTAC\n+\n]]]]]]\n@ref2\nGG\n+\n]]\n',
+            open( join( 'out', 'ref.fastq' ) ).read()
+        )
+
 class TestFunctional(Base):
     def test_reads_by_plat_emptydir(self):
         from ngs_mapper.data import reads_by_plat as rbp
@@ -155,7 +203,7 @@ class TestFunctional(Base):
 
     def test_reads_by_plat(self):
         with patch('ngs_mapper.data.platform_for_read', lambda filepath: self.reads_for_platforms()[filepath]) as a:
-            with patch('ngs_mapper.data.filter_reads_by_platform', lambda path,plat: self.reads[plat]) as b:
+            with patch('ngs_mapper.data.platforms_in_dir', lambda path, cachefile=None: self.reads) as b:
                 from ngs_mapper import data
                 for plat, readfiles in self.reads.items():
                     if plat == 'MiSeq':
@@ -164,8 +212,8 @@ class TestFunctional(Base):
 
     def test_platform_has_paired_reads(self):
         reads = ['read1_r1','read1_r2','read2_r1','read3_r1','read3_r2']
-        mates = [1,-1,4]
-        with patch('ngs_mapper.data.find_mate', MagicMock(side_effect=mates)):
+        mates = ['read1_r2',None,'read3_r2']
+        with patch('ngs_mapper.data.mate_name', MagicMock(side_effect=mates)):
             from ngs_mapper.data import pair_reads
             expected = [('read1_r1','read1_r2'),'read2_r1',('read3_r1','read3_r2')]
             eq_( expected, pair_reads(reads) )
@@ -182,6 +230,101 @@ class TestFunctional(Base):
         from ngs_mapper.data import find_mate
         eq_( -1, find_mate(self.reads['Sanger'][0], self.reads['Sanger']) )
 
+class TestPlatformsInDir(Base):
+    functionname = 'platforms_in_dir'
+
+    def setUp(self):
+        super(TestPlatformsInDir,self).setUp()
+        self.readsdir = join( self.tempdir, 'reads' )
+        os.mkdir( self.readsdir )
+        self.expected = self.mock_reads_dir(self.readsdir)
+        self.cachefile = join( self.tempdir, '.read_platforms.json' )
+        from ngs_mapper import data
+        self.patcher = patch('ngs_mapper.data.platform_for_read', wraps=data.platform_for_read)
+        self.platform_for_read = self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        super(TestPlatformsInDir,self).tearDown()
+
+    def check( self, result ):
+        eq_( sorted(self.expected.keys()), sorted(result.keys()) )
+        for plat, reads in self.expected.items():
+            eq_( sorted(reads), sorted(result[plat]) )
+
+    def test_reads_every_file_once(self):
+        from ngs_mapper.data import reads_by_plat
+        reads_by_plat( self.readsdir, self.cachefile )
+        nfiles = sum( [len(r) for r in self.expected.values()] )
+        eq_( nfiles, self.platform_for_read.call_count )
+        ok_( exists( self.cachefile ) )
+
+    def test_no_cachefile_writes_nothing(self):
+        before = sorted( os.listdir( self.readsdir ) )
+        self.check( self._C( self.readsdir ) )
+        eq_( before, sorted( os.listdir( self.readsdir ) ) )
+        eq_( ['reads'], os.listdir( self.tempdir ) )
+
+    def test_cachefile_readable_by_others(self):
+        import stat
+        from ngs_mapper.util import readable_mode
+        self._C( self.readsdir, self.cachefile )
+        eq_( readable_mode(), stat.S_IMODE( os.stat( self.cachefile ).st_mode ) )
+
+    def test_uses_cache(self):
+        self.check( self._C( self.readsdir, self.cachefile ) )
+        self.platform_for_read.reset_mock()
+        self.check( self._C( self.readsdir, self.cachefile ) )
+        eq_( 0, self.platform_for_read.call_count )
+
+    def test_changed_file_read_again(self):
+        self._C( self.readsdir, self.cachefile )
+        roche = self.expected['Roche454'][0]
+        with open( roche, 'w' ) as fh:
+            fh.write( '@{0}\nATGCA\n+\n!!!!!\n'.format(self.read_ids['Sanger']) )
+        self.platform_for_read.reset_mock()
+        r = self._C( self.readsdir, self.cachefile )
+        self.platform_for_read.assert_called_once_with( roche )
+        ok_( roche in r['Sanger'] )
+        ok_( 'Roche454' not in r )
+
+    def test_caches_unknown_files(self):
+        junk = join( self.readsdir, 'file.junk' )
+        open( junk, 'w' ).close()
+        self._C( self.readsdir, self.cachefile )
+        self.platform_for_read.reset_mock()
+        self.check( self._C( self.readsdir, self.cachefile ) )
+        eq_( 0, self.platform_for_read.call_count )
+
+    def test_drops_removed_files(self):
+        import json
+        self._C( self.readsdir, self.cachefile )
+        os.unlink( self.expected['Roche454'][0] )
+        self._C( self.readsdir, self.cachefile )
+        cache = json.load( open( self.cachefile ) )
+        ok_( realpath(self.expected['Roche454'][0]) not in cache['files'] )
+        ok_( realpath(self.expected['Sanger'][0]) in cache['files'] )
+
+    def test_linked_reads_use_cache(self):
+        # Same as a stage reading the links ngs_filter makes for unfiltered reads
+        self._C( self.readsdir, self.cachefile )
+        linkdir = join( self.tempdir, 'filtered' )
+        os.mkdir( linkdir )
+        for reads in self.expected.values():
+            for r in reads:
+                os.symlink( r, join( linkdir, basename( r ) ) )
+        self.platform_for_read.reset_mock()
+        r = self._C( linkdir, self.cachefile )
+        eq_( 0, self.platform_for_read.call_count )
+        for plat, reads in self.expected.items():
+            eq_( sorted([join(linkdir, basename(f)) for f in reads]), sorted(r[plat]) )
+
+    def test_read_only_dir(self):
+        import errno
+        with patch('ngs_mapper.data.tempfile.mkstemp', side_effect=OSError(errno.EROFS, 'Read-only file system')):
+            self.check( self._C( self.readsdir, self.cachefile ) )
+        ok_( not exists( self.cachefile ) )
+
 class TestIntegration(Base):
     def test_reads_by_plat_individual(self):
         from ngs_mapper.data import reads_by_plat as rdp
@@ -281,8 +424,27 @@ READ_IDS = {
 class TestPlatformForRead(unittest.TestCase):
     def test_no_reads_in_file(self, mseqio):
         mseqio.parse.return_value = iter([])
+        self.assertRaises(data.NoPlatformFound, data.platform_for_read, 'file.sff')
+
+    @mock.patch.object(data, 'iter_fastq')
+    def test_no_reads_in_fastq_file(self, miter_fastq, mseqio):
+        miter_fastq.return_value = iter([])
+        self.assertRaises(data.NoPlatformFound, data.platform_for_read, 'file.fastq')
+        self.assertFalse(mseqio.parse.called)
+
+    @mock.patch.object(data, 'iter_fastq')
+    def test_invalid_fastq_file(self, miter_fastq, mseqio):
+        miter_fastq.side_effect = ValueError("Invalid fastq record")
         self.assertRaises(data.NoPlatformFound, data.platform_for_read, 'file.fastq')
 
+    @mock.patch.object(data, 'iter_fastq')
+    def test_fastq_read_id_from_header(self, miter_fastq, mseqio):
+        miter_fastq.return_value = iter([
+            ('@_aZ_:1000:000000000-A1B11:1000:0001:0001:0001 1:N:0:1\n', 'ATGC\n', '+\n', '!!!!\n')
+        ])
+        self.assertEqual('MiSeq', data.platform_for_read('/path/to/read.fastq'))
+        self.assertFalse(mseqio.parse.called)
+
     def test_identifies_roche_reads(self, mseqio):
         records = [
             mock.Mock(id='ABC1ABC12ABCA1', seq='ATGC'),
@@ -326,9 +488,9 @@ class TestPlatformForRead(unittest.TestCase):
             r = data.platform_for_read('/path/to/read.sff')
             self.assertEqual('MiSeq', r)
 
-    def test_handles_gzipped_filepath(self, mseqio):
-        record = mock.Mock(id='aZ_09-', seq='ATGC')
-        mseqio.parse.return_value = iter([record])
+    @mock.patch.object(data, 'iter_fastq')
+    def test_handles_gzipped_filepath(self, miter_fastq, mseqio):
+        miter_fastq.return_value = iter([('@aZ_09-\n', 'ATGC\n', '+\n', '!!!!\n')])
         r = data.platform_for_read('/path/to/read.fastq.gz')
         self.assertEqual('Sanger', r)
 
@@ -1,6 +1,8 @@
 from ngs_mapper.nfilter import make_filtered, write_filtered, fqs_excluding_indices, write_post_filter, mkdir_p, run_from_config
 
 import os
+import gzip
+import json
 import mock
 import shutil
 import warnings
@@ -85,6 +87,40 @@ class TestNGSFilter(unittest.TestCase):
         self.assertEquals(fst, expected_fst)
         self.assertEquals(snd, expected_snd)
 
+    def test_structured_stats(self):
+        write_post_filter(self.inputdir, 32, True, ['Sanger'], self.outdir)
+        stats = json.load(open(join(self.outdir, 'ngs_filter_stats.json')))
+        self.assertEqual(1, len(stats))
+        self.assertEqual(self.inputfn, stats[0]['file'])
+        self.assertEqual(self.actualfn, stats[0]['output'])
+        self.assertEqual((4, 1, 1, 2), (stats[0]['total'], stats[0]['bad_index'], stats[0]['has_n'], stats[0]['written']))
+        self.assertEqual(os.path.getsize(self.inputfn), stats[0]['bytes'])
+        self.assertEqual(os.path.getsize(self.actualfn), stats[0]['bytes_written'])
+        rows = [line.rstrip('\n').split('\t') for line in open(join(self.outdir, 'ngs_filter_stats.tsv'))]
+        self.assertEqual(('file', 'output', 'total', 'bad_index', 'has_n', 'written'), tuple(rows[0][:6]))
+        self.assertEqual((self.inputfn, self.actualfn, '4', '1', '1', '2'), tuple(rows[1][:6]))
+        # Nothing is left behind from writing them
+        self.assertFalse([f for f in os.listdir(self.outdir) if f.startswith('.')])
+
+    def test_unfiltered_stats_have_no_counts(self):
+        write_post_filter(self.inputdir, 0, False, ['Sanger'], self.outdir)
+        stats = json.load(open(join(self.outdir, 'ngs_filter_stats.json')))
+        self.assertEqual(None, stats[0]['total'])
+        self.assertEqual('', open(self.statsfile).read())
+
+    def test_next_stage_uses_platform_cache(self):
+        ''' reads that were only linked are not read again by the stage after ngs_filter '''
+        from ngs_mapper import data
+        cache = join(self.outdir, '.read_platforms.json')
+        write_post_filter(self.inputdir, 0, False, ['Sanger'], self.outdir, platform_cache=cache)
+        self.assertTrue(os.path.exists(cache))
+        with mock.patch('ngs_mapper.data.platform_for_read', wraps=data.platform_for_read) as mplatform_for_read:
+            plats = data.reads_by_plat(self.outdir, cache)
+        # Only the stats files ngs_filter wrote are new
+        opened = [c[0][0] for c in mplatform_for_read.call_args_list]
+        self.assertFalse([f for f in opened if f.endswith('.fastq')])
+        self.assertEqual({'Sanger': [self.actualfn]}, plats)
+
     def test_skips_platforms(self):
         try:
             write_post_filter(self.inputdir, 32, True, ['miseq'], self.outdir)
@@ -99,10 +135,107 @@ class TestNGSFilter(unittest.TestCase):
                 {'platforms' : { 'default' : ['Sanger'] },
                  'dropNs' : { 'default' : True },
                  'indexQualityMin' : {'default' : 32},
-                 'threads' : {'default' : 2}}
+                 'threads' : {'default' : 2},
+                 'compress' : {'default' : False}}
          }
         mload_config.return_value = mfig
         run_from_config(self.inputdir,self.outdir, '_')
         actual = open(self.actualfn)
         expected = open(self.expectedfn)
         self.assertFilesEqual(expected, actual)
+
+class TestChunkedFilter(unittest.TestCase):
+    ''' filtering large files in chunks has to match filtering them in one piece '''
+
+    def setUp(self):
+        self.readsdir = 'chunkreads'
+        self.outdir = 'chunkout'
+        mkdir_p(self.readsdir)
+        mkdir_p(self.outdir)
+        mkdir_p('serialout')
+        self.readpath = join(self.readsdir, '1900_S118_L001_R1_001_2015_04_24.fastq')
+        self.indexpath = join(self.readsdir, '1900_S118_L001_I1_001_2015_04_24.fastq')
+        with open(self.readpath, 'w') as reads, open(self.indexpath, 'w') as index:
+            for i in range(103):
+                seq = 'ACGTN'[i % 5] * 10
+                qual = chr(33 + 40 - i % 17) * 8
+                reads.write('@M00001:1:000000000-AAAAA:1:1101:{0}:1000 1:N:0:1\n{1}\n+\n{2}\n'.format(i, seq, 'I' * 10))
+                index.write('@M00001:1:000000000-AAAAA:1:1101:{0}:1000 1:N:0:1\nACGTACGT\n+\n{1}\n'.format(i, qual))
+
+    def tearDown(self):
+        for d in (self.readsdir, self.outdir, 'serialout'):
+            shutil.rmtree(d)
+
+    def test_plan_chunks(self):
+        from ngs_mapper.nfilter import plan_chunks, line_offsets
+        chunks = plan_chunks(self.readpath, 4, minreads=10)
+        self.assertEqual([26, 26, 26, 25], [c for r, i, c in chunks])
+        self.assertEqual(line_offsets(self.readpath, [0, 104, 208, 312]), [r for r, i, c in chunks])
+        self.assertEqual(line_offsets(self.indexpath, [0, 104, 208, 312]), [i for r, i, c in chunks])
+        with open(self.readpath) as fh:
+            fh.seek(chunks[1][0])
+            self.assertTrue(fh.readline().startswith('@M00001:1:000000000-AAAAA:1:1101:26:1000'))
+
+    def test_plan_chunks_small_file_is_one_chunk(self):
+        from ngs_mapper.nfilter import plan_chunks
+        self.assertEqual([(0, 0, None)], plan_chunks(self.readpath, 4, minreads=1000))
+
+    def test_plan_chunks_uneven_index_is_one_chunk(self):
+        from ngs_mapper.nfilter import plan_chunks
+        with open(self.indexpath, 'a') as index:
+            index.write('@extra\nACGTACGT\n+\nIIIIIIII\n')
+        self.assertEqual([(0, 0, None)], plan_chunks(self.readpath, 4, minreads=10))
+
+    def gzip_inputs(self):
+        for path in (self.readpath, self.indexpath):
+            with open(path, 'rb') as fh:
+                gz = gzip.open(path + '.gz', 'wb')
+                gz.write(fh.read())
+                gz.close()
+            os.unlink(path)
+
+    def test_plan_chunks_compressed_is_one_chunk(self):
+        from ngs_mapper.nfilter import plan_chunks
+        self.gzip_inputs()
+        self.assertEqual([(0, 0, None)], plan_chunks(self.readpath + '.gz', 4, minreads=10))
+
+    @mock.patch('ngs_mapper.nfilter.MIN_CHUNK_READS', 10)
+    def test_compressed_input_and_output(self):
+        write_post_filter(self.readsdir, 30, True, ['MiSeq'], 'serialout', 1)
+        name = os.path.basename(self.readpath)
+        expected = open(join('serialout', name)).read()
+        # Compressed chunks joined into one compressed file
+        write_post_filter(self.readsdir, 30, True, ['MiSeq'], self.outdir, 3, compress=True)
+        self.assertEqual(expected, gzip.open(join(self.outdir, name + '.gz')).read())
+        # Compressed input to uncompressed output
+        shutil.rmtree(self.outdir)
+        mkdir_p(self.outdir)
+        self.gzip_inputs()
+        write_post_filter(self.readsdir, 30, True, ['MiSeq'], self.outdir, 1)
+        self.assertEqual(expected, open(join(self.outdir, name)).read())
+
+    def test_unfiltered_compressed_is_linked(self):
+        self.gzip_inputs()
+        write_post_filter(self.readsdir, 0, False, ['MiSeq'], self.outdir, 1)
+        outpath = join(self.outdir, os.path.basename(self.readpath) + '.gz')
+        self.assertTrue(os.path.islink(outpath))
+
+    @mock.patch('ngs_mapper.nfilter.MIN_CHUNK_READS', 10)
+    def test_chunked_matches_serial(self):
+        write_post_filter(self.readsdir, 30, True, ['MiSeq'], 'serialout', 1)
+        write_post_filter(self.readsdir, 30, True, ['MiSeq'], self.outdir, 3)
+        name = os.path.basename(self.readpath)
+        self.assertEqual(open(join('serialout', name)).read(), open(join(self.outdir, name)).read())
+        self.assertEqual(
+            open(join('serialout', 'ngs_filter_stats.txt')).read(),
+            open(join(self.outdir, 'ngs_filter_stats.txt')).read()
+        )
+        # Chunks are removed once they are joined
+        self.assertEqual(
+            sorted([name, 'ngs_filter_stats.txt', 'ngs_filter_stats.json', 'ngs_filter_stats.tsv']),
+            sorted(os.listdir(self.outdir))
+        )
+        serial = json.load(open(join('serialout', 'ngs_filter_stats.json')))[0]
+        chunked = json.load(open(join(self.outdir, 'ngs_filter_stats.json')))[0]
+        for key in ('total', 'bad_index', 'has_n', 'written', 'bytes', 'bytes_written'):
+            self.assertEqual(serial[key], chunked[key])
@@ -0,0 +1,87 @@
+from imports import *
+from mock import ANY
+
+class Base(common.BaseBaseCaller):
+    modulepath = 'ngs_mapper.flagstat'
+
+class TestCountFlags(Base):
+    functionname = 'count_flags'
+
+    def test_unpaired(self):
+        r = self._C([(0,0,-1,60), (4,-1,-1,0), (16|0x400,0,-1,60), (0x200,0,-1,60)])
+        eq_([3,1], r['total'])
+        eq_([2,1], r['mapped'])
+        eq_([1,0], r['duplicates'])
+        eq_([0,0], r['paired'])
+
+    def test_paired(self):
+        reads = [
+            # Proper pair on the same reference
+            (0x1|0x2|0x40, 0, 0, 60),
+            (0x1|0x2|0x80, 0, 0, 60),
+            # Mates on different references, only one has high mapq
+            (0x1|0x40, 0, 1, 60),
+            (0x1|0x80, 1, 0, 3),
+            # Singleton and its unmapped mate
+            (0x1|0x8|0x40, 0, 0, 60),
+            (0x1|0x4|0x80, 0, 0, 0),
+        ]
+        r = self._C(reads)
+        eq_([6,0], r['paired'])
+        eq_([2,0], r['properpair'])
+        eq_([3,0], r['read1'])
+        eq_([3,0], r['read2'])
+        eq_([4,0], r['mated'])
+        eq_([1,0], r['singletons'])
+        eq_([2,0], r['diffchr'])
+        eq_([1,0], r['diffchrhigh'])
+        eq_([5,0], r['mapped'])
+
+class TestPct(Base):
+    functionname = 'pct'
+
+    def test_pct(self):
+        eq_('98.40', self._C(329364, 334718))
+        eq_('100.00', self._C(1, 1))
+
+    def test_zero_total(self):
+        eq_('-nan', self._C(0, 0))
+        eq_('inf', self._C(1, 0))
+
+class TestFormatFlagstats(Base):
+    functionname = 'format_flagstats'
+
+    def test_same_as_samtools(self):
+        from ngs_mapper.flagstat import FIELDS
+        counts = dict(zip(FIELDS, [
+            [334718,0], [0,0], [329364,0], [334718,0], [167369,0], [167349,0],
+            [328898,0], [329040,0], [324,0], [0,0], [0,0]
+        ]))
+        e = '334718 + 0 in total (QC-passed reads + QC-failed reads)\n' \
+            '0 + 0 duplicates\n' \
+            '329364 + 0 mapped (98.40%:-nan%)\n' \
+            '334718 + 0 paired in sequencing\n' \
+            '167369 + 0 read1\n' \
+            '167349 + 0 read2\n' \
+            '328898 + 0 properly paired (98.26%:-nan%)\n' \
+            '329040 + 0 with itself and mate mapped\n' \
+            '324 + 0 singletons (0.10%:-nan%)\n' \
+            '0 + 0 with mate mapped to a different chr\n' \
+            '0 + 0 with mate mapped to a different chr (mapQ>=5)\n'
+        eq_(e, self._C(counts))
+
+class TestFlagstats(Base):
+    functionname = 'flagstats'
+
+    def test_reads_bam(self):
+        self.require_engine()
+        r = self._C(self.bam)
+        eq_('21 + 0 in total (QC-passed reads + QC-failed reads)', r.splitlines()[0])
+        eq_('21 + 0 mapped (100.00%:-nan%)', r.splitlines()[2])
+
+    @patch('ngs_mapper.flagstat.pysam', None)
+    @patch('ngs_mapper.flagstat.Popen')
+    def test_falls_back_to_samtools(self, mpopen):
+        mpopen.return_value.communicate.return_value = ('flagstats', None)
+        eq_('flagstats', self._C('in.bam'))
+        mpopen.assert_called_once_with(['samtools', 'flagstat', 'in.bam'], stdout=ANY)
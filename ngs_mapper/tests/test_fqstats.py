@@ -3,6 +3,14 @@ from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 from Bio.Alphabet import generic_dna
 
+def to_fqrec( rec ):
+    ''' fastq record lines for a SeqRecord like ngs_mapper.reads.fastq_records makes '''
+    quals = ''.join( [chr(q+33) for q in rec._per_letter_annotations['phred_quality']] )
+    return ('@' + rec.id + '\n', str(rec.seq) + '\n', '+\n', quals + '\n')
+
+def make_fqrec( seq, quals ):
+    return to_fqrec( common.make_seqrec( seq, quals ) )
+
 class Base( common.BaseClass ):
     modulepath = 'ngs_mapper.fqstats'
 
@@ -10,17 +18,17 @@ class TestReadAvgQual( Base ):
     functionname = 'read_avg_qual'
 
     def test_correct_avgq( self ):
-        rrec = common.make_seqrec( 'ATGCATGC', [0,0,0,0,40,40,40,40] )
+        rrec = make_fqrec( 'ATGCATGC', [0,0,0,0,40,40,40,40] )
         r = self._C( rrec )
         eq_( 20.0, r )
 
     def test_rounds( self ):
-        rrec = common.make_seqrec( 'ATGC', [0,0,5,5] )
+        rrec = make_fqrec( 'ATGC', [0,0,5,5] )
         r = self._C( rrec )
         eq_( 3, r )
 
     def test_no_qual_values( self ):
-        rrec = common.make_seqrec( '', [] )
+        rrec = make_fqrec( '', [] )
         r = self._C( rrec )
         eq_( 0.0, r )
 
@@ -46,13 +54,14 @@ class TestFqstats( Base ):
         import time
         from ngs_mapper.fqstats import bin_values, read_avg_qual
         randseqs, mlen, mqual = common.random_seqs( 10000 )
+        randseqs = map( to_fqrec, randseqs )
         s = time.time()
         rlb, aqb, mrl, maq, mrc, mqc = self._C( randseqs )
         d = time.time() - s
 
         eq_( mlen, mrl, 'Did not compute max read length correctly {0} != {1}'.format(mlen,mrl) )
         eq_( mqual, maq, 'Did not compute max AvgQual correctly {0} != {1}'.format(mqual,maq) )
-        rlbin, aa = bin_values( [len(r.seq._data) for r in randseqs] )
+        rlbin, aa = bin_values( [len(r[1].rstrip()) for r in randseqs] )
         aqbin, bb = bin_values( [read_avg_qual(r) for r in randseqs] )
 
         for k,v in rlbin.iteritems():
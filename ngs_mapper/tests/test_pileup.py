@@ -0,0 +1,163 @@
+import common
+import fixtures
+
+from nose.tools import eq_, raises, ok_
+from nose.plugins.attrib import attr
+from mock import MagicMock, patch, Mock, call
+
+from os.path import *
+import os
+
+from ngs_mapper.samtools import MPileupColumn
+
+class Base(common.BaseBaseCaller):
+    modulepath = 'ngs_mapper.pileup'
+
+class TestPileupColumn(Base):
+    functionname = 'PileupColumn'
+
+    def test_same_as_mpileupcolumn(self):
+        line = self._mock_pileup_str('Ref1', 5, 'N', 4, 'AAT*', 'II#!', '<<<<')
+        e = MPileupColumn(line)
+        r = self._C('Ref1', 5, 'AAT*', [40,40,2,0], [27,27,27,27])
+        eq_(e.ref, r.ref)
+        eq_(e.pos, r.pos)
+        eq_(e.refbase, r.refbase)
+        eq_(e.depth, r.depth)
+        eq_(e.bases, r.bases)
+        eq_(e.bquals, r.bquals)
+        eq_(e.mquals, r.mquals)
+        eq_(e.base_stats(), r.base_stats())
+        eq_(str(e).split('\t'), str(r).split('\t'))
+
+    def test_empty_column(self):
+        r = self._C('Ref1', 1, '', [], [])
+        eq_(0, r.depth)
+        eq_('', r.bases)
+        eq_(0, r.base_stats()['depth'])
+
+class TestHasEngine(Base):
+    functionname = 'has_engine'
+
+    def test_missing_file(self):
+        ok_(not self._C('missing.bam'))
+
+    def test_not_indexed(self):
+        common.touch('test.bam')
+        ok_(not self._C('test.bam'))
+
+    def test_not_a_path(self):
+        ok_(not self._C(['test.bam']))
+
+    @patch('ngs_mapper.pileup.pysam', None)
+    def test_no_pysam(self):
+        ok_(not self._C(self.bam))
+
+    def test_indexed_bam(self):
+        self.require_engine()
+        ok_(self._C(self.bam))
+
+class TestColumns(Base):
+    functionname = 'columns'
+
+    @patch('ngs_mapper.samtools.mpileup')
+    def test_falls_back_to_mpileup(self, mmpileup):
+        mmpileup.return_value = self.mpileups['Ref2']
+        r = list(self._C('missing.bam', 'Ref2:1-2', 0, 0, 100))
+        mmpileup.assert_called_once_with('missing.bam', 'Ref2:1-2', 0, 0, 100)
+        eq_(2, len(r))
+        ok_(isinstance(r[0], MPileupColumn))
+        eq_(['C','C'], list(r[0].bases))
+
+    def test_engine_matches_expected(self):
+        self.require_engine()
+        r = list(self._C(self.bam, 'Ref1:5-5', 0, 0, 100000))
+        eq_(1, len(r))
+        col = r[0]
+        eq_(('Ref1', 5, 9), (col.ref, col.pos, col.depth))
+        eq_('ATTTTGGGG', col.bases)
+        eq_([40,40,1,1,1,1,1,1,40], col.bquals)
+        eq_([60]*9, col.mquals)
+
+    def test_engine_all_references(self):
+        self.require_engine()
+        r = [(c.ref, c.pos) for c in self._C(self.bam, None, 0, 0, 100000)]
+        # Ref3 only has reads covering 5-7
+        e = [(ref, pos) for ref in ('Ref1','Ref2') for pos in range(1,9)]
+        e += [('Ref3', pos) for pos in range(5,8)]
+        eq_(e, r)
+
+    def test_engine_minbq_removes_bases(self):
+        self.require_engine()
+        col = next(self._C(self.bam, 'Ref1:5-5', 0, 25, 100000))
+        eq_('ATG', col.bases)
+        eq_(3, col.depth)
+
+    def test_engine_deletions(self):
+        self.require_engine()
+        import pysam
+        header = {'HD': {'VN': '1.3', 'SO': 'coordinate'}, 'SQ': [{'SN': 'Ref1', 'LN': 8}]}
+        bam = pysam.AlignmentFile('del.bam', 'wb', header=header)
+        read = pysam.AlignedSegment()
+        read.query_name = 'Read1'
+        read.query_sequence = 'ACGTAC'
+        read.flag = 0
+        read.reference_id = 0
+        read.reference_start = 0
+        read.mapping_quality = 60
+        read.cigar = [(0, 3), (2, 2), (0, 3)]
+        read.query_qualities = pysam.qualitystring_to_array('ABCDEF')
+        bam.write(read)
+        bam.close()
+        pysam.index('del.bam')
+        r = list(self._C('del.bam', 'Ref1:4-5', 0, 0, 100000))
+        eq_(['*','*'], [c.bases for c in r])
+        # Deletions get the quality of the next base just like mpileup
+        eq_([[35],[35]], [c.bquals for c in r])
+
+class TestSampleDepths(Base):
+    functionname = 'sample_depths'
+
+    def test_no_engine_is_zero(self):
+        eq_([0,0,0], self._C('missing.bam', 'Ref1', [1,2,3]))
+
+    def test_counts_reads(self):
+        self.require_engine()
+        eq_([9,9], self._C(self.bam, 'Ref1', [1,8]))
+        # Ref3 only has reads at 5-7
+        eq_([0,1], self._C(self.bam, 'Ref3', [1,5]))
+
+    def test_unknown_reference(self):
+        self.require_engine()
+        eq_([0], self._C(self.bam, 'missing', [1]))
+
+class TestGapColumns(Base):
+    functionname = 'gap_columns'
+
+    @patch('ngs_mapper.samtools.mpileup')
+    def test_yields_gap_runs(self, mmpileup):
+        from ngs_mapper.samtools import PileupGap
+        mmpileup.return_value = [
+            self._mock_pileup_str('R1',1,'A',1,'A','!','!'),
+            self._mock_pileup_str('R1',4,'A',1,'A','!','!'),
+            self._mock_pileup_str('R2',3,'A',1,'A','!','!'),
+        ]
+        r = [c if isinstance(c, PileupGap) else c.pos for c in self._C('missing.bam', None, 0, 0, 100)]
+        eq_([1, PileupGap('R1',2,3), 4, PileupGap('R2',1,2), 3], r)
+
+class TestNogapColumns(Base):
+    functionname = 'nogap_columns'
+
+    @patch('ngs_mapper.samtools.mpileup')
+    def test_fills_missing_positions(self, mmpileup):
+        mmpileup.return_value = [
+            self._mock_pileup_str('R1',1,'A',1,'A','!','!'),
+            self._mock_pileup_str('R1',3,'A',1,'A','!','!'),
+            self._mock_pileup_str('R2',3,'A',1,'A','!','!'),
+        ]
+        r = [(c.ref, c.pos, c.depth) for c in self._C('missing.bam', None, 0, 0, 100)]
+        e = [
+            ('R1',1,1), ('R1',2,0), ('R1',3,1),
+            ('R2',1,0), ('R2',2,0), ('R2',3,1)
+        ]
+        eq_(e, r)
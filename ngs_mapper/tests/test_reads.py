@@ -30,39 +30,96 @@ def rand_sff_seqs( ):
     for i in range( 10 ):
         yield common.rand_seqrec( 100, 0, 0, 5, 75 )
 
-@patch('ngs_mapper.reads.SeqIO.parse')
 class TestSffsToFastq(Base):
     functionname = 'sffs_to_fastq'
 
     def setUp( self ):
         super( TestSffsToFastq, self ).setUp()
+        self.sff = join( fixtures.THIS, 'fixtures', 'reads', 'sample1__1__TI1__1979_01_01__Den2.sff' )
 
-    def _pre( self, bioparse ):
-        self.f1records = [r for r in rand_sff_seqs()]
-        self.f2records = [r for r in rand_sff_seqs()]
-        self.records = self.f1records + self.f2records
-        # parse should now return f1records then f2records
-        bioparse.side_effect = [self.f1records,self.f2records]
-
-    def _post( self, outfile, count, trim=True ):
+    def biopython_fastq( self, outfile, trim ):
+        ''' What converting with Bio.SeqIO and clip_seq_record writes '''
         from Bio import SeqIO
-        ok_( exists(outfile), 'Did not create out.fastq' )
-        eq_( 20, count )
-        newrecs = SeqIO.index(outfile,'fastq')
-        for origr in self.records:
-            self.check_trimmed_against_record( newrecs[origr.id], origr, trim )
-
-    def test_trims( self, bioparse ):
-        self._pre( bioparse )
-        outfile = 'out.fastq'
-        count = self._C( ['file1.sff','file2.sff'], outfile, True )
-        self._post( outfile, count )
-
-    def test_no_trims( self, bioparse ):
-        self._pre( bioparse )
-        outfile = 'out.fastq'
-        count = self._C( ['file1.sff','file2.sff'], outfile, False )
-        self._post( outfile, count, False )
+        from ngs_mapper.reads import clip_seq_record
+        with open( outfile, 'w' ) as fh:
+            for rec in SeqIO.parse( self.sff, 'sff' ):
+                if trim:
+                    rec = clip_seq_record( rec )
+                SeqIO.write( rec, fh, 'fastq' )
+        return open( outfile ).read()
+
+    def test_trims( self ):
+        count = self._C( [self.sff, self.sff], 'out.fastq', True )
+        eq_( 200, count )
+        eq_( self.biopython_fastq( 'bio.fastq', True ) * 2, open( 'out.fastq' ).read() )
+
+    def test_no_trims( self ):
+        count = self._C( [self.sff], 'out.fastq', False )
+        eq_( 100, count )
+        eq_( self.biopython_fastq( 'bio.fastq', False ), open( 'out.fastq' ).read() )
+
+    def test_not_sff( self ):
+        with open( 'bad.sff', 'w' ) as fh:
+            fh.write( '@read\nACGT\n+\nIIII\n' * 4 )
+        assert_raises( ValueError, self._C, ['bad.sff'], 'out.fastq' )
+
+class TestUnitIterSff(Base):
+    functionname = 'iter_sff'
+
+    def test_right_clip_zero_is_no_clip( self ):
+        import struct
+        from ngs_mapper.reads import SFF_HEADER, SFF_READ_HEADER
+        # 4 flows, 1 read with 4 bases and no clip values
+        header = SFF_HEADER.pack( '.sff', '\x00\x00\x00\x01', 0, 0, 1, 40, 4, 4, 1 ) + 'TACGTCAG'
+        header += '\x00' * (40 - len(header))
+        read = SFF_READ_HEADER.pack( 24, 2, 4, 0, 0, 0, 0 ) + 'r1' + '\x00' * 6
+        data = struct.pack( '>4H', 1, 1, 1, 1 ) + '\x01' * 4 + 'acgt' + '\x1e\x1f\x20\x28'
+        read += data + '\x00' * (-len(data) % 8)
+        with open( 'in.sff', 'wb' ) as fh:
+            fh.write( header + read )
+        with open( 'in.sff', 'rb' ) as fh:
+            eq_( [('@r1\n', 'ACGT\n', '+\n', '?@AI\n')], list( self._C( fh ) ) )
+
+class TestUnitConvertedSff(Base):
+    functionname = 'converted_sff'
+
+    def setUp( self ):
+        super( TestUnitConvertedSff, self ).setUp()
+        self.sff = join( fixtures.THIS, 'fixtures', 'reads', 'sample1__1__TI1__1979_01_01__Den2.sff' )
+
+    def test_converts_once( self ):
+        from ngs_mapper.reads import sffs_to_fastq
+        r = self._C( self.sff, 'sample' )
+        eq_( join( 'sample', '.sff_cache', 'sample1__1__TI1__1979_01_01__Den2.fastq' ), r )
+        sffs_to_fastq( [self.sff], 'expected.fastq' )
+        eq_( open( 'expected.fastq' ).read(), open( r ).read() )
+        with patch('ngs_mapper.reads.sffs_to_fastq') as msffs_to_fastq:
+            eq_( r, self._C( self.sff, 'sample' ) )
+            eq_( 0, msffs_to_fastq.call_count )
+
+    def test_readable_by_others( self ):
+        from ngs_mapper.util import readable_mode
+        import stat
+        r = self._C( self.sff, 'sample' )
+        eq_( readable_mode(), stat.S_IMODE( os.stat( r ).st_mode ) )
+
+    def test_converts_again_when_sff_changes( self ):
+        r = self._C( self.sff, 'sample' )
+        os.utime( r, (0, 0) )
+        with patch('ngs_mapper.reads.sffs_to_fastq') as msffs_to_fastq:
+            self._C( self.sff, 'sample' )
+            eq_( 1, msffs_to_fastq.call_count )
+
+    def test_converts_again_when_unreadable( self ):
+        r = self._C( self.sff, 'sample' )
+        with patch('ngs_mapper.reads.os.access', return_value=False):
+            with patch('ngs_mapper.reads.sffs_to_fastq') as msffs_to_fastq:
+                self._C( self.sff, 'sample' )
+                eq_( 1, msffs_to_fastq.call_count )
+
+    def test_sff_dir_not_written( self ):
+        self._C( self.sff, 'sample' )
+        ok_( not exists( join( dirname( self.sff ), '.sff_cache' ) ) )
 
 class TestClipSeqRecord(Base):
     functionname = 'clip_seq_record'
@@ -93,7 +150,7 @@ class TestClipSeqRecord(Base):
         trimrec = self._C( rec )
         eq_( 'TACGGTAGCAGAGACTTGGTCTCTCTGATGGCTGGGTTGGTATCTTA', trimrec.seq._data, 'Did not trim sequence as expected' )
 
-@patch('bwa.seqio.concat_files')
+@patch('ngs_mapper.reads.concat_files')
 class TestFunctionalCompileReads(Base):
     functionname = 'compile_reads' 
 
@@ -137,7 +194,10 @@ class TestFunctionalCompileReads(Base):
             'NP':None
         }
         eq_( expected, self._C( reads, outputdir ) )
-        eq_( len(mock.call_args_list), 2 )
+        # Single files are linked instead of copied
+        eq_( len(mock.call_args_list), 0 )
+        eq_( abspath('p1_1.fastq'), os.readlink(expected['F']) )
+        eq_( abspath('p1_2.fastq'), os.readlink(expected['R']) )
 
     def test_compile_reads_paired_only_multiple(self,mock):
         outputdir = 'output'
@@ -166,7 +226,19 @@ class TestFunctionalCompileReads(Base):
             'NP':join(outputdir,files[2])
         }
         eq_( expected, self._C( reads, outputdir ) )
-        eq_( len(mock.call_args_list), 1 )
+        eq_( len(mock.call_args_list), 0 )
+        eq_( abspath('p1.fastq'), os.readlink(expected['NP']) )
+
+    def test_relinks_existing_output(self,mock):
+        outputdir = join(self.tempdir,'output')
+        with open('p1.fastq','w') as fh:
+            fh.write('@p1\nA\n+\nI\n')
+        self._C( ['p1.fastq'], outputdir )
+        # Must not write into p1.fastq through the old link
+        mock.side_effect = lambda paths, out: open(out,'w').write('both')
+        r = self._C( ['p1.fastq', 'p2.fastq'], outputdir )
+        ok_( not os.path.islink(r['NP']) )
+        eq_( '@p1\nA\n+\nI\n', open('p1.fastq').read() )
 
     def test_compile_reads_unpaired_only_multiple(self,mock):
         outputdir = 'output'
@@ -181,18 +253,23 @@ class TestFunctionalCompileReads(Base):
         eq_( expected, self._C( reads, outputdir ) )
         eq_( len(mock.call_args_list), 1 )
 
-    @patch('ngs_mapper.reads.sffs_to_fastq')
-    def test_converts_sff_to_fastq(self,sffs_to_fastq, concat_files):
-        def side_effect( ins, out ):
-            fh = open(out,'w')
-            fh.write('\n')
-            fh.close()
-        sffs_to_fastq.side_effect = side_effect
+    @patch('ngs_mapper.reads.converted_sff')
+    def test_converts_sff_to_fastq(self,converted_sff, concat_files):
+        converted_sff.return_value = 'np.sff.fastq'
         outputdir = join(self.tempdir,'output')
         reads = ['np.sff','np.fastq',('F.fastq','R.fastq')]
         self._C( reads, outputdir )
-        eq_( ['np.sff'], sffs_to_fastq.call_args_list[0][0][0] )
-        eq_( 3, len(concat_files.call_args_list) )
+        converted_sff.assert_called_once_with( 'np.sff', outputdir )
+        # F and R are single files that are linked
+        concat_files.assert_called_once_with( ['np.sff.fastq', 'np.fastq'], join(outputdir,'NP.fq') )
+
+    @patch('ngs_mapper.reads.converted_sff')
+    def test_single_sff_is_linked(self,converted_sff, concat_files):
+        converted_sff.return_value = 'np.sff.fastq'
+        outputdir = join(self.tempdir,'output')
+        r = self._C( ['np.sff'], outputdir )
+        eq_( 0, len(concat_files.call_args_list) )
+        eq_( abspath('np.sff.fastq'), os.readlink(r['NP']) )
 
     def test_compile_reads_non_supported_read_types(self,mock):
         # Only support fastq and sff right now
@@ -223,6 +300,175 @@ class TestFunctionalCompileReads(Base):
         reads = ['np.sff','np.ab1','np.fastq.gz']
         eq_({'F':None,'R':None,'NP':None}, self._C( [], outputdir ) )
 
+class TestUnitInterleaveReads(Base):
+    functionname = 'interleave_reads'
+
+    def setUp( self ):
+        super( TestUnitInterleaveReads, self ).setUp()
+        with open( 'F.fq', 'w' ) as fh:
+            fh.write( '@r1/1 1:N:0:1\nACGT\n+\nIIII\n@r2/1\nAAAA\n+\nIIII\n' )
+        with open( 'R.fq', 'w' ) as fh:
+            fh.write( '@r1/2 2:N:0:1\nTTTT\n+\nIIII\n@r2/2\nCCCC\n+\n####' )
+        with open( 'NP.fq', 'w' ) as fh:
+            fh.write( '@s1 some comment\nGGGG\n+\nIIII\n' )
+
+    def test_pairs_then_nonpaired( self ):
+        out = StringIO()
+        eq_( 5, self._C( {'F':'F.fq','R':'R.fq','NP':'NP.fq'}, 'RG:Z:MiSeq', out ) )
+        e = '@r1/1 RG:Z:MiSeq\nACGT\n+\nIIII\n' \
+            '@r1/2 RG:Z:MiSeq\nTTTT\n+\nIIII\n' \
+            '@r2/1 RG:Z:MiSeq\nAAAA\n+\nIIII\n' \
+            '@r2/2 RG:Z:MiSeq\nCCCC\n+\n####\n' \
+            '@s1 RG:Z:MiSeq\nGGGG\n+\nIIII\n'
+        eq_( e, out.getvalue() )
+
+    def test_nonpaired_only( self ):
+        out = StringIO()
+        eq_( 1, self._C( {'F':None,'R':None,'NP':'NP.fq'}, 'RG:Z:Sanger', out ) )
+        eq_( '@s1 RG:Z:Sanger\nGGGG\n+\nIIII\n', out.getvalue() )
+
+    def test_uneven_mates( self ):
+        from ngs_mapper.reads import InvalidReadFile
+        with open( 'R.fq', 'w' ) as fh:
+            fh.write( '@r1/2\nTTTT\n+\nIIII\n' )
+        assert_raises( InvalidReadFile, self._C, {'F':'F.fq','R':'R.fq','NP':None}, 'RG:Z:MiSeq', StringIO() )
+
+class TestUnitIterFastq(Base):
+    functionname = 'iter_fastq'
+
+    def test_records( self ):
+        fh = StringIO( '@r1 c\nACGT\n+\nIIII\n\n@r2\nAAAA\n+r2\n####' )
+        eq_(
+            [('@r1 c\n','ACGT\n','+\n','IIII\n'), ('@r2\n','AAAA\n','+r2\n','####\n')],
+            list( self._C( fh ) )
+        )
+
+    def test_invalid_record( self ):
+        assert_raises( ValueError, list, self._C( StringIO( '>r1\nACGT\n' ) ) )
+
+    def test_starts_at_position( self ):
+        fh = StringIO( '@r1\nACGT\n+\nIIII\n@r2\nAAAA\n+\n####\n' )
+        fh.seek( 16 )
+        eq_( ['@r2\n'], [r[0] for r in self._C( fh )] )
+
+class TestUnitFastaRecords(Base):
+    functionname = 'fasta_records'
+
+    def test_multiline_records( self ):
+        with open( 'ref.fa', 'w' ) as fh:
+            fh.write( '>ref1 desc\nACGT\nAC\n>ref2\nGG\n' )
+        eq_( [('ref1','ACGTAC'), ('ref2','GG')], list( self._C( 'ref.fa' ) ) )
+
+class TestUnitMinQual(Base):
+    functionname = 'min_qual'
+
+    def test_min_qual( self ):
+        eq_( 2, self._C( 'II#I\n' ) )
+        eq_( 40, self._C( 'IIII' ) )
+
+    def test_empty( self ):
+        assert_raises( ValueError, self._C, '\n' )
+
+class TestUnitFastqWriter(Base):
+    def test_writes_blocks( self ):
+        from ngs_mapper.reads import FastqWriter
+        out = Mock()
+        rec = ('@r\n','A\n','+\n','I\n')
+        with FastqWriter( out, blocksize=2 ) as writer:
+            for i in range( 3 ):
+                writer.write( rec )
+        eq_( 3, writer.written )
+        eq_( [call('@r\nA\n+\nI\n' * 2), call('@r\nA\n+\nI\n')], out.write.call_args_list )
+
+class TestUnitGzipName(Base):
+    functionname = 'gzip_name'
+
+    def test_names( self ):
+        eq_( 'a.fastq.gz', self._C( 'a.fastq', True ) )
+        eq_( 'a.fastq.gz', self._C( 'a.fastq.gz', True ) )
+        eq_( 'a.fastq', self._C( 'a.fastq.gz', False ) )
+        eq_( 'a.fastq', self._C( 'a.fastq', False ) )
+
+class TestUnitOpenOutput(Base):
+    functionname = 'open_output'
+
+    def test_compressed_roundtrip( self ):
+        from ngs_mapper.reads import open_input, concat_decompressed
+        import gzip
+        for path, data in (('a.fastq.gz', '@a\nA\n+\nI\n'), ('b.fastq.gz', '@b\nC\n+\nI\n')):
+            with self._C( path ) as fh:
+                fh.write( data )
+        eq_( '@a\nA\n+\nI\n', gzip.open( 'a.fastq.gz' ).read() )
+        with open( 'c.fastq', 'w' ) as fh:
+            fh.write( '@c\nG\n+\nI\n' )
+        concat_decompressed( ['a.fastq.gz', 'c.fastq', 'b.fastq.gz'], 'all.fq' )
+        eq_( '@a\nA\n+\nI\n@c\nG\n+\nI\n@b\nC\n+\nI\n', open( 'all.fq' ).read() )
+        eq_( ['@a\n', '@c\n'], [r[0] for r in open_input_records( 'a.fastq.gz', 'c.fastq' )] )
+
+    def test_uncompressed( self ):
+        with self._C( 'a.fastq' ) as fh:
+            fh.write( 'plain' )
+        eq_( 'plain', open( 'a.fastq' ).read() )
+
+def open_input_records( *paths ):
+    from ngs_mapper.reads import fastq_records
+    for path in paths:
+        for record in fastq_records( path ):
+            yield record
+
+class TestUnitConcatFiles(Base):
+    functionname = 'concat_files'
+
+    def setUp( self ):
+        super( TestUnitConcatFiles, self ).setUp()
+        self.paths = []
+        for i, data in enumerate( ('a' * 10, '', 'b' * 3000000) ):
+            path = 'in{0}.fq'.format(i)
+            with open( path, 'wb' ) as fh:
+                fh.write( data )
+            self.paths.append( path )
+        self.expected = 'a' * 10 + 'b' * 3000000
+
+    def test_concats_files( self ):
+        eq_( len(self.expected), self._C( self.paths, 'out.fq' ) )
+        eq_( self.expected, open( 'out.fq', 'rb' ).read() )
+
+    @patch('ngs_mapper.reads.kernel_copiers')
+    def test_falls_back_to_blocks( self, kernel_copiers ):
+        import errno
+        unsupported = Mock( side_effect=OSError( errno.ENOSYS, 'not supported' ) )
+        kernel_copiers.return_value = [unsupported]
+        eq_( len(self.expected), self._C( self.paths, 'out.fq' ) )
+        eq_( self.expected, open( 'out.fq', 'rb' ).read() )
+        # Not tried again once it failed
+        eq_( 1, unsupported.call_count )
+
+    @patch('ngs_mapper.reads.kernel_copiers')
+    def test_raises_real_errors( self, kernel_copiers ):
+        import errno
+        kernel_copiers.return_value = [Mock( side_effect=OSError( errno.ENOSPC, 'full' ) )]
+        assert_raises( OSError, self._C, self.paths, 'out.fq' )
+
+    @patch('ngs_mapper.reads.COPY_BLOCKSIZE', 7)
+    @patch('ngs_mapper.reads.kernel_copiers', Mock(return_value=[]))
+    def test_block_copy_small_blocks( self ):
+        eq_( len(self.expected), self._C( self.paths, 'out.fq' ) )
+        eq_( self.expected, open( 'out.fq', 'rb' ).read() )
+
+class TestUnitLinkOrConcat(Base):
+    functionname = 'link_or_concat'
+
+    @patch('ngs_mapper.reads.concat_files')
+    def test_links_single_file( self, concat_files ):
+        eq_( 'out.fq', self._C( ['in.fq'], 'out.fq' ) )
+        eq_( abspath( 'in.fq' ), os.readlink( 'out.fq' ) )
+        eq_( 0, concat_files.call_count )
+
+    @patch('ngs_mapper.reads.concat_files')
+    def test_concats_multiple_files( self, concat_files ):
+        self._C( ['a.fq', 'b.fq'], 'out.fq' )
+        concat_files.assert_called_once_with( ['a.fq', 'b.fq'], 'out.fq' )
+
 class TestUnitIsValidRead(Base):
     functionname = 'is_valid_read'
 
@@ -230,6 +476,10 @@ class TestUnitIsValidRead(Base):
         for ext in ('ab1','gz','adasdf'):
             eq_( False, self._C( 'file.'+ext ) )
 
+    def test_compressed_fastq_is_valid( self ):
+        eq_( True, self._C( 'file.fastq.gz' ) )
+        eq_( False, self._C( 'file.sff.gz' ) )
+
     def test_valid_read( self ):
         from ngs_mapper.reads import VALID_READ_EXT
         for ext in VALID_READ_EXT:
@@ -0,0 +1,108 @@
+from imports import *
+
+class Base(BaseClass):
+    modulepath = 'ngs_mapper.refcache'
+
+    def setUp(self):
+        super(Base, self).setUp()
+        with open('ref.fasta', 'w') as fh:
+            fh.write('>ref\nAAATAAAATAAAAA\n')
+
+def fake_build(fasta):
+    ''' Makes empty index files instead of running bwa '''
+    from ngs_mapper.refcache import INDEX_EXT
+    for ext in INDEX_EXT:
+        common.touch(fasta + ext)
+
+class TestFastaChecksum(Base):
+    functionname = 'fasta_checksum'
+
+    def test_same_contents_same_checksum(self):
+        shutil.copy('ref.fasta', 'copy.fasta')
+        eq_(self._C('ref.fasta'), self._C('copy.fasta'))
+        eq_(self._C('ref.fasta'), self._C('ref.fasta', blocksize=3))
+
+    def test_different_contents(self):
+        with open('other.fasta', 'w') as fh:
+            fh.write('>ref\nAAATAAAATAAAAC\n')
+        ok_(self._C('ref.fasta') != self._C('other.fasta'))
+
+@patch('ngs_mapper.refcache.build_index')
+class TestCachedReference(Base):
+    functionname = 'cached_reference'
+
+    def test_builds_once(self, mbuild):
+        from ngs_mapper.refcache import fasta_checksum
+        mbuild.side_effect = fake_build
+        r = self._C('ref.fasta', 'cache')
+        eq_(join('cache', fasta_checksum('ref.fasta'), 'reference.fasta'), r)
+        ok_(exists(r + '.bwt'))
+        # Same contents under another name use the same entry
+        shutil.copy('ref.fasta', 'copy.fasta')
+        eq_(r, self._C('copy.fasta', 'cache'))
+        eq_(1, mbuild.call_count)
+
+    def test_entry_readable_by_others(self, mbuild):
+        import stat
+        from ngs_mapper.util import readable_mode
+        mbuild.side_effect = fake_build
+        os.chmod('ref.fasta', 0600)
+        r = self._C('ref.fasta', 'cache')
+        eq_(readable_mode(0755), stat.S_IMODE(os.stat(dirname(r)).st_mode))
+        for path in [r] + [r + ext for ext in ('.bwt', '.fai')]:
+            eq_(readable_mode(0644), stat.S_IMODE(os.stat(path).st_mode))
+
+    def test_failed_build_leaves_nothing(self, mbuild):
+        mbuild.side_effect = ValueError('bwa failed')
+        assert_raises(ValueError, self._C, 'ref.fasta', 'cache')
+        # Only the lock file is left behind
+        eq_(1, len(os.listdir('cache')))
+        ok_(os.listdir('cache')[0].endswith('.lock'))
+
+    def test_built_while_waiting_for_lock(self, mbuild):
+        from ngs_mapper.refcache import fasta_checksum
+        entry = join('cache', fasta_checksum('ref.fasta'))
+        import ngs_mapper.refcache
+        locked = ngs_mapper.refcache.locked
+        def other_sample_built(lockfile):
+            # Another sample finishes the entry right before we get the lock
+            os.makedirs(entry)
+            return locked(lockfile)
+        with patch('ngs_mapper.refcache.locked', side_effect=other_sample_built):
+            r = self._C('ref.fasta', 'cache')
+        eq_(join(entry, 'reference.fasta'), r)
+        eq_(0, mbuild.call_count)
+
+@patch('ngs_mapper.refcache.build_index', Mock(side_effect=fake_build))
+class TestLinkReference(Base):
+    functionname = 'link_reference'
+
+    def test_links_reference_and_index(self):
+        from ngs_mapper.refcache import INDEX_EXT
+        os.mkdir('sample')
+        dest = join('sample', 'ref.fasta')
+        eq_(dest, self._C('ref.fasta', dest, 'cache'))
+        eq_(open('ref.fasta').read(), open(dest).read())
+        for ext in INDEX_EXT:
+            ok_(exists(dest + ext), dest + ext)
+
+    def test_symlinks_across_filesystems(self):
+        import errno
+        os.mkdir('sample')
+        dest = join('sample', 'ref.fasta')
+        with patch('ngs_mapper.refcache.os.link', Mock(side_effect=OSError(errno.EXDEV, 'cross-device'))):
+            self._C('ref.fasta', dest, 'cache')
+        ok_(os.path.islink(dest + '.bwt'))
+        ok_(exists(dest + '.bwt'))
+
+@attr('slow')
+class TestBuildIndex(Base):
+    functionname = 'build_index'
+
+    def test_builds_everything(self):
+        from ngs_mapper.refcache import INDEX_EXT
+        from ngs_mapper.base_caller import load_hpoly_index
+        self._C('ref.fasta')
+        for ext in INDEX_EXT:
+            ok_(exists('ref.fasta' + ext), ext)
+        ok_(load_hpoly_index('ref.fasta')['ref'][1])
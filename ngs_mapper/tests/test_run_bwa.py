@@ -1,66 +1,57 @@
 from imports import *
 from ngs_mapper import compat
+from mock import ANY
 
 class Base(BaseClass):
     modulepath = 'ngs_mapper.run_bwa'
 
-class TestUnitBWAMem(Base):
-    functionname = 'bwa_mem'
-
-    def test_bwa_mem_nonpaired(self):
-        with patch('ngs_mapper.run_bwa.BWAMem', return_value=Mock( run=Mock( return_value=0 ) ) ) as b:
-            with patch('ngs_mapper.run_bwa.index_ref',Mock(return_value=True)) as a:
-                result = self._C( 'F.fq', mate=None, ref='ref.fna' )
-
-    def test_bwa_mem_paired(self):
-        with patch('ngs_mapper.run_bwa.BWAMem', return_value=Mock( run=Mock( return_value=0 ) ) ) as b:
-            with patch('ngs_mapper.run_bwa.index_ref',Mock(return_value=True)) as a:
-                result = self._C( 'F.fq', mate='R.fq', ref='ref.fna' )
-
-    def test_bwa_mem_output_arg(self):
-        with patch('ngs_mapper.run_bwa.BWAMem', return_value=Mock( run=Mock( return_value=0 ) ) ) as b:
-            with patch('ngs_mapper.run_bwa.index_ref',Mock(return_value=True)) as a:
-                result = self._C( 'F.fq', mate='R.fq', ref='ref.fna', output='file.sai' )
-
-    def test_bwa_mem_fails(self):
-        with patch('ngs_mapper.run_bwa.BWAMem', return_value=Mock( run=Mock( return_value=1 ) ) ) as b:
-            with patch('ngs_mapper.run_bwa.index_ref',Mock(return_value=True)) as b:
-                result = self._C( 'F.fq', mate='R.fq', ref='ref.fna', output='file.sai' )
+class TestUnitPrepareRef(Base):
+    functionname = 'prepare_ref'
 
     @patch('ngs_mapper.run_bwa.index_ref', Mock(return_value=False))
     def test_ref_index_fails(self):
-        from ngs_mapper.run_bwa import bwa_mem, InvalidReference
+        from ngs_mapper.run_bwa import InvalidReference
         try:
-            self._C( 'F.fq', mate='R.fq', ref='ref.fna', output='file.sai' )
+            self._C( 'ref.fna' )
         except InvalidReference as e:
             pass
         else:
             assert False, "Did not raise InvalidReference"
 
-    @patch('ngs_mapper.run_bwa.index_ref')
-    @patch('ngs_mapper.run_bwa.compile_refs')
-    @patch('ngs_mapper.run_bwa.BWAMem')
-    def test_ref_index_directory(self, bwamem_mock, compile_refs_mock, index_ref_mock ):
-        bwamem_mock.return_value.run.return_value = 1
-        compile_refs_mock.return_value = 'ref_compiled.fna'
-        index_ref_mock.return_value = 1
-        from ngs_mapper.run_bwa import InvalidReference
-        ret = self._C( 'F.fq', mate='R.fq', ref='ref_compiled.fna', output='file.sai' )
-        eq_( 1, ret )
+    @patch('ngs_mapper.run_bwa.index_ref', Mock(return_value=True))
+    @patch('ngs_mapper.run_bwa.compile_refs', Mock(return_value='reference.fa'))
+    def test_ref_directory_compiled(self):
+        os.mkdir( 'refs' )
+        eq_( 'reference.fa', self._C( 'refs' ) )
 
-    @patch('ngs_mapper.run_bwa.index_ref')
-    @patch('ngs_mapper.run_bwa.BWAMem')
-    @patch('ngs_mapper.run_bwa.which_bwa',Mock(return_value='bwa'))
-    def test_set_threads(self, bwamem_mock,index_ref_mock ):
-        bwamem_mock.return_value.run.return_value = 1
-        index_ref_mock.return_value = 1
-        from ngs_mapper.run_bwa import InvalidReference
+class TestUnitIsIndexed(Base):
+    functionname = 'is_indexed'
 
-        ret = self._C( 'F.fq', mate='R.fq', ref='ref.fna', output='file.sai', t=8 )
-        bwamem_mock.assert_called_with( 'ref.fna', 'F.fq', 'R.fq', bwa_path='bwa', t=8 )
+    def setUp(self):
+        super(TestUnitIsIndexed,self).setUp()
+        common.touch('ref.fna')
+        for ext in ('.amb', '.ann', '.bwt', '.pac', '.sa'):
+            common.touch('ref.fna' + ext)
 
-        ret = self._C( 'F.fq', ref='ref.fna', output='file.sai', t=8 )
-        bwamem_mock.assert_called_with( 'ref.fna', 'F.fq', bwa_path='bwa', t=8 )
+    def test_indexed(self):
+        ok_( self._C('ref.fna') )
+
+    def test_missing_index_file(self):
+        os.unlink('ref.fna.sa')
+        ok_( not self._C('ref.fna') )
+
+    def test_index_older_than_ref(self):
+        os.utime('ref.fna.bwt', (0, 0))
+        ok_( not self._C('ref.fna') )
+
+    def test_missing_ref(self):
+        ok_( not self._C('missing.fna') )
+
+    @patch('ngs_mapper.run_bwa.index_ref')
+    def test_prepare_ref_skips_indexed(self, index_ref):
+        from ngs_mapper.run_bwa import prepare_ref
+        eq_( 'ref.fna', prepare_ref('ref.fna') )
+        eq_( 0, index_ref.call_count )
 
 class TestUnitParseArgs(Base):
     functionname = 'parse_args'
@@ -110,15 +101,18 @@ class TestUnitParseArgs(Base):
         res = self._C( ['fake_read', 'fake_ref', '-t', '5'] )
         eq_( res.threads, 5 )
 
+    def test_platform_cache( self ):
+        eq_( None, self._C( ['fake_read', 'fake_ref'] ).platform_cache )
+        res = self._C( ['fake_read', 'fake_ref', '--platform-cache', 'cache.json'] )
+        eq_( 'cache.json', res.platform_cache )
+
 # Pretty sure this isn't the way to do this, but I'm learning here
 @patch('shutil.move')
 @patch('shutil.rmtree')
 @patch('ngs_mapper.run_bwa.parse_args')
 @patch('ngs_mapper.bam.mergebams')
 @patch('ngs_mapper.bam.indexbam')
-@patch('ngs_mapper.bam.samtobam')
-@patch('ngs_mapper.bam.sortbam')
-@patch('ngs_mapper.run_bwa.bwa_mem')
+@patch('ngs_mapper.run_bwa.bwa_mem_sorted')
 @patch('ngs_mapper.run_bwa.compile_reads')
 @patch('ngs_mapper.run_bwa.reads_by_plat')
 @patch('ngs_mapper.run_bwa.compile_refs')
@@ -126,97 +120,194 @@ class TestUnitParseArgs(Base):
 class TestUnitMain(Base):
     functionname = 'main'
 
-    def _setUp(self, tmp_mock,ref_mock,reads_mock,compile_reads_mock, bwa_mem_mock, sort, convert, index, merge, parse_args, shrmtree, shmove):
+    MISEQ_RG = '@RG\tID:MiSeq\tSM:out\tPL:ILLUMINA'
+    SANGER_RG = '@RG\tID:Sanger\tSM:out\tPL:CAPILLARY'
+
+    def _setUp(self, tmp_mock,ref_mock,reads_mock,compile_reads_mock, bwa_mem_mock, index, merge, parse_args, shrmtree, shmove):
         self.tmp_mock = tmp_mock
         self.ref_mock = ref_mock
         self.reads_mock = reads_mock
         self.compile_reads_mock = compile_reads_mock
         self.bwa_mem_mock = bwa_mem_mock
-        self.sort = sort
-        self.convert = convert
         self.index = index
         self.merge = merge
         self.parse_args = parse_args
         self.shrmtree = shrmtree
         self.shmove = shmove
         tmp_mock.side_effect = Exception("Don't call mkdtemp")
+        merge.side_effect = AssertionError("Should never merge")
         os.mkdir('tdir')
         ref_mock.return_value = 'reference.fa'
         reads_mock.return_value = {'MiSeq':[('r1.fq','r2.fq')]}
-        compile_reads_mock.return_value = {'F':'F.fq','R':'R.fq','NP':None}
+        self.paired = {'F':'F.fq','R':'R.fq','NP':None}
+        compile_reads_mock.return_value = self.paired
         parse_args.return_value = Mock(
             reads='/reads', reference='/reference.fa', platforms=['MiSeq','Sanger'],
-            keep_temp=False, threads=1, output='tdir/out.bam'
+            keep_temp=False, threads=1, output='tdir/out.bam', SM=None, CN=None,
+            sort_threads=1, sort_memory=None, platform_cache=None
         )
         bwa_mem_mock.return_value = 'tdir/out.bam'
 
+    def _paired_and_nonpaired(self):
+        self.reads_mock.return_value = {'MiSeq':[('r1.fq','r2.fq')],'Sanger':['r3.fq']}
+        self.nonpaired = {'F':None,'R':None,'NP':'NP.fq'}
+        self.compile_reads_mock.side_effect = [self.paired, self.nonpaired]
+
     def test_paired_readfiles(self, *mocks):
         self._setUp(*mocks)
         res = self._C()
-        eq_( [call('F.fq','R.fq','/reference.fa','tdir/bwa/paired.sai',t=1)], self.bwa_mem_mock.call_args_list )
-        eq_( [call([('r1.fq','r2.fq')],'tdir/bwa/reads')], self.compile_reads_mock.call_args_list )
-        eq_( [call('/reads')], self.reads_mock.call_args_list )
-        eq_( self.sort.call_count, 1 )
-        eq_( self.convert.call_count, 1 )
-        eq_( self.index.call_count, 1 )
+        eq_( [call([('MiSeq',self.paired)],'/reference.fa','tdir/out.bam',1,'tdir/bwa/rg.txt',1,None)], self.bwa_mem_mock.call_args_list )
+        eq_( [call([('r1.fq','r2.fq')],'tdir/bwa/reads/MiSeq','tdir')], self.compile_reads_mock.call_args_list )
+        eq_( [call('/reads', None)], self.reads_mock.call_args_list )
+        eq_( [call('tdir/out.bam')], self.index.call_args_list )
         self.shrmtree.assert_called_with('tdir/bwa')
 
     def test_nonpaired_readfiles(self, *mocks):
         self._setUp(*mocks)
-        self.merge.side_effect = AssertionError("Should not merge single files")
         self.reads_mock.return_value = {'Sanger':['r1.fq']}
         self.compile_reads_mock.return_value = {'F':None,'R':None,'NP':'NP.fq'}
 
         res = self._C()
-        eq_( [call('NP.fq',ref='/reference.fa',output='tdir/bwa/nonpaired.sai',t=1)], self.bwa_mem_mock.call_args_list )
-        eq_( [call(['r1.fq'],'tdir/bwa/reads')], self.compile_reads_mock.call_args_list )
-        eq_( [call('/reads')], self.reads_mock.call_args_list )
-        eq_( self.sort.call_count, 1 )
-        eq_( self.convert.call_count, 1 )
-        eq_( self.index.call_count, 1 )
+        eq_( [call([('Sanger',{'F':None,'R':None,'NP':'NP.fq'})],'/reference.fa','tdir/out.bam',1,'tdir/bwa/rg.txt',1,None)], self.bwa_mem_mock.call_args_list )
+        eq_( [call(['r1.fq'],'tdir/bwa/reads/Sanger','tdir')], self.compile_reads_mock.call_args_list )
+        eq_( [call('/reads', None)], self.reads_mock.call_args_list )
+        eq_( 1, self.index.call_count )
         self.shrmtree.assert_called_with('tdir/bwa')
     
     def test_paired_and_nonpaired_readfiles(self, *mocks):
         self._setUp(*mocks)
-        self.reads_mock.return_value = {'MiSeq':[('r1.fq','r2.fq')],'Sanger':['r3.fq']}
-        self.compile_reads_mock.return_value = {'F':'F.fq','R':'R.fq','NP':'NP.fq'}
+        self._paired_and_nonpaired()
         res = self._C()
 
-        eq_( [call('F.fq','R.fq','/reference.fa','tdir/bwa/paired.sai',t=1),call('NP.fq',ref='/reference.fa',output='tdir/bwa/nonpaired.sai',t=1)], self.bwa_mem_mock.call_args_list )
-        eq_( [call([('r1.fq','r2.fq'),'r3.fq'],'tdir/bwa/reads')], self.compile_reads_mock.call_args_list )
-        eq_( [call('/reads')], self.reads_mock.call_args_list )
-        eq_( 2, self.sort.call_count )
-        eq_( 2, self.convert.call_count )
+        # Mapped, sorted and indexed once
+        eq_( [call([('MiSeq',self.paired),('Sanger',self.nonpaired)],'/reference.fa','tdir/out.bam',1,'tdir/bwa/rg.txt',1,None)], self.bwa_mem_mock.call_args_list )
+        eq_( [call([('r1.fq','r2.fq')],'tdir/bwa/reads/MiSeq','tdir'),call(['r3.fq'],'tdir/bwa/reads/Sanger','tdir')], self.compile_reads_mock.call_args_list )
+        eq_( [call('/reads', None)], self.reads_mock.call_args_list )
         eq_( 1, self.index.call_count )
-        eq_( 1, self.merge.call_count )
+        eq_( 0, self.shmove.call_count )
         self.shrmtree.assert_called_with('tdir/bwa')
 
+    def test_header_has_all_read_groups(self, *mocks):
+        self._setUp(*mocks)
+        self._paired_and_nonpaired()
+        self.parse_args.return_value.keep_temp = True
+        res = self._C()
+        with open('tdir/bwa/rg.txt') as fh:
+            hdr = fh.read()
+        eq_( self.MISEQ_RG + '\n' + self.SANGER_RG + '\n', hdr )
+
+    def test_sets_sm_and_cn(self, *mocks):
+        self._setUp(*mocks)
+        self.parse_args.return_value.SM = 'sample1'
+        self.parse_args.return_value.CN = 'center'
+        self.parse_args.return_value.keep_temp = True
+        res = self._C()
+        with open('tdir/bwa/rg.txt') as fh:
+            eq_( '@RG\tID:MiSeq\tSM:sample1\tCN:center\tPL:ILLUMINA\n', fh.read() )
+
+    def test_skips_unselected_platforms(self, *mocks):
+        self._setUp(*mocks)
+        self.reads_mock.return_value = {'MiSeq':[('r1.fq','r2.fq')],'IonTorrent':['r3.fq']}
+        res = self._C()
+        eq_( [call([('r1.fq','r2.fq')],'tdir/bwa/reads/MiSeq','tdir')], self.compile_reads_mock.call_args_list )
+
+    def test_uses_platform_cache(self, *mocks):
+        self._setUp(*mocks)
+        self.parse_args.return_value.platform_cache = 'sample/.read_platforms.json'
+        res = self._C()
+        eq_( [call('/reads', 'sample/.read_platforms.json')], self.reads_mock.call_args_list )
+
     def test_keeptemp(self, *mocks):
         self._setUp(*mocks)
         self.shrmtree.side_effect = AssertionError("Should not remove files with keeptemp option")
-        self.parse_args.return_value = Mock(reads='/reads', reference='/reference.fa', platforms=['MiSeq','Sanger'], keep_temp=True, threads=1, output='tdir/out.bam')
+        self.parse_args.return_value.keep_temp = True
         res = self._C()
         eq_( 0, self.shrmtree.call_count )
 
     def test_utilizes_thread_arg(self, *mocks):
         self._setUp(*mocks)
-        self.reads_mock.return_value = {'MiSeq':[('r1.fq','r2.fq')],'Sanger':['r3.fq']}
-        self.compile_reads_mock.return_value = {'F':'F.fq','R':'R.fq','NP':'NP.fq'}
-        self.parse_args.return_value = Mock(reads='reads', reference='reference.fa', platforms=['MiSeq','Sanger'], keep_temp=False, threads=8, output='tdir/out.bam')
+        self._paired_and_nonpaired()
+        self.parse_args.return_value = Mock(reads='reads', reference='reference.fa', platforms=['MiSeq','Sanger'], keep_temp=False, threads=8, output='tdir/out.bam', SM=None, CN=None,
+            sort_threads=2, sort_memory='1G')
         res = self._C()
-        self.bwa_mem_mock.assert_called_with('NP.fq', ref='reference.fa', output='tdir/bwa/nonpaired.sai', t=8)
+        self.bwa_mem_mock.assert_called_with([('MiSeq',self.paired),('Sanger',self.nonpaired)], 'reference.fa', 'tdir/out.bam', 8, 'tdir/bwa/rg.txt', 2, '1G')
 
     @attr('current')
     def test_bwa_error_should_raise_exception(self,*args):
-        with patch('ngs_mapper.run_bwa.os') as os:
-            from ngs_mapper.run_bwa import BWAError
-            bwa_mem_mock = args[4]
-            bwa_mem_mock.return_value = 1
-            try:
-                self._C()
-                ok_(False,"Did not raise Exception for bwa error")
-            except BWAError as e:
-                ok_(True)
+        self._setUp(*args)
+        from ngs_mapper.run_bwa import BWAError
+        self.bwa_mem_mock.side_effect = BWAError
+        try:
+            self._C()
+            ok_(False,"Did not raise Exception for bwa error")
+        except BWAError as e:
+            ok_(True)
+
+@patch('ngs_mapper.run_bwa.which_bwa',Mock(return_value='bwa'))
+@patch('ngs_mapper.run_bwa.prepare_ref')
+@patch('ngs_mapper.bam.sortsam')
+@patch('ngs_mapper.run_bwa.Popen')
+class TestUnitBWAMemSorted(Base):
+    functionname = 'bwa_mem_sorted'
+
+    def _setUp(self, popen, sortsam, prepare_ref, rets=(0,0,0)):
+        prepare_ref.return_value = 'ref.fna'
+        self.bwa = popen.return_value
+        self.written = []
+        self.bwa.stdin.write.side_effect = self.written.append
+        self.view, self.sort = Mock(), Mock()
+        sortsam.return_value = (self.view, self.sort)
+        self.bwa.wait.return_value = rets[0]
+        self.view.wait.return_value = rets[1]
+        self.sort.wait.return_value = rets[2]
+        with open('F.fq','w') as fh:
+            fh.write('@r1 1:N:0:1\nACGT\n+\nIIII\n')
+        with open('R.fq','w') as fh:
+            fh.write('@r1 2:N:0:1\nTTTT\n+\nIIII\n')
+        with open('NP.fq','w') as fh:
+            fh.write('@s1\nGGGG\n+\nIIII\n')
+        self.platreads = [
+            ('MiSeq', {'F':'F.fq','R':'R.fq','NP':None}),
+            ('Sanger', {'F':None,'R':None,'NP':'NP.fq'}),
+        ]
+
+    def test_streams_into_sort(self, popen, sortsam, prepare_ref):
+        from subprocess import PIPE
+        self._setUp(popen, sortsam, prepare_ref)
+        r = self._C( self.platreads, 'ref.fna', 'out.bam', 4, 'rg.txt', 2, '1G' )
+        eq_( 'out.bam', r )
+        popen.assert_called_once_with(
+            ['bwa','mem','-p','-C','-t','4','-H','rg.txt','ref.fna','-'], stdin=PIPE, stdout=PIPE
+        )
+        sortsam.assert_called_once_with( self.bwa.stdout, 'out.bam', 2, '1G' )
+        self.bwa.stdout.close.assert_called_once_with()
+        self.bwa.stdin.close.assert_called_once_with()
+
+    def test_interleaves_all_platforms(self, popen, sortsam, prepare_ref):
+        self._setUp(popen, sortsam, prepare_ref)
+        self._C( self.platreads, 'ref.fna', 'out.bam' )
+        e = '@r1 RG:Z:MiSeq\nACGT\n+\nIIII\n' \
+            '@r1 RG:Z:MiSeq\nTTTT\n+\nIIII\n' \
+            '@s1 RG:Z:Sanger\nGGGG\n+\nIIII\n'
+        eq_( e, ''.join( self.written ) )
+
+    def test_no_header(self, popen, sortsam, prepare_ref):
+        self._setUp(popen, sortsam, prepare_ref)
+        self._C( self.platreads, ref='ref.fna', output='out.bam' )
+        eq_( ['bwa','mem','-p','-C','-t','1','ref.fna','-'], popen.call_args[0][0] )
+
+    def test_bwa_fails(self, popen, sortsam, prepare_ref):
+        from ngs_mapper.run_bwa import BWAError
+        self._setUp(popen, sortsam, prepare_ref, (1,0,0))
+        self.bwa.stdin.write.side_effect = IOError(32, 'Broken pipe')
+        assert_raises( BWAError, self._C, self.platreads, 'ref.fna' )
+        # Still waits on samtools
+        ok_( self.sort.wait.called )
+
+    def test_sort_fails(self, popen, sortsam, prepare_ref):
+        from ngs_mapper.run_bwa import SortError
+        self._setUp(popen, sortsam, prepare_ref, (0,0,1))
+        assert_raises( SortError, self._C, self.platreads, 'ref.fna' )
 
 class TestIntegrateMainArgs(Base):
     def setUp(self):
@@ -319,38 +410,3 @@ class TestIntegrateMainArgs(Base):
         self._eqsize( ff['merged.bam'], res )
         assert os.path.exists( 'bwa' ), "Temp directory missing"
         assert os.path.exists( 'merged.bam.bai' )
-
-class TestFunctionalRunBWA(Base):
-    functionname = 'bwa_mem'
-
-    def setUp(self):
-        super(TestFunctionalRunBWA,self).setUp()
-        self.read1,self.read2,self.ref = fixtures.get_sample_paired_reads()
-        self.sff = glob( join( fixtures.THIS, 'fixtures', 'reads', '*.sff' ) )[0]
-
-    def test_maps_reads_paired(self):
-        eq_( 'bwa.sai', self._C( self.read1, self.read2, ref=self.ref ) )
-        assert exists( 'bwa.sai' ), "Did not create a sai file"
-        assert os.stat('bwa.sai' ).st_size != 0, "sai file created is zero bytes"
-
-    def test_maps_reads_single(self):
-        eq_( 'bwa.sai', self._C( self.read1, ref=self.ref ) )
-        assert exists( 'bwa.sai' ), "Did not create a sai file"
-        assert os.stat('bwa.sai').st_size != 0, "sai file created is zero bytes"
-
-    def test_output_param(self):
-        eq_( 'file.sai', self._C( self.read1, ref=self.ref, output='file.sai' ) )
-        assert exists( 'file.sai' ), "Did not create a sai file"
-        assert os.stat('file.sai').st_size != 0, "sai file created is zero bytes"
-
-    def test_ref_is_directory(self):
-        import shutil
-        os.mkdir( 'refs' )
-        r1 = join('refs','ref1.fna')
-        r2 = join('refs','ref2.fna')
-        shutil.copy( self.ref, r1 )
-        shutil.copy( self.ref, r2 )
-        tot_size = os.stat(r1).st_size + os.stat(r2).st_size
-        eq_( 'bwa.sai', self._C( self.read1, self.read2, ref='refs' ) ) 
-        # bwa.bwa.compile_refs produces reference.fa inside of current directory
-        eq_( tot_size, os.stat( 'reference.fa' ).st_size )
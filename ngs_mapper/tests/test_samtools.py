@@ -7,6 +7,7 @@ from mock import MagicMock, patch, Mock, call
 
 from os.path import *
 import os
+import sys
 
 class Base(common.BaseBaseCaller):
     modulepath = 'ngs_mapper.samtools'
@@ -132,6 +133,16 @@ class TestSamRow(SamRowBase):
         r = self._C( self.row[:-1] )
         eq_( '', r._tags )
 
+    def test_set_converts( self ):
+        r = self._C( self.row[:-1] )
+        r.FLAG = '16'
+        eq_( 16, r.FLAG )
+        eq_( '16', str(r).split('\t')[1] )
+
+    @raises(ValueError)
+    def test_invalid_row( self ):
+        self._C( 'Read1\t0\tRef1' )
+
 class TestUnitSamRowStr(SamRowBase):
     def test_samestring_notags( self ):
         r = self._C( self.row[:-1] )
@@ -273,6 +284,42 @@ class TestNoGapMpileup(MpileupBase):
         for ex, re in zip(expected,list(r)):
             eq_(ex.split(), re.split())
 
+class TestGapMpileup(MpileupBase):
+    functionname = 'gap_mpileup'
+
+    @patch('ngs_mapper.samtools.Popen')
+    def test_yields_gap_runs(self, mock_popen):
+        from ngs_mapper.samtools import PileupGap
+        _all = [
+            self._mock_pileup_str('R1',1,'A',1,'A','!','!'),
+            self._mock_pileup_str('R1',4,'A',1,'A','!','!'),
+            self._mock_pileup_str('R2',3,'A',1,'A','!','!'),
+            self._mock_pileup_str('R2',4,'A',1,'A','!','!'),
+        ]
+        mock_popen.return_value.stdout = _all
+        r = list(self._C(self.bam, None, 0, 0, 100))
+        _ex = [
+            _all[0],
+            PileupGap('R1',2,3),
+            _all[1],
+            PileupGap('R2',1,2),
+            _all[2],
+            _all[3],
+        ]
+        eq_(_ex, r)
+
+class TestUnitPileupGap(Base):
+    functionname = 'PileupGap'
+
+    def test_expands_lazily(self):
+        r = self._C('R1', 3, 5)
+        eq_(3, r.length)
+        eq_(0, r.depth)
+        eq_([3,4,5], list(r.positions()))
+        rows = r.rows()
+        eq_(self._mock_pileup_str('R1',3,'',0,'','',''), next(rows))
+        eq_(2, len(list(rows)))
+
 class TestUnitCharToQual(Base):
     functionname = 'char_to_qual'
 
@@ -313,6 +360,68 @@ class TestUnitBases(MpileupBase):
         r = self._C( str )
         eq_( 'AAAAAAAAAA', r.bases )
 
+    def test_decoded_once( self ):
+        str = 'Ref1	1	A	2	.C	II	]]'
+        r = self._C( str )
+        with patch('ngs_mapper.samtools.decode_bases') as mdecode:
+            mdecode.return_value = 'AC'
+            eq_( 'AC', r.bases )
+            eq_( 'AC', r.bases )
+            list( r )
+            r.base_stats()
+        mdecode.assert_called_once_with( '.C', 'A' )
+
+class TestUnitDecodeBases(Base):
+    functionname = 'decode_bases'
+
+    def test_readstart_mapq_looks_like_marker( self ):
+        # Mapping quality after ^ can be any character
+        eq_( 'AAAAA', self._C( '^+A^$.^^a^1A^-,', 'A' ) )
+
+    def test_multidigit_indel( self ):
+        eq_( 'GC', self._C( 'G+12ACGTACGTACGTc', 'A' ) )
+
+    def test_indel_after_readstart( self ):
+        eq_( 'TTC', self._C( '^].-2AA,$C', 'T' ) )
+
+    def test_no_refbase( self ):
+        eq_( 'A', self._C( '.a', '' ) )
+
+    def test_empty( self ):
+        eq_( '', self._C( '', 'A' ) )
+
+class TestUnitDecodeColumns(Base):
+    functionname = 'decode_columns'
+
+    def test_flat_arrays( self ):
+        from ngs_mapper.samtools import MPileupColumn
+        cols = [
+            'Ref1	1	A	3	.+1Cc^]G$	I5!	]]]',
+            'Ref1	2	A	0			',
+            # mquals that cannot be used are 0
+            'Ref1	3	T	2	,*	II	]I]',
+        ]
+        r = self._C( [cols[0], MPileupColumn(cols[1]), cols[2]] )
+        eq_( [0,3,3,5], list(r.offsets) )
+        eq_( 'ACGT*', r.bases.tostring() )
+        eq_( [40,20,0,40,40], list(r.bquals) )
+        eq_( [60,60,60,0,0], list(r.mquals) )
+
+    def test_same_as_columns( self ):
+        from ngs_mapper.samtools import MPileupColumn
+        cols = [MPileupColumn(c) for c in self.mpileups['Ref5']]
+        r = self._C( cols )
+        for i, col in enumerate(cols):
+            s, e = r.offsets[i], r.offsets[i+1]
+            eq_( col.bases, r.bases[s:e].tostring() )
+            eq_( col.bquals, list(r.bquals[s:e]) )
+            eq_( col.mquals, list(r.mquals[s:e]) )
+
+    def test_empty( self ):
+        r = self._C( [] )
+        eq_( [0], list(r.offsets) )
+        eq_( 0, len(r.bases) )
+
 class TestUnitBQuals(MpileupBase):
     pass
 
@@ -391,6 +500,43 @@ class TestUnitBaseStats(MpileupBase):
         eq_( r['A']['baseq'], [36,35,34,33] )
         eq_( r['A']['mapq'], [32,33,34,35] )
 
+class TestUnitBaseCounts(MpileupBase):
+    def _CA( self, mpstr ):
+        return self._C( mpstr ).base_counts()
+
+    def test_same_as_base_stats( self ):
+        str = 'Ref1	1	A	14	Aa.,CcGgTtNn*$C^]	EDCBAIHGFEDCBA	ABCDEFGHIABCDE'
+        col = self._C( str )
+        e = col.base_stats()
+        r = col.base_counts()
+        eq_( sorted(e.keys()), sorted(r.keys()) )
+        for k in ('depth','bqualsum','mqualsum'):
+            eq_( e[k], r[k] )
+        for b in 'ACGTN*':
+            counts = r[b]['baseq']
+            eq_( 94, len(counts) )
+            eq_( sorted(e[b]['baseq']), [q for q in range(94) for i in range(counts[q])] )
+
+    def test_empty_column( self ):
+        str = 'Ref1	1	N	0			'
+        r = self._CA( str )
+        eq_( {'depth':0,'bqualsum':0.0,'mqualsum':0.0}, r )
+
+class TestUnitQualCounts(Base):
+    functionname = 'qual_counts'
+
+    def test_counts( self ):
+        r = self._C( [0,40,40,93] )
+        eq_( 94, len(r) )
+        eq_( 1, r[0] )
+        eq_( 2, r[40] )
+        eq_( 1, r[93] )
+        eq_( 4, r.sum() )
+
+    def test_empty( self ):
+        r = self._C( [] )
+        eq_( [0]*94, list(r) )
+
 class TestUnitAvgQuals(MpileupBase):
     def test_avgbqual_set( self ):
         str = 'Ref1	1	N	10	AAAAAAAAAA	ABCDEABCDE	]]]]]]]]]]'
@@ -507,6 +653,116 @@ class TestUnitPileupColumnInit(MpileupBase):
         eq_( ']'*10, r._mquals )
         eq_( 'A'*10, r.bases )
 
+class DictSamRow(object):
+    ''' SamRow the way it was before it had __slots__(only used to benchmark against) '''
+    from ngs_mapper.samtools import Prop
+    FLAG = Prop( 'FLAG', int )
+    MAPQ = Prop( 'MAPQ', int )
+    POS = Prop( 'POS', int )
+    TLEN = Prop( 'TLEN', int )
+    PNEXT = Prop( 'PNEXT', int )
+
+    def __init__( self, samrow_str ):
+        parts = samrow_str.rstrip().split( '\t', 11 )
+        self.QNAME, self.FLAG, self.RNAME, self.POS, self.MAPQ, self.CIGAR, \
+            self.RNEXT, self.PNEXT, self.TLEN, self.SEQ, self._qual, self._tags = parts
+
+    @property
+    def QUAL( self ):
+        from ngs_mapper.samtools import char_to_qual
+        return [char_to_qual(c) for c in self._qual]
+
+class DictMPileupColumn(object):
+    ''' MPileupColumn the way it was before it had __slots__(only used to benchmark against) '''
+    def __init__( self, mpileup_str ):
+        self.ref,self.pos,self.refbase,self.depth,self._bases,self._bquals,self._mquals = \
+            mpileup_str.rstrip('\n').split('\t')
+
+    @property
+    def depth( self ):
+        return self.__dict__['depth']
+
+    @depth.setter
+    def depth( self, value ):
+        self.__dict__['depth'] = int(value)
+
+    @property
+    def pos( self ):
+        return self.__dict__['pos']
+
+    @pos.setter
+    def pos( self, value ):
+        self.__dict__['pos'] = int(value)
+
+    @property
+    def bquals( self ):
+        from ngs_mapper.samtools import char_to_qual
+        return map(char_to_qual, self._bquals)
+
+class TestSlotsFootprint(Base):
+    '''
+    Shows that the slot based SamRow and MPileupColumn are smaller than the
+    dictionary based classes they replaced
+    '''
+    def footprint( self, obj ):
+        ''' Bytes for the object and the container that holds its fields '''
+        if hasattr( obj, '__dict__' ):
+            return sys.getsizeof( obj ) + sys.getsizeof( obj.__dict__ )
+        return sys.getsizeof( obj ) + sys.getsizeof( obj._fields )
+
+    def compare( self, new, old, row, use ):
+        ok_( hasattr( new, '__slots__' ) )
+        ok_( not hasattr( new(row), '__dict__' ) )
+        newsize = self.footprint( use(new(row)) )
+        oldsize = self.footprint( use(old(row)) )
+        ok_( newsize < oldsize, "{0} >= {1} bytes".format(newsize, oldsize) )
+
+    def test_samrow( self ):
+        from ngs_mapper.samtools import SamRow
+        row = 'Read1\t99\tRef1\t100\t60\t8M\t=\t200\t108\tACGTACGT\tIIIIIIII\tNM:i:0\tAS:i:8'
+        def use( r ):
+            # What tagreads does with every read
+            r.FLAG >= 2048
+            r.QNAME
+            str( r )
+            return r
+        self.compare( SamRow, DictSamRow, row, use )
+
+    def test_mpileupcolumn( self ):
+        from ngs_mapper.samtools import MPileupColumn
+        row = self._mock_pileup_str( 'Ref1', 100, 'A', 50, 'A'*50, 'I'*50, ']'*50 )
+        def use( c ):
+            # Columns get their position, depth and qualities looked at more than once
+            for i in range( 3 ):
+                c.pos, c.depth, c.bquals
+            return c
+        self.compare( MPileupColumn, DictMPileupColumn, row, use )
+
+@attr('slow')
+class TestSlotsBenchmark(TestSlotsFootprint):
+    '''
+    Reports the time and bytes per record of the slot based SamRow and MPileupColumn
+    next to the dictionary based classes they replaced
+
+    Nothing is asserted about the numbers so a busy machine cannot fail it
+    '''
+    records = 5000
+
+    def per_record( self, func, rows ):
+        ''' Best time in microseconds per record to run func on every row '''
+        import timeit
+        best = min( timeit.repeat( lambda: [func(r) for r in rows], number=1, repeat=3 ) )
+        return best / len(rows) * 1e6
+
+    def compare( self, new, old, row, use ):
+        rows = [row] * self.records
+        for klass in (new, old):
+            print "{0}: {1:.2f}us and {2} bytes per record".format(
+                klass.__name__,
+                self.per_record( lambda r: use(klass(r)), rows ),
+                self.footprint( use(klass(row)) )
+            )
+
 class TestUnitParseRegionString(Base):
     functionname = 'parse_regionstring'
 
@@ -1,5 +1,6 @@
 from imports import *
 from ngs_mapper import compat
+from mock import ANY
 
 class Base(common.BaseTester):
     modulepath = 'ngs_mapper.tagreads'
@@ -179,6 +180,226 @@ class TestUnitTagReads(Base):
         eq_( 1, counts['Sanger'] )
         eq_( 996, counts['MiSeq'] )
 
+    def pysam_counts( self, bam ):
+        ''' Count reads for each read group id without samtools '''
+        import pysam
+        counts = {}
+        for read in pysam.AlignmentFile( bam, 'rb' ).fetch( until_eof=True ):
+            id = read.get_tag( 'RG' )
+            counts[id] = counts.get( id, 0 ) + 1
+        return counts
+
+    def test_streams_tags_with_pysam( self ):
+        from ngs_mapper import tagreads
+        if tagreads.pysam is None:
+            raise SkipTest( 'pysam is not installed' )
+        self.temp_copy_files()
+        hdr = tagreads.get_rg_headers( self.bam )
+        with patch( 'ngs_mapper.tagreads.sortbam' ) as msortbam:
+            self._C( self.bam, hdr )
+        # Tagging keeps the order so a sorted bam is never sorted again
+        ok_( not msortbam.called )
+        counts = self.pysam_counts( self.bam )
+        eq_( {'IonTorrent': 1, 'Roche454': 1, 'Sanger': 1, 'MiSeq': 996}, counts )
+        ok_( exists( self.bam + '.bai' ) )
+        eq_( ['sample1.untagged.bam', 'sample1.untagged.bam.bai'], sorted( os.listdir( self.tempdir ) ) )
+
+    @patch( 'ngs_mapper.tagreads.indexbam' )
+    @patch( 'ngs_mapper.tagreads.sortbam' )
+    @patch( 'ngs_mapper.tagreads.stream_tag_samtools' )
+    def test_unsorted_header_is_sorted( self, mstream, msortbam, mindexbam ):
+        from ngs_mapper import tagreads
+        bam = join( self.tempdir, 'in.bam' )
+        mstream.side_effect = lambda b, h, o: common.touch( o )
+        with patch( 'ngs_mapper.tagreads.pysam', None ):
+            self._C( bam, '@HD\tVN:1.3\tSO:unsorted\n' )
+        msortbam.assert_called_once_with( bam + '.tagging', bam )
+        mindexbam.assert_called_once_with( bam )
+        ok_( not exists( bam + '.tagging' ) )
+
+    @patch( 'ngs_mapper.tagreads.Popen' )
+    @patch( 'ngs_mapper.tagreads.samtools.view' )
+    def test_falls_back_to_samtools( self, mview, mpopen ):
+        from ngs_mapper.tagreads import stream_tag_samtools
+        mview.return_value = MagicMock()
+        mview.return_value.__iter__.return_value = iter( [
+            'read1_sanger\t0\tref\t1\t60\t1M\t*\t0\t0\tA\tI\n'
+        ] )
+        mpopen.return_value.wait.return_value = 0
+        stream_tag_samtools( 'in.bam', '@HD\n', 'out.bam' )
+        mpopen.assert_called_once_with( ['samtools', 'view', '-Sb', '-o', 'out.bam', '-'], stdin=ANY )
+        written = [c[0][0] for c in mpopen.return_value.stdin.write.call_args_list]
+        eq_( '@HD\n', written[0] )
+        ok_( written[1].endswith( '\tRG:Z:Sanger\n' ) )
+
+    @raises( ValueError )
+    @patch( 'ngs_mapper.tagreads.Popen' )
+    @patch( 'ngs_mapper.tagreads.samtools.view' )
+    def test_samtools_failure_raises( self, mview, mpopen ):
+        from ngs_mapper.tagreads import stream_tag_samtools
+        mview.return_value = MagicMock()
+        mpopen.return_value.wait.return_value = 1
+        stream_tag_samtools( 'in.bam', '@HD\n', 'out.bam' )
+
+class TestUnitReadGroupCache(Base):
+    functionname = 'ReadGroupCache'
+
+    def test_same_run_is_cached( self ):
+        c = self._C()
+        names = [
+            'M01234:12:000000000-ABCDE:1:1101:15589:1333',
+            'M01234:12:000000000-ABCDE:1:1101:16000:1400',
+            'M01234:12:000000000-ABCDE:1:2119:19999:1234',
+        ]
+        eq_( ['MiSeq'] * 3, [c( n ) for n in names] )
+        eq_( 2, c.hits )
+        eq_( 1, c.misses )
+
+    def test_same_prefix_different_layout( self ):
+        c = self._C()
+        eq_( 'IonTorrent', c( 'AAAAA:00123:00456' ) )
+        eq_( 'IonTorrent', c( 'AAAAA:00789:00012' ) )
+        eq_( 'Sanger', c( 'AAAAA:sanger' ) )
+        eq_( 'Sanger', c( 'AAAAA:0:' ) )
+        eq_( 1, c.hits )
+
+    def test_names_without_prefix_not_cached( self ):
+        c = self._C()
+        eq_( 'Roche454', c( 'GXDX4VB01AFZ9W' ) )
+        eq_( 'Sanger', c( 'read1_sanger' ) )
+        eq_( {}, c.cache )
+        eq_( 2, c.misses )
+
+    def test_bounded( self ):
+        c = self._C( maxsize=2 )
+        for i in range( 5 ):
+            c( 'M0000{0}:1:FC:1:1101:1234:1234'.format(i) )
+        ok_( len( c.cache ) <= 2 )
+        eq_( 5, c.misses )
+
+    def test_same_as_regexes( self ):
+        from ngs_mapper.tagreads import get_rg_for_name
+        c = self._C()
+        names = [
+            'M01234:12:000000000-ABCDE:1:1101:15589:1333',
+            'M01234:12:000000000-ABCDE:1:1101:1558:1333',
+            'M01234:12:000000000-ABCDE:1:11011:1558:1333',
+            'AAAAA:1:1', 'AAAAA:1:', 'AAAA:1:1', 'A0A0A0A0A0A0A0:x',
+            'GXDX4VB01AFZ9W', 'read_sanger', 'weird:name:1',
+        ]
+        # Twice so the second pass is all cache hits
+        for n in names + names:
+            eq_( get_rg_for_name( n ), c( n ), n )
+
+class TestReadGroupCacheMixedRun(Base):
+    '''
+    Checks how ReadGroupCache handles a run that mixes names from every platform
+    '''
+    functionname = 'ReadGroupCache'
+    reads = 2000
+
+    def mixed_names( self ):
+        ''' self.reads names from every platform with fixed width MiSeq and IonTorrent coordinates '''
+        import random
+        r = random.Random( 1 )
+        makers = [
+            lambda: 'M01234:12:000000000-ABCDE:1:{0}:{1}:{2}'.format(
+                r.choice( (1101, 1102, 2101, 2119) ), r.randint( 10000, 29999 ), r.randint( 10000, 29999 )
+            ),
+            lambda: 'AAAAA:{0:05d}:{1:05d}'.format( r.randint( 0, 99999 ), r.randint( 0, 99999 ) ),
+            lambda: 'GXDX4VB01{0}'.format( ''.join( r.sample( 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 5 ) ) ),
+            lambda: 'read{0}_sanger'.format( r.randint( 0, 99 ) ),
+        ]
+        return [r.choice( makers )() for i in range( self.reads )]
+
+    def test_same_as_regexes( self ):
+        from ngs_mapper.tagreads import get_rg_for_name
+        c = self._C()
+        names = self.mixed_names()
+        for n in names:
+            eq_( get_rg_for_name( n ), c( n ), n )
+        platforms = set( get_rg_for_name( n ) for n in names )
+        eq_( set( ['MiSeq', 'IonTorrent', 'Roche454', 'Sanger'] ), platforms )
+
+    def test_hits_and_misses( self ):
+        c = self._C()
+        names = self.mixed_names()
+        for n in names:
+            c( n )
+        # Every MiSeq name shares one key and so does every IonTorrent name
+        # Roche454 and Sanger names have no prefix so they always miss
+        uncached = len( [n for n in names if ':' not in n] )
+        eq_( 2 + uncached, c.misses )
+        eq_( len( names ) - c.misses, c.hits )
+        eq_( 2, len( c.cache ) )
+
+    def test_clears_at_maxsize( self ):
+        c = self._C( maxsize=3 )
+        names = ['M0000{0}:1:FC:1:1101:1234:1234'.format( i ) for i in range( 4 )]
+        for n in names[:3]:
+            c( n )
+        eq_( 3, len( c.cache ) )
+        c( names[3] )
+        eq_( [c.key( names[3] )], c.cache.keys() )
+        eq_( 'MiSeq', c( names[0] ) )
+        eq_( 5, c.misses )
+        eq_( 0, c.hits )
+
+@attr('slow')
+class TestReadGroupCacheBenchmark(Base):
+    '''
+    Reports the time per read of classifying read names with ReadGroupCache next
+    to matching every name against ID_MAP with get_rg_for_name
+
+    Nothing is asserted about the numbers so a busy machine cannot fail it
+    '''
+    functionname = 'ReadGroupCache'
+    reads = 200000
+
+    def per_read( self, func, names ):
+        ''' Best time in microseconds per read to run func on every name '''
+        import timeit
+        best = min( timeit.repeat( lambda: [func(n) for n in names], number=1, repeat=3 ) )
+        return best / len(names) * 1e6
+
+    def test_miseq_iontorrent_run( self ):
+        import random
+        from ngs_mapper.tagreads import get_rg_for_name
+        r = random.Random( 1 )
+        names = []
+        for i in range( self.reads ):
+            if r.random() < 0.5:
+                names.append( 'M01234:12:000000000-ABCDE:1:{0}:{1}:{2}'.format(
+                    r.choice( (1101, 1102, 2101, 2119) ), r.randint( 1000, 29999 ), r.randint( 1000, 29999 )
+                ) )
+            else:
+                names.append( 'AAAAA:{0:05d}:{1:05d}'.format( r.randint( 0, 99999 ), r.randint( 0, 99999 ) ) )
+        c = self._C()
+        newtime = self.per_read( c, names )
+        oldtime = self.per_read( get_rg_for_name, names )
+        print "ReadGroupCache: {0:.2f}us per read, get_rg_for_name: {1:.2f}us per read, {2} keys cached".format(
+            newtime, oldtime, len( c.cache )
+        )
+
+class TestUnitRgLine(Base):
+    functionname = 'rg_line'
+
+    def test_without_cn( self ):
+        eq_( '@RG\tID:MiSeq\tSM:sample1\tPL:ILLUMINA', self._C( 'MiSeq', 'sample1' ) )
+
+    def test_with_cn( self ):
+        eq_( '@RG\tID:Sanger\tSM:sample1\tCN:center\tPL:CAPILLARY', self._C( 'Sanger', 'sample1', 'center' ) )
+
+class TestUnitIsCoordinateSorted(Base):
+    functionname = 'is_coordinate_sorted'
+
+    def test_coordinate( self ):
+        ok_( self._C( '@HD\tVN:1.3\tSO:coordinate\n@SQ\tSN:ref\tLN:10\n' ) )
+
+    def test_unsorted( self ):
+        ok_( not self._C( '@HD\tVN:1.3\tSO:unsorted\n' ) )
+        ok_( not self._C( '@SQ\tSN:ref\tLN:10\n' ) )
+
 class TestUnitTagReadGroup(Base):
     functionname = 'tag_readgroup'
 
@@ -162,6 +162,72 @@ class TestTrimReadsInDir(TrimBase):
         # Make sure lists are same
         eq_( expectedfiles, resultfiles, 'Expected files({0}) was not equal to Resulting files({1})'.format(expectedfiles,resultfiles) )
 
+    @patch('ngs_mapper.trim_reads.trim_jobs')
+    @patch('ngs_mapper.trim_reads.data')
+    def test_combines_unpaired( self, mdata, mtrim_jobs ):
+        mdata.reads_by_plat.return_value = {'Sanger': ['a.fastq', 'b.fastq', 'c.fastq']}
+        os.mkdir( 'out' )
+        for name, data in (('a', '@a\n'), ('b', ''), ('c', '@c\n')):
+            with open( join( 'out', name + '.unpaired' ), 'w' ) as fh:
+                fh.write( data )
+        mtrim_jobs.return_value = [['out/a', 'out/a.unpaired'], ['out/b', 'out/b.unpaired'], ['out/c', 'out/c.unpaired']]
+        self._C( 'reads', 20, 'out' )
+        eq_( '@a\n@c\n', open( join( 'out', 'unpaired_trimmed.fastq' ) ).read() )
+        eq_( [], glob( join( 'out', '*.unpaired' ) ) )
+
+    @patch('ngs_mapper.trim_reads.trim_jobs')
+    @patch('ngs_mapper.trim_reads.data')
+    def test_single_unpaired_is_renamed( self, mdata, mtrim_jobs ):
+        mdata.reads_by_plat.return_value = {'Sanger': ['a.fastq', 'b.fastq']}
+        os.mkdir( 'out' )
+        for name, data in (('a', '@a\n'), ('b', '')):
+            with open( join( 'out', name + '.unpaired' ), 'w' ) as fh:
+                fh.write( data )
+        mtrim_jobs.return_value = [['out/a', 'out/a.unpaired'], ['out/b', 'out/b.unpaired']]
+        with patch('ngs_mapper.reads.concat_files') as mconcat:
+            self._C( 'reads', 20, 'out' )
+        eq_( 0, mconcat.call_count )
+        eq_( '@a\n', open( join( 'out', 'unpaired_trimmed.fastq' ) ).read() )
+        eq_( [], glob( join( 'out', '*.unpaired' ) ) )
+
+    @patch('ngs_mapper.trim_reads.trim_jobs', Mock(return_value=[]))
+    @patch('ngs_mapper.trim_reads.data')
+    def test_uses_platform_cache( self, mdata ):
+        mdata.reads_by_plat.return_value = {}
+        self._C( 'reads', 20, 'out', platform_cache='sample/.read_platforms.json' )
+        mdata.reads_by_plat.assert_called_once_with( 'reads', 'sample/.read_platforms.json' )
+
+class TestTrimReadSff(TrimBase):
+    functionname = 'trim_read'
+
+    @patch('ngs_mapper.trim_reads.run_trimmomatic')
+    @patch('ngs_mapper.trim_reads.reads.converted_sff')
+    def test_trims_converted_sff( self, mconverted_sff, mrun_trimmomatic ):
+        mconverted_sff.return_value = 'cached.fastq'
+        mrun_trimmomatic.side_effect = lambda *a, **kw: open( kw['trimlog'], 'w' ).close() or 'output'
+        os.makedirs( join( 'sample', 'trimmed' ) )
+        self._C( 'reads/a.sff', 20, join( 'sample', 'trimmed', 'a.fastq' ) )
+        # Converted fastq is kept for later stages
+        mconverted_sff.assert_called_once_with( 'reads/a.sff', 'sample' )
+        eq_( 'cached.fastq', mrun_trimmomatic.call_args[0][1] )
+        ok_( exists( join( 'sample', 'trim_stats', 'a.sff.trim_stats' ) ) )
+
+class TestTrimmedName(TrimBase):
+    functionname = 'trimmed_name'
+
+    def test_names( self ):
+        eq_( 'out/a.fastq', self._C( 'out/a.fastq', False ) )
+        eq_( 'out/a.fastq.gz', self._C( 'out/a.fastq', True ) )
+        eq_( 'out/a.fastq', self._C( 'out/a.fastq.gz', False ) )
+        eq_( 'out/a.fastq.gz', self._C( 'out/a.sff', True ) )
+
+class TestUnpairedName(TrimBase):
+    functionname = 'unpaired_name'
+
+    def test_keeps_gz_last( self ):
+        eq_( 'a.fastq.unpaired', self._C( 'a.fastq' ) )
+        eq_( 'a.fastq.unpaired.gz', self._C( 'a.fastq.gz' ) )
+
 class TestTrimRead(TrimBase):
     functionname = 'trim_read'
 
@@ -375,3 +441,53 @@ class TestIntegrate(TrimBase):
             efiles += ['unpaired_trimmed.fastq']
         self.has_files( outdir, efiles )
         self.has_files( 'trim_stats', [f + '.trim_stats' for f in os.listdir(self.read_dir) if 'R2' not in f] )
+
+class TestTrimThreads(TrimBase):
+    functionname = 'trim_threads'
+
+    def test_single_job_gets_budget( self ):
+        eq_( [8], self._C( [100], 8 ) )
+
+    def test_split_by_size( self ):
+        eq_( [3, 1], self._C( [75, 25], 4 ) )
+        eq_( [2, 1, 1], self._C( [90, 5, 5], 4 ) )
+
+    def test_more_jobs_than_budget( self ):
+        eq_( [1, 1, 1, 1, 1], self._C( [900, 1, 1, 1, 1], 4 ) )
+
+    def test_empty_files( self ):
+        eq_( [1, 1], self._C( [0, 0], 4 ) )
+
+class TestTrimJobs(TrimBase):
+    functionname = 'trim_jobs'
+
+    def test_serial_with_one_thread( self ):
+        with patch('ngs_mapper.trim_reads.trim_read') as mtrim_read:
+            mtrim_read.side_effect = lambda i, q, o, **kw: [o]
+            eq_( [['a.out'], ['b.out']], self._C( [('a', 'a.out'), ('b', 'b.out')], 20, 1, head_crop=0 ) )
+            eq_( [call('a', 20, 'a.out', threads=1, head_crop=0), call('b', 20, 'b.out', threads=1, head_crop=0)],
+                mtrim_read.call_args_list )
+
+    def test_parallel_keeps_order_and_budget( self ):
+        import threading
+        import time
+        for name, size in (('small', 10), ('big', 30), ('pair1', 20), ('pair2', 20)):
+            with open( name, 'w' ) as fh:
+                fh.write( 'A' * size )
+        lock = threading.Lock()
+        inuse = [0, 0]
+        def fake_trim( i, q, o, threads, **kw ):
+            with lock:
+                inuse[0] += threads
+                inuse[1] = max( inuse[1], inuse[0] )
+            time.sleep( 0.05 )
+            with lock:
+                inuse[0] -= threads
+            return [o]
+        jobs = [('small', 'small.out'), ('big', 'big.out'), (('pair1', 'pair2'), ['p1.out', 'p2.out'])]
+        with patch('ngs_mapper.trim_reads.trim_read') as mtrim_read:
+            mtrim_read.side_effect = fake_trim
+            r = self._C( jobs, 20, 3 )
+        eq_( [o for i, o in jobs], [x[0] for x in r] )
+        ok_( inuse[1] <= 3, 'Used {0} threads at once'.format(inuse[1]) )
+        eq_( 3, mtrim_read.call_count )
@@ -21,9 +21,8 @@ class VCFBase(common.BaseClass):
     def vcf_file( self, filepath=None ):
         if filepath is None:
             filepath = join( self.tempdir, 'test.vcf' )
-        template = StringIO( VCF_HEAD.format('test.vcf') )
-        template.name = basename(filepath)
-        return vcf.Writer( open(filepath,'w'), template=vcf.Reader(template) ), filepath
+        from ngs_mapper.base_caller import VCFWriter
+        return VCFWriter( open(filepath,'w'), VCF_HEAD.format('test.vcf') ), filepath
 
     def vcf_record( self, *args, **kwargs ):
         return _Record( *args, **kwargs )
@@ -8,7 +8,9 @@ import argparse
 import sys
 from os.path import basename, join, isdir, dirname, expandvars
 from glob import glob
-import tempfile
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 import reads
 import shlex
 import data
@@ -26,7 +28,10 @@ def main():
         args.outputdir,
         head_crop=args.headcrop,
         platforms=args.platforms,
-        primer_info=[args.primer_file, args.primer_seed, args.palindrom_clip, args.simple_clip]
+        primer_info=[args.primer_file, args.primer_seed, args.palindrom_clip, args.simple_clip],
+        compress=args.compress,
+        threads=args.threads,
+        platform_cache=args.platform_cache
     )
 
 def trim_reads_in_dir( *args, **kwargs ):
@@ -34,11 +39,14 @@ def trim_reads_in_dir( *args, **kwargs ):
         Trims all read files in a given directory and places the resulting files into out_path directory
         Combines all unpaired trimmed fastq files into a single file as a result of running Trimmomatic
 
-        :param str readdir: Directory with read files in it(sff and fastq only)
+        :param str readdir: Directory with read files in it(sff, fastq and fastq.gz only)
         :param int qual_th: What to pass to cutadapt -q
         :param str out_path: Output directory path
         :param int head_crop: How many bases to crop off ends
         :param list platforms: List of platform's reads to use
+        :param bool compress: Write .fastq.gz files instead of .fastq
+        :param int threads: CPU budget shared by all Trimmomatic runs(see trim_jobs)
+        :param str platform_cache: data.PlatformCache file to look read platforms up in
     '''
     readdir = args[0]
     qual_th = args[1]
@@ -46,6 +54,9 @@ def trim_reads_in_dir( *args, **kwargs ):
     headcrop = kwargs.get('head_crop', 0)
     platforms = kwargs.get('platforms', None)
     primer_info = kwargs.get('primer_info')
+    compress = kwargs.get('compress', False)
+    threads = int(kwargs.get('threads', 1))
+    platform_cache = kwargs.get('platform_cache')
     logger.info(
         "Only accepting the following platform's read files: {0}".format(
             platforms
@@ -54,42 +65,41 @@ def trim_reads_in_dir( *args, **kwargs ):
 
     # Only sff and fastq files
     #reads = [f for f in os.listdir(readdir) if f.endswith('sff') or f.endswith('fastq')]
-    platreads = data.reads_by_plat( readdir )
+    platreads = data.reads_by_plat( readdir, platform_cache )
     # Make out_path
     if not isdir( out_path ):
         os.mkdir( out_path )
-    # Trim all the reads
-    unpaired = []
-    for plat, reads in platreads.iteritems():
+    # Gather all the reads to trim
+    jobs = []
+    for plat, platfiles in platreads.iteritems():
         if platforms is None or plat in platforms:
-            for r in reads:
+            for r in platfiles:
                 if '_I1_' in r or '_I2_' in r:
                     logger.debug("Skipped MiSeq index read {0}".format(r))
                     continue
                 inreads = None
                 if isinstance(r,str):
-                    # Only accept .sff and .fastq
-                    if r.endswith('.sff') or r.endswith('.fastq'):
+                    # Only accept .sff, .fastq and .fastq.gz
+                    if r.endswith('.sff') or r.endswith('.fastq') or r.endswith('.fastq.gz'):
                         inreads = r
-                        outreads = join(out_path, basename(r).replace('.sff','.fastq'))
+                        outreads = trimmed_name(join(out_path, basename(r)), compress)
                 else:
                     inreads = r
-                    outreads = [join(out_path, basename(pr)) for pr in r]
+                    outreads = [trimmed_name(join(out_path, basename(pr)), compress) for pr in r]
                 # Sometimes inreads not set because .ab1 files
                 if inreads is None:
                     continue
-                try:
-                    r = trim_read( inreads, qual_th, outreads, head_crop=headcrop, primer_info=primer_info )
-                    logger.debug("Output from trim_read {0}".format(r))
-                    unpaired += r[1::2]
-                    logger.debug("Added {0} to unpaired list".format(r[1::2]))
-                except subprocess.CalledProcessError as e:
-                    print e.output
-                    raise e
+                jobs.append( (inreads, outreads) )
         else:
             logger.info("{0} are being excluded as they are not in {1}".format(
-                reads,platforms
+                platfiles,platforms
             ))
+    # Trim all the reads
+    unpaired = []
+    for r in trim_jobs( jobs, qual_th, threads, head_crop=headcrop, primer_info=primer_info ):
+        logger.debug("Output from trim_read {0}".format(r))
+        unpaired += r[1::2]
+        logger.debug("Added {0} to unpaired list".format(r[1::2]))
     #!!
     # Combine all *.fastq.unpaired into one file for mapping as SE
     #!!
@@ -97,16 +107,121 @@ def trim_reads_in_dir( *args, **kwargs ):
     notempty = filter( lambda f: os.stat(f).st_size > 0, unpaired )
     if notempty:
         logger.info("Combining all unpaired trimmed files into a single file")
-        out_unpaired = join( out_path, 'unpaired_trimmed.fastq' )
-        with open( out_unpaired, 'w' ) as fw:
-            for up in notempty:
-                with open(up) as fr:
-                    fw.write( fr.read() )
+        # Compressed files can be joined as they are since concatenated gzip files are valid gzip
+        out_unpaired = reads.gzip_name( join( out_path, 'unpaired_trimmed.fastq' ), compress )
+        if len( notempty ) == 1:
+            # Nothing to combine so it only needs a new name
+            os.rename( notempty[0], out_unpaired )
+        else:
+            reads.concat_files( notempty, out_unpaired )
     else:
         logger.debug("All unpaired trimmed files are empty")
     # Remove the read now as it is no longer needed
     for up in unpaired:
-        os.unlink( up )
+        if os.path.exists( up ):
+            os.unlink( up )
+
+class CpuBudget(object):
+    '''
+        Hands out threads from a fixed total so the Trimmomatic runs going at
+        the same time never use more than total threads
+    '''
+    def __init__( self, total ):
+        self.free = total
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def reserve( self, n ):
+        with self.cond:
+            while self.free < n:
+                self.cond.wait()
+            self.free -= n
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.free += n
+                self.cond.notify_all()
+
+def trim_threads( sizes, budget ):
+    '''
+        Splits budget threads between jobs by their size
+
+        Each job gets its share of budget by size but never so many that the other jobs
+        could not run beside it with at least 1 thread each. With as many jobs as
+        the budget every job gets 1 thread and the files themselves are run in parallel
+
+        @param sizes - Size of the input of every job
+        @param budget - Total threads to use
+
+        @returns list of threads for every job
+    '''
+    cap = budget - min(len(sizes), budget) + 1
+    total = float(sum(sizes)) or 1.0
+    return [max(1, min(cap, int(round(budget * size / total)))) for size in sizes]
+
+def trim_jobs( jobs, qual_th, budget=1, **kwargs ):
+    '''
+        Runs trim_read for every (inreads, outreads) job with at most budget threads
+        in use at once. Jobs are started largest first and each gets Trimmomatic
+        threads from trim_threads
+
+        @param jobs - List of (inreads, outreads) for trim_read
+        @param qual_th - Quality threshold for trim_read
+        @param budget - Total threads to use
+        @param kwargs - Passed on to trim_read
+
+        @returns list of what trim_read returned for each job in the same order as jobs
+    '''
+    def run( job, threads=1 ):
+        try:
+            return trim_read( job[0], qual_th, job[1], threads=threads, **kwargs )
+        except subprocess.CalledProcessError as e:
+            print e.output
+            raise e
+
+    if budget <= 1 or len(jobs) <= 1:
+        return [run( job, max(budget, 1) ) for job in jobs]
+
+    sizes = [sum(os.stat(f).st_size for f in ([i] if isinstance(i, str) else i)) for i, o in jobs]
+    threads = trim_threads( sizes, budget )
+    cpus = CpuBudget( budget )
+    def reserved( i ):
+        with cpus.reserve( threads[i] ):
+            logger.debug( "Trimming {0} with {1} threads".format(jobs[i][0], threads[i]) )
+            return i, run( jobs[i], threads[i] )
+    order = sorted( range(len(jobs)), key=lambda i: sizes[i], reverse=True )
+    pool = ThreadPool( min(len(jobs), budget) )
+    try:
+        results = dict( pool.map( reserved, order ) )
+    finally:
+        pool.close()
+        pool.join()
+    return [results[i] for i in range(len(jobs))]
+
+def trimmed_name( path, compress ):
+    '''
+        Name of the trimmed fastq for read file path
+        Trimmomatic compresses its output only if the name ends in .gz
+
+        @param path - Read file path(.sff, .fastq or .fastq.gz)
+        @param compress - Should the trimmed file be compressed
+
+        @returns path as .fastq or .fastq.gz
+    '''
+    path = reads.gzip_name( path, False )
+    if path.endswith( '.sff' ):
+        path = path[:-4] + '.fastq'
+    return reads.gzip_name( path, compress )
+
+def unpaired_name( path ):
+    '''
+        Name of the unpaired output for the trimmed fastq path
+        Keeps .gz on the end so Trimmomatic compresses it the same way as path
+    '''
+    if reads.is_gzip( path ):
+        return path[:-3] + '.unpaired.gz'
+    return path + '.unpaired'
 
 def trim_read( *args, **kwargs ):
     '''
@@ -117,6 +232,7 @@ def trim_read( *args, **kwargs ):
         @param qual_th - Quality threshold to trim reads on
         @param out_paths - Where to put the trimmed file[s]
         @param head_crop - How many bases to trim off the front
+        @param threads - How many threads Trimmomatic can use
 
         @returns path to the trimmed fastq file
     '''
@@ -134,9 +250,8 @@ def trim_read( *args, **kwargs ):
         out_paths = (None,None)
     headcrop = kwargs.get('head_crop', 0)
     primer_info = kwargs.get('primer_info')
+    threads = kwargs.get('threads', 1)
 
-    from Bio import SeqIO
-    tfile = None
     for i, out_path in enumerate(out_paths):
         if out_path is None:
             out_paths[i] = basename( readpaths[i] ).replace('.sff','.fastq')
@@ -145,25 +260,23 @@ def trim_read( *args, **kwargs ):
     # Keep the original name for later( Have to copy otherwise we are dealing with a pointer )
     orig_readpaths = [f for f in readpaths]
 
-    # Convert sff to fastq
+    sampledir = dirname(dirname(out_paths[0]))
+    # Convert sff to fastq(clipped with the clip_qual values in the sff)
+    # Kept after trimming so later stages do not have to convert it again
     for i,readpath in enumerate(readpaths):
         if readpath.endswith('.sff'):
-            logger.debug( "Converting {0} to fastq".format(readpath) )
-            # Just put in temp location then remove later
-            _, tfile = tempfile.mkstemp(prefix='trimreads',suffix='sff.fastq')
-            try:
-                # Clip adapter based on clip_qual values in sff
-                nwritten = reads.sffs_to_fastq( [readpath], tfile, True )
-            except AssertionError as e:
-                # Ignore the stupid sff bug in BioPython
-                pass
-            readpaths[i] = tfile
+            readpaths[i] = reads.converted_sff( readpath, sampledir )
 
     # Run trimmer on the file
-    trim_stats_dir = join( dirname(dirname(out_paths[0])), 'trim_stats' )
+    trim_stats_dir = join( sampledir, 'trim_stats' )
     stats_file = join( trim_stats_dir, basename(orig_readpaths[0]) + '.trim_stats' )
     if not isdir(dirname(stats_file)):
-        os.makedirs( dirname(stats_file) )
+        try:
+            os.makedirs( dirname(stats_file) )
+        except OSError:
+            # Another trim_jobs worker may have just made it
+            if not isdir(dirname(stats_file)):
+                raise
 
     #run_cutadapt( readpath, stats=stats_file, o=out_path, q=qual_th )
     retpaths = []
@@ -172,14 +285,14 @@ def trim_read( *args, **kwargs ):
         output = run_trimmomatic(
             'SE', readpaths[0], out_paths[0],
             ('LEADING',qual_th), ('TRAILING',qual_th), ('HEADCROP',headcrop),
-            threads=1, trimlog=stats_file, primer_info=primer_info
+            threads=threads, trimlog=stats_file, primer_info=primer_info
         )
     else:
-        retpaths = [out_paths[0],out_paths[0]+'.unpaired',out_paths[1],out_paths[1]+'.unpaired']
+        retpaths = [out_paths[0],unpaired_name(out_paths[0]),out_paths[1],unpaired_name(out_paths[1])]
         output = run_trimmomatic(
-            'PE', readpaths[0], readpaths[1], out_paths[0], out_paths[0]+'.unpaired', out_paths[1], out_paths[1]+'.unpaired',
+            'PE', readpaths[0], readpaths[1], retpaths[0], retpaths[1], retpaths[2], retpaths[3],
             ('LEADING',qual_th), ('TRAILING',qual_th), ('HEADCROP',headcrop),
-            threads=1, trimlog=stats_file, primer_info=primer_info
+            threads=threads, trimlog=stats_file, primer_info=primer_info
         )
 
     # Prepend stats file with stdout from trimmomatic
@@ -190,10 +303,6 @@ def trim_read( *args, **kwargs ):
         fh.write( '\n' )
         fh.write( contents )
 
-    # Clean up temp file
-    if tfile:
-        os.unlink(tfile)
-
     return retpaths
 
 def run_trimmomatic( *args, **kwargs ):
@@ -342,4 +451,28 @@ def parse_args( args=sys.argv[1:] ):
         help=defaults['simpleclip']['help']
     )
 
+    parser.add_argument(
+        '--threads',
+        dest='threads',
+        type=int,
+        default=defaults['threads']['default'],
+        help=defaults['threads']['help']
+    )
+
+    parser.add_argument(
+        '--compress',
+        dest='compress',
+        action='store_true',
+        default=defaults['compress']['default'],
+        help=defaults['compress']['help']
+    )
+
+    parser.add_argument(
+        '--platform-cache',
+        dest='platform_cache',
+        default=None,
+        help='File to remember the platform of every read file in(see data.PlatformCache). ' \
+            'runsample passes one file for the whole sample so each stage can reuse it'
+    )
+
     return parser.parse_args( args )
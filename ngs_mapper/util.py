@@ -17,3 +17,17 @@ def build_datafiles(prefix, datadir):
         _prefix = os.path.normpath(root.replace(datadir, prefix))
         manifest.append((_prefix, [os.path.join(root,f) for f in files]))
     return manifest
+
+def readable_mode( mode=0644 ):
+    '''
+    mode with the bits the current umask clears taken out so files that are
+    renamed into place from a mkstemp/mkdtemp(always 0600/0700) get the same
+    permissions a normally created file would have
+
+    :param int mode: Permissions before the umask is applied
+    :return: mode & ~umask
+    '''
+    # umask can only be read by setting it
+    umask = os.umask( 0 )
+    os.umask( umask )
+    return mode & ~umask